@@ -178,13 +178,44 @@ class PrecomputeModule(CmdModule):
 
     def __init__(self, parser):
         help_msg = 'precompute to speed up db_search'
-        description = 'precompute logarithms to speed up db_search'
+        description = ('build a search index of a model database with the entropies, their prefix '
+                       'sums, the upper bound tables, consensus strings and checksums. '
+                       'db_search uses an up to date index next to the model database '
+                       'automatically, or the index file itself can be passed as model database')
         super().__init__(parser, help=help_msg, description=description)
         scp = self.subcommand_parser
-        scp.add_argument('some_file')
+        scp.add_argument('model_db', type=aph.file_r,
+                         help='model database in json or binary format')
+        scp.add_argument('--index_file', type=aph.file_rw,
+                         help='output file, defaults to the model database with an .index suffix')
+        scp.add_argument('--min_overlap', type=int, default=4,
+                         help='min_overlap of the searches, shorter models are left out')
+        scp.add_argument('--bucket_width', type=int, default=4,
+                         help='models are grouped into buckets of this length range for scanning')
+        scp.add_argument('--candidate_index', action='store_true',
+                         help='also embed every model into a k-mer affinity vector, so that '
+                              'db_search --candidates can retrieve the most similar models '
+                              'of a query before scoring them. Written next to the index '
+                              'with a .candidates suffix')
+        # the default is candidates.KMER_LENGTH, spelled out so that building
+        # the parser does not import db_search
+        scp.add_argument('--kmer_length', type=int, default=4,
+                         help='k-mer length of the embedding, it has 4^k dimensions')
 
     def __call__(self, args):
-        pass
+        # db_search pulls in numpy and scipy, imported here so that the other
+        # subcommands do not pay for them at startup
+        from bamm_suite.db_search.search_index import build_search_index, default_index_path
+        from bamm_suite.db_search.candidates import CandidateIndex, default_candidate_index_path
+
+        index_file = args.index_file or default_index_path(args.model_db)
+        db_models = build_search_index(args.model_db, index_file, args.min_overlap,
+                                       args.bucket_width)
+        print('wrote the search index of %s models to %s' % (len(db_models), index_file))
+        if args.candidate_index:
+            candidate_file = default_candidate_index_path(index_file)
+            CandidateIndex.build(db_models, args.kmer_length).save(candidate_file)
+            print('wrote the candidate index to %s' % candidate_file)
 
 
 class DBSearchModule(CmdModule):
@@ -38,7 +38,7 @@ def main():
     else:
         args = parser.parse_args()
 
-    args.subcommand_func(args)
+    args._subcommand_func(args)
 
 if __name__ == '__main__':
     main()
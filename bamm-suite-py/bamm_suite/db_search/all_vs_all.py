@@ -0,0 +1,272 @@
+import argparse
+from multiprocessing import Pool
+import json
+import logging
+import os
+import shutil
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from bamm_suite.db_search.packed_db import PackedModelDB
+from bamm_suite.db_search.search_index import load_packed_db
+from bamm_suite.db_search.searcher import MotifSearcher
+from bamm_suite.db_search.db_search import load_null_model
+from bamm_suite.db_search.dispatch import imap_unordered_bounded
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='compare every model of a database with every other model. A pair is kept '
+                    'if either model finds the other with an e-value below the threshold, as '
+                    'in a db_search of the database against itself'
+    )
+    parser.add_argument('model_db')
+    parser.add_argument('output_file', help='sparse similarity matrix in npz format')
+    parser.add_argument('--min_overlap', type=int, default=4)
+    parser.add_argument('--evalue_threshold', type=float, default=0.1)
+    parser.add_argument('--null', choices=['permutation', 'precomputed'], default='permutation',
+                        help='fit the null per model or look it up in the precomputed null model. '
+                             'The permutation nulls cost n_neg_perm database scans per model '
+                             'and strand')
+    parser.add_argument('--null_model',
+                        help='precomputed null model, defaults to the model db with a .null.json suffix')
+    parser.add_argument('--n_neg_perm', type=int, default=10)
+    parser.add_argument('--shared_rev_null', action='store_true',
+                        help='reuse the forward null for the reverse strand instead of fitting '
+                             'its own, see db_search')
+    parser.add_argument('--highscore_fraction', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--tile_size', type=int, default=128,
+                        help='number of models per tile')
+    parser.add_argument('--checkpoint_dir',
+                        help='directory for finished tiles, defaults to the output file '
+                             'with a .checkpoints suffix')
+    parser.add_argument('--keep_checkpoints', action='store_true')
+    parser.add_argument('--n_processes', type=int)
+    return parser
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger_fmt = '%(asctime)s [%(levelname)s]  %(message)s'
+    formatter = logging.Formatter(logger_fmt)
+    console_handler = logging.StreamHandler(stream=sys.stdout)
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+
+    db_models = load_packed_db(args.model_db, args.min_overlap)
+    db_checksum = db_models.checksum()
+
+    checkpoint_dir = args.checkpoint_dir or args.output_file + '.checkpoints'
+    check_manifest(checkpoint_dir, {
+        'db_checksum': db_checksum,
+        'min_overlap': args.min_overlap,
+        'evalue_threshold': args.evalue_threshold,
+        'null': args.null,
+        'n_neg_perm': args.n_neg_perm,
+        'shared_rev_null': args.shared_rev_null,
+        'highscore_fraction': args.highscore_fraction,
+        'seed': args.seed,
+        'tile_size': args.tile_size,
+    })
+    nulls = load_nulls(args, checkpoint_dir, db_models, db_checksum)
+
+    n_tiles = -(-len(db_models) // args.tile_size)
+    tiles = [(tile_a, tile_b) for tile_a in range(n_tiles) for tile_b in range(tile_a, n_tiles)]
+    todo = [tile for tile in tiles if not os.path.exists(tile_path(checkpoint_dir, *tile))]
+    logger.info('Scoring %s tiles, %s of them finished in a previous run',
+                len(tiles), len(tiles) - len(todo))
+
+    db_shm, db_handle = db_models.to_shared_memory()
+    n_models = len(db_models)
+    model_ids = db_models.model_ids
+    del db_models
+
+    def init_workers():
+        global db_models_g
+        db_models_g = PackedModelDB.from_shared_memory(db_handle)
+        global tile_size_g
+        tile_size_g = args.tile_size
+        global min_overlap_g
+        min_overlap_g = args.min_overlap
+        global nulls_g
+        nulls_g = nulls
+        global evalue_threshold_g
+        evalue_threshold_g = args.evalue_threshold
+        global highscore_fraction_g
+        highscore_fraction_g = args.highscore_fraction
+        global checkpoint_dir_g
+        checkpoint_dir_g = checkpoint_dir
+
+    try:
+        with Pool(args.n_processes, initializer=init_workers) as pool:
+            max_in_flight = 4 * (args.n_processes or os.cpu_count())
+            # the diagonal tiles cost half as much, we start with the others
+            todo.sort(key=lambda tile: tile[0] == tile[1])
+            for n_finished, _ in enumerate(imap_unordered_bounded(pool, score_tile, todo,
+                                                                  max_in_flight), start=1):
+                logger.info('Finished tile (%s/%s)', n_finished, len(todo))
+    finally:
+        db_shm.close()
+        db_shm.unlink()
+
+    rows, cols, scores, evalues, strands = [], [], [], [], []
+    for tile in tiles:
+        with np.load(tile_path(checkpoint_dir, *tile)) as tile_result:
+            rows.append(tile_result['row'])
+            cols.append(tile_result['col'])
+            scores.append(tile_result['score'])
+            evalues.append(tile_result['evalue'])
+            strands.append(tile_result['strand'])
+
+    np.savez_compressed(
+        args.output_file,
+        row=np.concatenate(rows), col=np.concatenate(cols),
+        score=np.concatenate(scores), evalue=np.concatenate(evalues),
+        strand=np.concatenate(strands),
+        model_ids=np.array(model_ids), shape=np.array([n_models, n_models]),
+    )
+    logger.info('Wrote %s similar pairs to %s', sum(len(row) for row in rows), args.output_file)
+
+    if not args.keep_checkpoints:
+        shutil.rmtree(checkpoint_dir)
+
+
+def check_manifest(checkpoint_dir, manifest):
+
+    # a resumed run has to use the same database and parameters
+    manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as handle:
+            if json.load(handle) != manifest:
+                raise ValueError('the checkpoints in %s belong to a different database or '
+                                 'different parameters' % checkpoint_dir)
+    else:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        with open(manifest_path, 'w') as out:
+            json.dump(manifest, out, indent=4, sort_keys=True)
+
+
+def load_nulls(args, checkpoint_dir, db_models, db_checksum):
+
+    # the (high_score, exp_lambda) of the null of both strands of every
+    # model as searched against the whole database, shape (n_models, 2, 2).
+    # They are fitted exactly like the nulls of db_search queries and kept
+    # with the checkpoints.
+    nulls_path = os.path.join(checkpoint_dir, 'nulls.npy')
+    if os.path.exists(nulls_path):
+        return np.load(nulls_path)
+
+    logger = logging.getLogger()
+    logger.info('Fitting the nulls of %s models', len(db_models))
+    nulls = np.zeros((len(db_models), 2, 2))
+    models = (db_models.model(index) for index in range(len(db_models)))
+    with MotifSearcher(db_models, n_neg_perm=args.n_neg_perm,
+                       highscore_fraction=args.highscore_fraction,
+                       separate_rev_null=not args.shared_rev_null, seed=args.seed,
+                       min_overlap=args.min_overlap,
+                       null_model=load_null_model(args, args.model_db, db_checksum),
+                       n_processes=args.n_processes or 0) as searcher:
+        for index, (strand_nulls, *_) in enumerate(searcher.map_strand_nulls(models)):
+            nulls[index] = [null[:2] for null in strand_nulls]
+
+    tmp_path = nulls_path + '.tmp.npy'
+    np.save(tmp_path, nulls)
+    os.replace(tmp_path, nulls_path)
+    return nulls
+
+
+def pair_evalues(sims, nulls):
+
+    # e-values of the scores of both strands, shape (2, n), under the nulls
+    # of the strands, shape (2, 2) or (2, 2, n). Like the hits of db_search,
+    # scores below the high score of the null are never significant.
+    high_scores, exp_lambdas = nulls[:, 0], nulls[:, 1]
+    pvalues = highscore_fraction_g * np.exp(-exp_lambdas * (sims - high_scores))
+    return np.where(sims >= high_scores, len(nulls_g) * pvalues, np.inf)
+
+
+def tile_path(checkpoint_dir, tile_a, tile_b):
+    return os.path.join(checkpoint_dir, 'tile_%s_%s.npz' % (tile_a, tile_b))
+
+
+def load_similarity_matrix(path):
+
+    # returns the symmetric similarity matrix as scipy csr matrix, a csr
+    # matrix that is 1 where the best alignment is on the reverse strand,
+    # and the model ids. The e-values of the pairs are in the 'evalue'
+    # array of the file.
+    with np.load(path) as result:
+        row, col = result['row'], result['col']
+        shape = tuple(result['shape'])
+        sym_row, sym_col = np.concatenate([row, col]), np.concatenate([col, row])
+        scores = sparse.csr_matrix((np.tile(result['score'], 2), (sym_row, sym_col)), shape=shape)
+        strands = sparse.csr_matrix((np.tile(result['strand'], 2), (sym_row, sym_col)), shape=shape)
+        return scores, strands, result['model_ids'].tolist()
+
+
+def score_tile(tile):
+    tile_a, tile_b = tile
+    models_a = range(tile_a * tile_size_g, min((tile_a + 1) * tile_size_g, len(db_models_g)))
+    models_b = range(tile_b * tile_size_g, min((tile_b + 1) * tile_size_g, len(db_models_g)))
+
+    # the models of tile b are packed on their own, so that the scans of
+    # all queries of tile a run over a small, cache friendly database
+    tile_db = PackedModelDB([db_models_g.model(index) for index in models_b])
+
+    rows, cols, scores, evalues, strands = [], [], [], [], []
+    for index in models_a:
+        model = db_models_g.model(index)
+        rev_pwm = model['pwm'][::-1, ::-1]
+
+        # the similarity is symmetric, on the diagonal tiles we only score
+        # the upper triangle
+        subset = None
+        if tile_a == tile_b:
+            subset = np.asarray(models_b) > index
+            if not subset.any():
+                continue
+
+        # scoring b against reverse complemented a covers the reverse strand of both
+        sims, *_ = tile_db.score(
+            np.stack([model['pwm'], rev_pwm]),
+            np.stack([model['H_model_bg'], model['H_model_bg'][::-1]]),
+            np.stack([model['H_model'], model['H_model'][::-1]]),
+            min_overlap=min_overlap_g, subset=subset
+        )
+        # the pair is as significant as the better of a search with a and a
+        # search with b, on the strand with the lowest e-value
+        col_nulls = np.moveaxis(nulls_g[np.asarray(models_b)], 0, -1)
+        pair_evalue = np.minimum(pair_evalues(sims, nulls_g[index][:, :, None]),
+                                 pair_evalues(sims, col_nulls))
+        strand = pair_evalue.argmin(axis=0)
+        best = pair_evalue.min(axis=0)
+        hits = np.flatnonzero(best < evalue_threshold_g)
+        rows.append(np.full(len(hits), index))
+        cols.append(np.asarray(models_b)[hits])
+        scores.append(sims[strand[hits], hits])
+        evalues.append(best[hits])
+        strands.append(strand[hits])
+
+    def concat(arrays, dtype):
+        return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+    # write to a temporary file first, an interrupted run must not leave
+    # a truncated tile behind
+    path = tile_path(checkpoint_dir_g, tile_a, tile_b)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, row=concat(rows, np.int64), col=concat(cols, np.int64),
+             score=concat(scores, float), evalue=concat(evalues, float),
+             strand=concat(strands, np.int8))
+    os.replace(tmp_path, path)
+    return tile
+
+
+if __name__ == '__main__':
+    main()
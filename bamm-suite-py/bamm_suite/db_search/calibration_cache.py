@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+def hash_arrays(*arrays):
+    sha = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr, dtype=float)
+        # the shape is part of the hash, so that e.g. a 4x2 and a 2x4
+        # matrix with the same entries do not collide
+        sha.update(repr(arr.shape).encode())
+        sha.update(arr.tobytes())
+    return sha.hexdigest()
+
+
+class CalibrationCache:
+
+    # On-disk cache of the fitted null distribution (high_score, exp_lambda)
+    # of a query, together with the number of permutations it took. Every
+    # entry is a small json file named after the hash of the query pwm, the
+    # database checksum and the search parameters.
+    # The modification time of an entry is its last use, the least recently
+    # used entries are evicted once the cache holds more than max_entries.
+
+    suffix = '.json'
+
+    def __init__(self, directory, max_entries=10000):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, pwm, bg_freq, db_checksum, **params):
+        sha = hashlib.sha1()
+        sha.update(hash_arrays(pwm, bg_freq).encode())
+        sha.update(db_checksum.encode())
+        sha.update(json.dumps(params, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as entry:
+                calibration = json.load(entry)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted by another process in the meantime
+            pass
+        return calibration['high_score'], calibration['exp_lambda'], calibration['n_perm']
+
+    def put(self, key, high_score, exp_lambda, n_perm):
+        # write to a temporary file first, so that concurrent readers
+        # never see a partially written entry
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'w') as entry:
+            json.dump({'high_score': float(high_score), 'exp_lambda': float(exp_lambda),
+                       'n_perm': int(n_perm)}, entry)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for dir_entry in it:
+                if not dir_entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    entries.append((dir_entry.stat().st_mtime, dir_entry.path))
+                except OSError:
+                    continue
+
+        n_evict = len(entries) - self.max_entries
+        if n_evict <= 0:
+            return
+        entries.sort()
+        for _, path in entries[:n_evict]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+
+# k-mers of the embedding, 4 ** KMER_LENGTH dimensions
+KMER_LENGTH = 4
+EMBEDDING_DTYPE = np.float32
+
+
+def default_candidate_index_path(index_path):
+    return index_path + '.candidates'
+
+
+def kmer_affinities(pwm, bg_freq, kmer_length=KMER_LENGTH):
+
+    # the affinity of the pwm to every k-mer, in lexicographic order of the
+    # k-mers: the highest probability of the k-mer over the windows of the
+    # pwm, minus its probability under the background
+    n_windows = len(pwm) - kmer_length + 1
+    if n_windows <= 0:
+        return np.zeros(len(bg_freq) ** kmer_length)
+    probs = np.ones((n_windows, 1))
+    bg_probs = np.ones(1)
+    for offset in range(kmer_length):
+        probs = (probs[:, :, None] * pwm[offset:offset + n_windows, None, :]).reshape(n_windows, -1)
+        bg_probs = np.outer(bg_probs, bg_freq).reshape(-1)
+    return probs.max(axis=0) - bg_probs
+
+
+def embed_model(pwm, bg_freq, kmer_length=KMER_LENGTH):
+
+    # the unit length embedding of a model. The k-mer affinities of both
+    # strands are added up, so that a model and its reverse complement
+    # embed alike, just as the search scores both strands of a query.
+    pwm = np.asarray(pwm, dtype=float)
+    bg_freq = np.asarray(bg_freq, dtype=float)
+    embedding = kmer_affinities(pwm, bg_freq, kmer_length) \
+        + kmer_affinities(pwm[::-1, ::-1], bg_freq[::-1], kmer_length)
+    norm = np.linalg.norm(embedding)
+    if norm > 0:
+        embedding /= norm
+    return embedding.astype(EMBEDDING_DTYPE)
+
+
+class CandidateIndex:
+
+    # The embeddings of all models of a packed database, to retrieve the
+    # models most similar to a query before scoring them exactly (see
+    # MotifSearcher n_candidates). The similarity of two models is the dot
+    # product of their embeddings. The retrieval is an exact search over
+    # all embeddings, which costs a small fraction of scoring the models.
+    #
+    # db_checksum ties the index to the database it was built from (see
+    # PackedModelDB.checksum).
+
+    def __init__(self, embeddings, db_checksum, kmer_length=KMER_LENGTH):
+        self.embeddings = embeddings
+        self.db_checksum = db_checksum
+        self.kmer_length = kmer_length
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @classmethod
+    def build(cls, db_models, kmer_length=KMER_LENGTH):
+        embeddings = np.zeros((len(db_models), 4 ** kmer_length), dtype=EMBEDDING_DTYPE)
+        for index in range(len(db_models)):
+            model = db_models.model(index)
+            embeddings[index] = embed_model(model['pwm'], model['bg_freq'], kmer_length)
+        return cls(embeddings, db_models.checksum(), kmer_length)
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as out:
+            np.savez(out, embeddings=self.embeddings, db_checksum=self.db_checksum,
+                     kmer_length=self.kmer_length)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['embeddings'], str(data['db_checksum']), int(data['kmer_length']))
+
+    def candidates(self, model, n_candidates):
+        # the database indices of the n_candidates models most similar to
+        # the query, in database order
+        if n_candidates >= len(self):
+            return np.arange(len(self))
+        similarity = self.embeddings @ embed_model(model['pwm'], model['bg_freq'],
+                                                   self.kmer_length)
+        return np.sort(np.argpartition(-similarity, n_candidates - 1)[:n_candidates])
@@ -1,30 +1,156 @@
 import argparse
-from multiprocessing import Pool
+from contextlib import contextmanager, nullcontext
 import json
-import numpy as np
 import logging
+import os
 import sys
 
-from bamm_suite.db_search.utils import calculate_H_model_bg, calculate_H_model, model_sim
+from bamm_suite.db_search.utils import shard_range
+from bamm_suite.db_search.model_db import load_models, update_models
+from bamm_suite.db_search.search_index import load_packed_db, find_search_index
+from bamm_suite.db_search.calibration_cache import CalibrationCache
+from bamm_suite.db_search.null_model import NullModel, default_null_model_path
+from bamm_suite.db_search.metrics import SearchMetrics, ProgressReporter
+from bamm_suite.db_search.incremental import write_search_state, load_search_state
+from bamm_suite.db_search.incremental import check_previous_results, merge_previous_results
+from bamm_suite.db_search.searcher import MotifSearcher
+from bamm_suite.db_search.result_store import HitStore
+from bamm_suite.db_search.out_of_core import IndexBlockReader, out_of_core_search
+from bamm_suite.db_search.candidates import CandidateIndex, default_candidate_index_path
+
+
+def shard_type(value):
+    # argparse type for shards given as i/N, with 1 <= i <= N
+    try:
+        index, n_shards = (int(tok) for tok in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('shards are given as i/N, not %r' % value)
+    if not 1 <= index <= n_shards:
+        raise argparse.ArgumentTypeError('shard %r out of range' % value)
+    return index, n_shards
 
 
 def create_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('input_models')
     parser.add_argument('model_db')
+    add_search_arguments(parser)
+    parser.add_argument('--shard', type=shard_type,
+                        help='only search the i-th of N equal parts of the queries, given as i/N')
+    parser.add_argument('--db_shard', type=shard_type,
+                        help='only scan the i-th of N equal parts of the model db, given as i/N. '
+                             'The null is still fitted on the whole db.')
+    parser.add_argument('--streaming', action='store_true',
+                        help='write the hits of every query as soon as it finishes')
+    parser.add_argument('--schedule', choices=('cost', 'input'), default='cost',
+                        help='cost: dispatch the most expensive queries first, in tiles that '
+                             'split long queries over database blocks (see TileScheduler). '
+                             'input: one job per query in input order')
+    parser.add_argument('--chunk_size', type=int, default=1,
+                        help='number of queries per job in streaming mode with --schedule input')
+    parser.add_argument('--max_in_flight', type=int,
+                        help='maximum number of pending jobs, defaults to two per process with '
+                             '--schedule cost and four per process in streaming mode with '
+                             '--schedule input')
+    parser.add_argument('--sort_output', action='store_true',
+                        help='in streaming mode, restore the input order of the queries at the end '
+                             'of a tsv output')
+    parser.add_argument('--metrics_file',
+                        help='write the time per phase and the counters of every query as json')
+    parser.add_argument('--progress_interval', type=float,
+                        help='log the throughput and the remaining time every this many seconds '
+                             'instead of a line per query')
+    parser.add_argument('--save_state', action='store_true',
+                        help='store the null fits and the database size next to the output file, '
+                             'so that the results can be extended with --previous_results')
+    parser.add_argument('--previous_results',
+                        help='result file of a run with --save_state. model_db then only holds the '
+                             'models added since, the previous hits are rescaled to the new '
+                             'database size and merged with the hits of the new models')
+    parser.add_argument('--memory_budget', type=float,
+                        help='search out of core within this many MB: the database is read in '
+                             'blocks from its search index (see bamm precompute) and all '
+                             'queries are scored against one block before the next is read')
+    parser.add_argument('--candidates', type=int,
+                        help='approximate search: only score this many database models most '
+                             'similar to a query in the candidate index (see bamm precompute '
+                             '--candidate_index). Hits can be missed, the ones found have the '
+                             'e-values of a full search. The null is still fitted against the '
+                             'whole database, combine with --null precomputed or a calibration '
+                             'cache for the full speedup')
+    parser.add_argument('--candidate_index',
+                        help='candidate index file, defaults to the one next to the search index '
+                             'of the model db')
+    parser.add_argument('--output_format', choices=('tsv', 'sqlite'), default='tsv',
+                        help='sqlite writes the hits into an indexed result store instead, '
+                             'see db_search_query')
+    parser.add_argument('output_file')
+    return parser
+
+
+def add_search_arguments(parser):
+
+    # the options of the search itself, shared with the search server
+    parser.add_argument('--null', choices=['permutation', 'precomputed'], default='permutation',
+                        help='fit the null per query or look it up in the precomputed null model')
+    parser.add_argument('--null_model',
+                        help='precomputed null model, defaults to the model db with a .null.json suffix')
     parser.add_argument('--n_neg_perm', type=int, default=10)
+    parser.add_argument('--adaptive_neg_perm', action='store_true',
+                        help='draw permutations in batches until the null fit converges')
+    parser.add_argument('--neg_perm_batch', type=int, default=2,
+                        help='permutations per batch in adaptive mode')
+    parser.add_argument('--max_neg_perm', type=int, default=50,
+                        help='maximum number of permutations in adaptive mode')
+    parser.add_argument('--neg_perm_tol', type=float, default=0.02,
+                        help='relative tolerance on high_score and lambda in adaptive mode')
+    parser.add_argument('--shared_rev_null', action='store_true',
+                        help='reuse the forward null for the reverse strand instead of fitting '
+                             'its own. This halves the permutations, but the e-values of the '
+                             'reverse strand are only exact if the model db holds the reverse '
+                             'complement of every model')
+    # fitting both strands separately is the default, the flag is kept for
+    # existing scripts
+    parser.add_argument('--separate_rev_null', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--no_prune', action='store_true',
+                        help='score every database model, even if its upper bound rules out a hit')
+    parser.add_argument('--top_k', type=int,
+                        help='only report the k hits with the lowest e-values per query')
     parser.add_argument('--highscore_fraction', type=float, default=0.1)
     parser.add_argument('--evalue_threshold', type=float, default=0.1)
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--min_overlap', type=int, default=4)
     parser.add_argument('--n_processes', type=int)
-    parser.add_argument('output_file')
-    return parser
+    parser.add_argument('--precision', choices=('float64', 'float32'), default='float64',
+                        help='precision of the database scan. float32 halves the memory traffic '
+                             'of the scan, scores close to the hit threshold are scored again '
+                             'in float64')
+    parser.add_argument('--db_size', type=int,
+                        help='database size for the e-values, defaults to the number of models')
+    parser.add_argument('--calibration_cache',
+                        help='directory for caching the fitted null distributions of queries')
+    parser.add_argument('--calibration_cache_size', type=int, default=10000,
+                        help='maximum number of cached null distributions')
 
 
 def main():
     parser = create_parser()
     args = parser.parse_args()
+    if args.previous_results and (args.shard or args.db_shard or args.top_k
+                                  or args.null == 'precomputed'):
+        parser.error('--previous_results cannot be combined with --shard, --db_shard, --top_k '
+                     'or --null precomputed')
+    if args.memory_budget and (args.db_shard or args.candidates):
+        parser.error('--memory_budget cannot be combined with --db_shard or --candidates')
+    if args.memory_budget and args.adaptive_neg_perm and args.null == 'permutation' \
+            and not args.previous_results:
+        parser.error('--adaptive_neg_perm fits the null against the whole database at once, '
+                     'with --memory_budget it needs --null precomputed or --previous_results')
+    if args.output_format == 'sqlite' and (args.shard or args.db_shard or args.save_state
+                                           or args.previous_results):
+        parser.error('--output_format sqlite cannot be combined with --shard, --db_shard, '
+                     '--save_state or --previous_results, their tsv results can be loaded into '
+                     'a store with db_search_query --from_tsv')
 
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
@@ -36,142 +162,278 @@ def main():
 
     logger.setLevel(logging.INFO)
 
-    def update_models(models):
-        upd_models = []
-        for model in models:
-            model['pwm'] = np.array(model['pwm'], dtype=float)
-            model_length, _ = model['pwm'].shape
-            if model_length < args.min_overlap:
-                logger.warn('model %s with length %s too small for the chosen min_overlap (%s).'
-                            ' Please consider lowering the min_overlap threshold.',
-                            model['model_id'], model_length, args.min_overlap)
-                continue
-            model['bg_freq'] = np.array(model['bg_freq'], dtype=float)
-            if 'H_model_bg' not in model or 'H_model' not in model:
-                model['H_model_bg'] = calculate_H_model_bg(model['pwm'], model['bg_freq'])
-                model['H_model'] = calculate_H_model(model['pwm'])
-            else:
-                model['H_model_bg'] = np.array(model['H_model_bg'], dtype=float)
-                model['H_model'] = np.array(model['H_model'], dtype=float)
-            upd_models.append(model)
-        return upd_models
-
-    with open(args.input_models) as in_models:
-        models = update_models(json.load(in_models))
-
-    with open(args.model_db) as model_db:
-        db_models = update_models(json.load(model_db))
-        db_size = len(db_models)
-
-    rev_models = []
-    for model in models:
-        rev_model = dict(model)
-        rev_model['model_id'] = model['model_id'] + '_rev'
-        # reverse complement the pwm
-        rev_model['pwm'] = model['pwm'][::-1, ::-1]
-
-        # entropy calculations simply reverse
-        rev_model['H_model_bg'] = model['H_model_bg'][::-1]
-        rev_model['H_model'] = model['H_model'][::-1]
-        rev_models.append(rev_model)
-
-    # intertwine models and rev. complemented models
-    models = [model for pair in zip(models, rev_models) for model in pair]
-
-    def init_workers():
-        global highscore_fraction_g
-        highscore_fraction_g = args.highscore_fraction
-        global evalue_thresh_g
-        evalue_thresh_g = args.evalue_threshold
-        np.random.seed(args.seed)
-        global db_models_g
-        db_models_g = db_models
-        global db_size_g
-        db_size_g = db_size
-        global n_neg_perm_g
-        n_neg_perm_g = args.n_neg_perm
-        global min_overlap_g
-        min_overlap_g = args.min_overlap
+    # the per query records are only needed for the metrics file
+    metrics = SearchMetrics(keep_queries=bool(args.metrics_file))
+    with metrics.phase('load_queries'):
+        models = list(load_models(args.input_models))
+    with metrics.phase('prepare_queries'):
+        models = update_models(models, args.min_overlap)
+    if args.shard:
+        start, end = shard_range(len(models), args.shard)
+        models = models[start:end]
+
+    # out of core, the database is only opened here and read in blocks
+    # during the search
+    reader = None
+    with metrics.phase('load_db'):
+        if args.memory_budget:
+            index_path = find_search_index(args.model_db, args.min_overlap)
+            if index_path is None:
+                parser.error('--memory_budget needs an up to date search index of %s, '
+                             'please build one with bamm precompute' % args.model_db)
+            reader = IndexBlockReader(index_path)
+            n_db_models = len(reader)
+        else:
+            db_models = load_packed_db(args.model_db, args.min_overlap, args.precision)
+            n_db_models = len(db_models)
+    db_size = args.db_size or n_db_models
+
+    # in incremental mode the queries keep the null of the previous run and
+    # only the new database models are scanned
+    stored_nulls = None
+    separate_rev_null = not args.shared_rev_null
+    if args.previous_results:
+        previous_state = load_search_state(args.previous_results)
+        check_previous_results(args.previous_results, previous_state,
+                               hit_header(args.adaptive_neg_perm), vars(args))
+        db_size = args.db_size or previous_state['db_size'] + n_db_models
+        stored_nulls = previous_state['nulls']
+        separate_rev_null = previous_state['params']['separate_rev_null']
+        # these only change the null fit, the stored nulls are used instead
+        for param in ('highscore_fraction', 'n_neg_perm', 'seed'):
+            if previous_state['params'][param] != getattr(args, param):
+                logger.warn('the previous results were created with %s=%s.',
+                            param, previous_state['params'][param])
+        if previous_state['evalue_threshold'] < args.evalue_threshold:
+            logger.warn('the previous results were filtered with e-value threshold %s, '
+                        'hits may be missing.', previous_state['evalue_threshold'])
+        missing = [model['model_id'] for model in models if model['model_id'] not in stored_nulls]
+        if missing:
+            raise ValueError('queries %s are not part of the previous results, please search '
+                             'them against the full database' % ', '.join(missing))
+        logger.info('Extending %s from %s to %s database models',
+                    args.previous_results, previous_state['db_size'], db_size)
+    db_shard = None
+    if args.db_shard:
+        db_shard = shard_range(n_db_models, args.db_shard)
+
+    sharded = args.shard or args.db_shard or args.db_size
+    if sharded:
+        # the merge command needs to know how the partial results were created
+        with open(args.output_file + '.meta.json', 'w') as meta:
+            json.dump({
+                'db_size': db_size,
+                'evalue_threshold': args.evalue_threshold,
+                'shard': args.shard or (1, 1),
+                'db_shard': args.db_shard or (1, 1),
+                'query_ids': [model['model_id'] for model in models],
+            }, meta, indent=4, sort_keys=True)
+    db_checksum = None
+    if args.calibration_cache or args.null == 'precomputed' or args.candidates:
+        with metrics.phase('checksum_db'):
+            db_checksum = reader.checksum if reader else db_models.checksum()
+
+    null_model = load_null_model(args, args.model_db, db_checksum)
+    candidate_index = None
+    if args.candidates:
+        with metrics.phase('load_candidate_index'):
+            candidate_index = load_candidate_index(parser, args, db_checksum)
+
+    params = dict(search_params(args), db_size=db_size, db_shard=db_shard, db_checksum=db_checksum,
+                  null_model=null_model, stored_nulls=stored_nulls,
+                  separate_rev_null=separate_rev_null, candidate_index=candidate_index,
+                  n_candidates=args.candidates)
+    if reader is None:
+        with metrics.phase('start_workers'):
+            searcher = MotifSearcher(db_models, n_processes=args.n_processes or 0, **params)
+        del db_models
+    else:
+        searcher = nullcontext()
 
     logger.info('Queuing %s search jobs', len(models))
 
-    with open(args.output_file, 'w') as out:
-        print('model_id', 'db_id', 'simscore', 'e-value',
-              'start_query', 'end_query', 'start_hit', 'end_hit', 'bg_score', 'cross_score',
-              sep='\t', file=out)
-        with Pool(args.n_processes, initializer=init_workers) as pool:
-            jobs = []
-            for model in models:
-                job = pool.apply_async(motif_search, args=(model,))
-                jobs.append(job)
-
-            total_jobs = len(jobs)
-            for job_index, job in enumerate(jobs, start=1):
-                hits = job.get()
-                hits.sort(key=lambda x: x[3])
-                for hit in hits:
-                    print(*hit, sep='\t', file=out)
+    with searcher, open_hit_writer(args) as write_hits, metrics.phase('search'):
+        if reader is None:
+            # in streaming mode, hits are written in completion order, with a
+            # bounded number of pending jobs
+            results = searcher.map_search(models, ordered=not args.streaming,
+                                          chunk_size=args.chunk_size,
+                                          max_in_flight=args.max_in_flight,
+                                          schedule=args.schedule)
+        else:
+            results = out_of_core_search(reader, models, args.memory_budget * 2 ** 20,
+                                         n_processes=args.n_processes or 0,
+                                         precision=args.precision, **params)
+
+        total_jobs = len(models)
+        job_index = 0
+        progress = None
+        # the nulls are only needed for the search state
+        nulls = {}
+        collect_nulls = args.save_state or args.previous_results
+        if args.progress_interval:
+            progress = ProgressReporter(logger, total_jobs, args.progress_interval)
+        # every query yields the hits of the forward and the reverse strand
+        for strand_hits, stats in results:
+            metrics.add_query(stats)
+            if collect_nulls:
+                nulls.update(stats['nulls'])
+            write_hits(strand_hits)
+            job_index += 1
+            if progress is None:
                 logger.info('Finished (%s/%s)', job_index, total_jobs)
+            else:
+                progress.update(2 * stats['pairs'])
+        totals = metrics.totals()
+        logger.info('Pruned %s of %s query/database pairs', totals['pruned'], totals['pairs'])
+
+    for worker, usage in sorted(metrics.summary()['workers'].items()):
+        logger.info('Worker %s busy %.1fs, utilization %.0f%%', worker, usage['busy_s'],
+                    100 * usage['utilization'])
+
+    query_order = {}
+    for index, model in enumerate(models):
+        query_order[model['model_id']] = 2 * index
+        query_order[model['model_id'] + '_rev'] = 2 * index + 1
+    if args.previous_results:
+        with metrics.phase('merge_previous'):
+            merge_previous_results(args.output_file, args.previous_results,
+                                   db_size / previous_state['db_size'], args.evalue_threshold,
+                                   query_order)
+    elif args.streaming and args.sort_output and args.output_format == 'tsv':
+        with metrics.phase('sort_output'):
+            sort_hits_file(args.output_file, query_order)
+
+    if args.save_state or args.previous_results:
+        params = {
+            'min_overlap': args.min_overlap,
+            'highscore_fraction': args.highscore_fraction,
+            'n_neg_perm': args.n_neg_perm,
+            'seed': args.seed,
+            'separate_rev_null': separate_rev_null,
+            'precision': args.precision,
+        }
+        write_search_state(args.output_file, db_size, args.evalue_threshold, params, nulls)
+
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
+        logger.info('Wrote metrics to %s', args.metrics_file)
+
+
+def load_null_model(args, model_db, db_checksum):
+    if args.null != 'precomputed':
+        return None
+
+    logger = logging.getLogger()
+    null_model = NullModel.load(args.null_model or default_null_model_path(model_db))
+    if null_model.db_checksum != db_checksum:
+        logger.warn('the null model was calibrated on a different model database.')
+    for param in ('min_overlap', 'highscore_fraction'):
+        if null_model.params[param] != getattr(args, param):
+            logger.warn('the null model was calibrated with %s=%s.',
+                        param, null_model.params[param])
+    return null_model
+
+
+def load_candidate_index(parser, args, db_checksum):
+    candidate_file = args.candidate_index
+    if candidate_file is None:
+        index_path = find_search_index(args.model_db, args.min_overlap)
+        if index_path is not None:
+            candidate_file = default_candidate_index_path(index_path)
+    if candidate_file is None or not os.path.exists(candidate_file):
+        parser.error('--candidates needs a candidate index of %s, please build one with '
+                     'bamm precompute --candidate_index' % args.model_db)
+
+    candidate_index = CandidateIndex.load(candidate_file)
+    if candidate_index.db_checksum != db_checksum:
+        parser.error('the candidate index %s was built from a different model database, '
+                     'please build it again' % candidate_file)
+    return candidate_index
+
+
+def search_params(args):
+
+    # the MotifSearcher arguments of the parsed search options
+    adaptive_perm = None
+    if args.adaptive_neg_perm:
+        adaptive_perm = (args.neg_perm_batch, args.max_neg_perm, args.neg_perm_tol)
+    calibration_cache = None
+    if args.calibration_cache:
+        calibration_cache = CalibrationCache(args.calibration_cache, args.calibration_cache_size)
+    return {
+        'highscore_fraction': args.highscore_fraction,
+        'evalue_threshold': args.evalue_threshold,
+        'n_neg_perm': args.n_neg_perm,
+        'adaptive_perm': adaptive_perm,
+        'min_overlap': args.min_overlap,
+        'top_k': args.top_k,
+        'prune': not args.no_prune,
+        'separate_rev_null': not args.shared_rev_null,
+        'seed': args.seed,
+        'db_size': args.db_size,
+        'calibration_cache': calibration_cache,
+    }
+
+
+def hit_header(adaptive_neg_perm):
+    header = ['model_id', 'db_id', 'simscore', 'e-value',
+              'start_query', 'end_query', 'start_hit', 'end_hit', 'bg_score', 'cross_score']
+    if adaptive_neg_perm:
+        header.append('n_neg_perm')
+    return header
+
+
+@contextmanager
+def open_hit_writer(args):
+
+    # a function that writes the hits of a query to the output file. In
+    # streaming mode, every query is flushed to disk right away.
+    if args.output_format == 'sqlite':
+        with HitStore(args.output_file, args.adaptive_neg_perm) as store:
+            def write_hits(strand_hits):
+                store.add(hit_rows(strand_hits))
+                if args.streaming:
+                    store.flush()
+            yield write_hits
+        return
+
+    with open(args.output_file, 'w') as out:
+        print(*hit_header(args.adaptive_neg_perm), sep='\t', file=out)
+
+        def write_hits(strand_hits):
+            for line in hit_lines(strand_hits):
+                print(line, file=out)
+            if args.streaming:
+                out.flush()
+        yield write_hits
+
+
+def hit_rows(strand_hits):
+
+    # the output rows of one query, strand by strand in e-value order
+    for hits in strand_hits:
+        hits.sort(key=lambda x: x[3])
+        yield from hits
+
+
+def hit_lines(strand_hits):
+    for hit in hit_rows(strand_hits):
+        yield '\t'.join(str(value) for value in hit)
+
+
+def sort_hits_file(path, query_order):
 
+    # sort the hits by query in input order and by e-value within a query
+    with open(path) as handle:
+        header = handle.readline()
+        rows = [line.rstrip('\n').split('\t') for line in handle]
+    rows.sort(key=lambda row: (query_order[row[0]], float(row[3])))
+    with open(path, 'w') as out:
+        out.write(header)
+        for row in rows:
+            print(*row, sep='\t', file=out)
 
-def motif_search(model):
-    pwm = model['pwm']
-    model_id = model['model_id']
-    bg_freq = model['bg_freq']
-    model_len = len(pwm)
-    H_model = model['H_model']
-    H_model_bg = model['H_model_bg']
-
-    # step 1: use shuffled pwms to estimate the p-value under the null.
-    shuffled_dists = []
-    for _ in range(n_neg_perm_g):
-        # calculate a locality preserving permutation
-        assert model_len > 1
-        Z = np.random.normal(0, 1, model_len)
-        shuffle_ind = np.argsort(2 * Z - np.arange(model_len))
-
-        shuffle_pwm = pwm[shuffle_ind]
-        H_shuffle_bg = calculate_H_model_bg(shuffle_pwm, bg_freq)
-        H_shuffle = calculate_H_model(shuffle_pwm)
-
-        for db_model in db_models_g:
-            shuf_sim, *_ = model_sim(
-                shuffle_pwm, db_model['pwm'],
-                H_shuffle_bg, db_model['H_model_bg'],
-                H_shuffle, db_model['H_model'],
-                min_overlap=min_overlap_g
-            )
-            shuffled_dists.append(shuf_sim)
-
-    # we are fitting only the tail of the null scores with an exponential
-    # distribution
-    sorted_null = np.sort(shuffled_dists)
-    N_neg = len(sorted_null)
-    high_scores = sorted_null[-int(N_neg * highscore_fraction_g):]
-    high_score = high_scores[0]
-    exp_lambda = 1 / np.mean(high_scores - high_score)
-
-    hits = []
-    # run pwm against the database
-    for db_model in db_models_g:
-        sim, (start1, end1), (start2, end2), (bg_score, cross_score) = model_sim(
-            pwm, db_model['pwm'],
-            H_model_bg, db_model['H_model_bg'],
-            H_model, db_model['H_model'],
-            min_overlap=min_overlap_g,
-        )
-        if sim < high_score:
-            # the score is not in the top scores of the background model
-            # this is surely not a significant hit
-            continue
-
-        pvalue = highscore_fraction_g * np.exp(- exp_lambda * (sim - high_score))
-        evalue = db_size_g * pvalue
-        if evalue < evalue_thresh_g:
-            hits.append((model_id, db_model['model_id'], sim, evalue,
-                         start1, end1, start2, end2,
-                         max(bg_score, 0), max(cross_score, 0)))
-    return hits
 
 if __name__ == '__main__':
     main()
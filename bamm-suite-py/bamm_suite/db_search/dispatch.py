@@ -0,0 +1,43 @@
+import queue
+
+
+def chunked(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def imap_unordered_bounded(pool, func, iterable, max_in_flight):
+
+    # like Pool.imap_unordered, but the iterable is consumed lazily and at
+    # most max_in_flight jobs are submitted and not yet collected. This
+    # bounds the memory held by pending arguments and finished results.
+    finished = queue.Queue()
+
+    def on_success(result):
+        finished.put((True, result))
+
+    def on_error(error):
+        finished.put((False, error))
+
+    def collect():
+        success, result = finished.get()
+        if not success:
+            raise result
+        return result
+
+    n_in_flight = 0
+    for item in iterable:
+        if n_in_flight >= max_in_flight:
+            yield collect()
+            n_in_flight -= 1
+        pool.apply_async(func, args=(item,), callback=on_success, error_callback=on_error)
+        n_in_flight += 1
+
+    for _ in range(n_in_flight):
+        yield collect()
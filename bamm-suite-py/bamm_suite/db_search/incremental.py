@@ -0,0 +1,81 @@
+import json
+import os
+
+
+def state_path(result_file):
+    return result_file + '.state.json'
+
+
+def write_search_state(result_file, db_size, evalue_threshold, params, nulls):
+
+    # everything an incremental run needs to extend the results of this run:
+    # the database size the e-values refer to, the search parameters and the
+    # fitted null distribution (high_score, exp_lambda, n_perm) of every
+    # query strand
+    with open(state_path(result_file), 'w') as out:
+        json.dump({
+            'db_size': db_size,
+            'evalue_threshold': evalue_threshold,
+            'params': params,
+            'nulls': nulls,
+        }, out, indent=4, sort_keys=True)
+
+
+def load_search_state(result_file):
+    path = state_path(result_file)
+    if not os.path.exists(path):
+        raise ValueError('%s has no %s, was it created with --save_state?' % (result_file, path))
+    with open(path) as handle:
+        state = json.load(handle)
+    state['nulls'] = {strand_id: tuple(null) for strand_id, null in state['nulls'].items()}
+    return state
+
+
+def check_previous_results(result_file, state, header, params):
+
+    # the previous hits are only merged after the search, so everything that
+    # would keep them from merging with the hits of this run is checked
+    # before: the file has to be a tsv result with the columns of this run,
+    # and the new models have to be scored like the previous ones
+    try:
+        with open(result_file) as handle:
+            previous_header = handle.readline().rstrip('\n').split('\t')
+    except (OSError, UnicodeDecodeError) as err:
+        raise ValueError('cannot read the previous results %s as tsv: %s' % (result_file, err))
+    if previous_header != header:
+        raise ValueError('%s has the columns %s, but this run writes %s'
+                         % (result_file, ', '.join(previous_header), ', '.join(header)))
+    for param in ('min_overlap', 'precision'):
+        if state['params'][param] != params[param]:
+            raise ValueError('%s was created with %s=%s, the new models have to be scored with '
+                             'the same value' % (result_file, param, state['params'][param]))
+
+
+def merge_previous_results(result_file, previous_file, scale, evalue_threshold, query_order):
+
+    # adds the hits of a previous run to the hits of the new database models
+    # in result_file. The e-values of the previous hits are rescaled to the
+    # new database size and filtered with the threshold again. A larger
+    # database only increases e-values, so no previous hit can be missing.
+    with open(previous_file) as handle:
+        header = handle.readline()
+        rows = []
+        for line in handle:
+            row = line.rstrip('\n').split('\t')
+            evalue = float(row[3]) * scale
+            if evalue < evalue_threshold and row[0] in query_order:
+                row[3] = repr(evalue)
+                rows.append(row)
+
+    with open(result_file) as handle:
+        if handle.readline() != header:
+            raise ValueError('%s and %s have different columns' % (previous_file, result_file))
+        rows.extend(line.rstrip('\n').split('\t') for line in handle)
+
+    # the sort is stable, ties keep the previous hits first like the
+    # database order of a full run with the new models appended
+    rows.sort(key=lambda row: (query_order[row[0]], float(row[3])))
+    with open(result_file, 'w') as out:
+        out.write(header)
+        for row in rows:
+            print(*row, sep='\t', file=out)
@@ -1,15 +1,17 @@
 import argparse
-import json
 import re
 
 import numpy as np
 from bamm_suite.db_search.utils import calculate_H_model, calculate_H_model_bg
+from bamm_suite.db_search.model_db import write_binary_db, write_json_db
 
 
 def create_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('meme_file')
     parser.add_argument('model_file')
+    parser.add_argument('--binary', action='store_true',
+                        help='write a binary model database instead of json')
     return parser
 
 
@@ -60,8 +62,10 @@ def main():
 
                 models.append(model)
 
-    with open(args.model_file, 'w') as out_db:
-        json.dump(models, out_db, indent=4, separators=(',', ': '), sort_keys=True)
+    if args.binary:
+        write_binary_db(args.model_file, models)
+    else:
+        write_json_db(args.model_file, models)
 
 
 class MalformattedMemeError(ValueError):
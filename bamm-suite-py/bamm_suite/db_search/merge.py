@@ -0,0 +1,92 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='merge the partial results of sharded db_search runs'
+    )
+    parser.add_argument('partial_results', nargs='+',
+                        help='result files of db_search runs with --shard/--db_shard')
+    parser.add_argument('output_file')
+    parser.add_argument('--db_size', type=int,
+                        help='database size for the e-values, defaults to the one of the shards')
+    parser.add_argument('--evalue_threshold', type=float, default=0.1)
+    return parser
+
+
+def load_meta(result_file):
+    meta_file = result_file + '.meta.json'
+    if not os.path.exists(meta_file):
+        raise ValueError('%s has no %s, was it created with --shard or --db_shard?'
+                         % (result_file, meta_file))
+    with open(meta_file) as handle:
+        return json.load(handle)
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger_fmt = '%(asctime)s [%(levelname)s]  %(message)s'
+    formatter = logging.Formatter(logger_fmt)
+    console_handler = logging.StreamHandler(stream=sys.stdout)
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+
+    metas = [load_meta(result_file) for result_file in args.partial_results]
+    db_size = args.db_size or metas[0]['db_size']
+    for result_file, meta in zip(args.partial_results, metas):
+        if meta['db_size'] < db_size and meta['evalue_threshold'] < args.evalue_threshold:
+            logger.warning('%s was filtered with e-value threshold %s for a smaller database, '
+                           'hits may be missing.', result_file, meta['evalue_threshold'])
+
+    # the partial results are ordered like a single-node run: by query shard,
+    # then by database shard
+    order = sorted(range(len(metas)),
+                   key=lambda index: (metas[index]['shard'][0], metas[index]['db_shard'][0]))
+
+    # queries are ranked by their input order, the reverse strand right
+    # after the forward strand
+    query_rank = {}
+    for file_index in order:
+        meta = metas[file_index]
+        for model_id in meta['query_ids']:
+            for strand_id in (model_id, model_id + '_rev'):
+                query_rank.setdefault(strand_id, len(query_rank))
+
+    header = None
+    hits = []
+    for file_index in order:
+        scale = db_size / metas[file_index]['db_size']
+        with open(args.partial_results[file_index]) as handle:
+            file_header = handle.readline()
+            if header is None:
+                header = file_header
+            elif file_header != header:
+                raise ValueError('%s has a different header' % args.partial_results[file_index])
+
+            for line in handle:
+                row = line.rstrip('\n').split('\t')
+                evalue = float(row[3])
+                if scale != 1:
+                    evalue *= scale
+                    row[3] = repr(evalue)
+                if evalue < args.evalue_threshold:
+                    hits.append((query_rank[row[0]], evalue, row))
+
+    # the sort is stable, so equal e-values keep the database order
+    hits.sort(key=lambda hit: hit[:2])
+    with open(args.output_file, 'w') as out:
+        out.write(header or '')
+        for _, _, row in hits:
+            print(*row, sep='\t', file=out)
+
+
+if __name__ == '__main__':
+    main()
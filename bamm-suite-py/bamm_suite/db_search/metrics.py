@@ -0,0 +1,115 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import time
+
+# the counters of the queries that are summed up over the run
+TOTAL_KEYS = ('pairs', 'pruned', 'n_perm', 'hits', 'rechecked', 'tiles', 'null_s', 'scan_s')
+
+
+class SearchMetrics:
+
+    # Collects the wall time of the phases of a db_search run, the counters
+    # of every query as reported by the workers, and the busy time of every
+    # worker process. A query split into tiles reports the busy time of
+    # every worker that took part in worker_busy. The counters are summed
+    # up as the queries come in. The records of the single queries are only
+    # kept with keep_queries, a run over millions of queries would otherwise
+    # hold all of them until the end.
+
+    def __init__(self, keep_queries=True):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.keep_queries = keep_queries
+        self.queries = []
+        self.n_queries = 0
+        self.query_totals = dict.fromkeys(TOTAL_KEYS, 0)
+        self.worker_busy = defaultdict(float)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def add_query(self, stats):
+        self.n_queries += 1
+        for key in TOTAL_KEYS:
+            self.query_totals[key] += stats.get(key, 0)
+        if self.keep_queries:
+            self.queries.append(stats)
+        worker_busy = stats.get('worker_busy',
+                                {stats['worker']: stats['null_s'] + stats['scan_s']})
+        for worker, busy in worker_busy.items():
+            self.worker_busy[worker] += busy
+
+    def totals(self):
+        return dict(self.query_totals)
+
+    def summary(self, search_phase='search'):
+        totals = self.totals()
+        search_s = self.phases.get(search_phase, 0.0)
+
+        # idle time is the time a worker spent in the search phase without
+        # working on a query: waiting for jobs, pickling and the tail at the
+        # end of the run
+        workers = {
+            str(pid): {
+                'busy_s': busy,
+                'idle_s': max(search_s - busy, 0.0),
+                'utilization': busy / search_s if search_s else 0.0,
+            } for pid, busy in self.worker_busy.items()
+        }
+        return {
+            'wall_s': time.perf_counter() - self.start,
+            'phases_s': self.phases,
+            'n_queries': self.n_queries,
+            'totals': totals,
+            'pruning_ratio': totals['pruned'] / totals['pairs'] if totals['pairs'] else 0.0,
+            'pairs_per_s': (totals['pairs'] - totals['pruned']) / search_s if search_s else 0.0,
+            'workers': workers,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as out:
+            json.dump({'summary': self.summary(), 'queries': self.queries}, out, indent=4)
+
+
+class ProgressReporter:
+
+    # logs the number of finished queries with the throughput and an
+    # estimate of the remaining time, at most once every interval seconds
+
+    def __init__(self, logger, total, interval):
+        self.logger = logger
+        self.total = total
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.n_done = 0
+        self.n_pairs = 0
+
+    def update(self, n_pairs):
+        self.n_done += 1
+        self.n_pairs += n_pairs
+        now = time.perf_counter()
+        if now - self.last_report < self.interval and self.n_done < self.total:
+            return
+        self.last_report = now
+
+        elapsed = now - self.start
+        rate = self.n_done / elapsed if elapsed else 0.0
+        eta = (self.total - self.n_done) / rate if rate else float('inf')
+        self.logger.info('Progress %s/%s queries (%.1f%%), %.1f queries/s, %.0f pairs/s, ETA %s',
+                         self.n_done, self.total, 100.0 * self.n_done / max(self.total, 1),
+                         rate, self.n_pairs / elapsed if elapsed else 0.0, format_duration(eta))
+
+
+def format_duration(seconds):
+    if seconds == float('inf'):
+        return 'unknown'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
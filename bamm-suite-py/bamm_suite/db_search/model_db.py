@@ -0,0 +1,232 @@
+import argparse
+import json
+import logging
+
+import numpy as np
+
+from bamm_suite.db_search.utils import calculate_H_model, calculate_H_model_bg
+
+# Binary model database layout (all numbers little endian):
+#
+#   magic           8 bytes, BINARY_MAGIC
+#   header_length   uint64
+#   header          json with the format version, the number of models,
+#                   rows and the alphabet size and the byte offset, dtype
+#                   and shape of every section below
+#   ids             the model ids, utf-8 encoded and separated by newlines
+#   offsets         int64 (n_models + 1), model i owns the rows offsets[i]:offsets[i + 1]
+#   pwm             float64 (n_rows, alphabet_size)
+#   H_model_bg      float64 (n_rows)
+#   H_model         float64 (n_rows)
+#   bg_freq         float64 (n_models, alphabet_size)
+#
+# Sections start at multiples of SECTION_ALIGNMENT.
+
+BINARY_MAGIC = b'BAMMDB\x00\x01'
+BINARY_VERSION = 1
+SECTION_ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+
+def is_binary_db(path):
+    with open(path, 'rb') as handle:
+        return handle.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def write_binary_db(path, models):
+    models = list(models)
+    pwms = [np.asarray(model['pwm'], dtype='<f8') for model in models]
+    alphabet_size = pwms[0].shape[1] if pwms else 4
+
+    H_model_bg = []
+    H_model = []
+    for model, pwm in zip(models, pwms):
+        bg_freq = np.asarray(model['bg_freq'], dtype=float)
+        if 'H_model_bg' not in model or 'H_model' not in model:
+            H_model_bg.append(calculate_H_model_bg(pwm, bg_freq))
+            H_model.append(calculate_H_model(pwm))
+        else:
+            H_model_bg.append(np.asarray(model['H_model_bg'], dtype=float))
+            H_model.append(np.asarray(model['H_model'], dtype=float))
+
+    lengths = [len(pwm) for pwm in pwms]
+    offsets = np.zeros(len(models) + 1, dtype='<i8')
+    np.cumsum(lengths, out=offsets[1:])
+    n_rows = int(offsets[-1])
+
+    def concat(arrays, shape):
+        return np.concatenate(arrays).astype('<f8') if arrays else np.zeros(shape, dtype='<f8')
+
+    ids = '\n'.join(model['model_id'] for model in models).encode('utf-8')
+    sections = [
+        ('ids', np.frombuffer(ids, dtype=np.uint8)),
+        ('offsets', offsets),
+        ('pwm', concat(pwms, (0, alphabet_size))),
+        ('H_model_bg', concat(H_model_bg, 0)),
+        ('H_model', concat(H_model, 0)),
+        ('bg_freq', np.array([model['bg_freq'] for model in models], dtype='<f8')
+         .reshape(len(models), alphabet_size)),
+    ]
+
+    # the section offsets depend on the header length and vice versa, so we
+    # reserve enough room for the header first
+    def make_header(data_start):
+        layout = {}
+        position = data_start
+        for name, arr in sections:
+            position = _align(position)
+            layout[name] = {'offset': position, 'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+            position += arr.nbytes
+        return json.dumps({
+            'version': BINARY_VERSION,
+            'n_models': len(models),
+            'n_rows': n_rows,
+            'alphabet_size': alphabet_size,
+            'sections': layout,
+        }).encode('utf-8')
+
+    prefix_length = len(BINARY_MAGIC) + 8
+    header = make_header(0)
+    while True:
+        data_start = prefix_length + len(header)
+        new_header = make_header(data_start)
+        if len(new_header) == len(header):
+            header = new_header
+            break
+        header = new_header
+
+    with open(path, 'wb') as out:
+        out.write(BINARY_MAGIC)
+        out.write(np.uint64(len(header)).astype('<u8').tobytes())
+        out.write(header)
+        layout = json.loads(header.decode('utf-8'))['sections']
+        for name, arr in sections:
+            out.write(b'\x00' * (layout[name]['offset'] - out.tell()))
+            out.write(arr.tobytes())
+
+
+class BinaryModelDB:
+
+    # read-only view on a binary model database. The arrays are memory
+    # mapped, the per-model pwms and entropies are views into them.
+
+    def __init__(self, path):
+        with open(path, 'rb') as handle:
+            if handle.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError('%s is not a binary model database' % path)
+            header_length = int(np.frombuffer(handle.read(8), dtype='<u8')[0])
+            self.header = json.loads(handle.read(header_length).decode('utf-8'))
+
+        if self.header['version'] != BINARY_VERSION:
+            raise ValueError('unsupported binary model database version %s'
+                             % self.header['version'])
+
+        self.path = path
+        sections = {}
+        for name, section in self.header['sections'].items():
+            shape = tuple(section['shape'])
+            if np.prod(shape) == 0:
+                sections[name] = np.zeros(shape, dtype=section['dtype'])
+            else:
+                sections[name] = np.memmap(path, mode='r', dtype=section['dtype'],
+                                           offset=section['offset'], shape=shape)
+
+        ids = bytes(sections['ids']).decode('utf-8')
+        self.model_ids = ids.split('\n') if ids else []
+        self.offsets = sections['offsets']
+        self.pwm_rows = sections['pwm']
+        self.H_model_bg = sections['H_model_bg']
+        self.H_model = sections['H_model']
+        self.bg_freqs = sections['bg_freq']
+
+    def __len__(self):
+        return len(self.model_ids)
+
+    def __getitem__(self, index):
+        rows = slice(self.offsets[index], self.offsets[index + 1])
+        return {
+            'model_id': self.model_ids[index],
+            'pwm': self.pwm_rows[rows],
+            'bg_freq': self.bg_freqs[index],
+            'H_model_bg': self.H_model_bg[rows],
+            'H_model': self.H_model[rows],
+        }
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def load_models(path):
+    # returns a list of model dicts, from either a json or a binary model database
+    if is_binary_db(path):
+        return list(BinaryModelDB(path))
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def update_models(models, min_overlap):
+    logger = logging.getLogger()
+    upd_models = []
+    for model in models:
+        # asarray keeps the memory mapped arrays of a binary database
+        model['pwm'] = np.asarray(model['pwm'], dtype=float)
+        model_length, _ = model['pwm'].shape
+        if model_length < min_overlap:
+            logger.warn('model %s with length %s too small for the chosen min_overlap (%s).'
+                        ' Please consider lowering the min_overlap threshold.',
+                        model['model_id'], model_length, min_overlap)
+            continue
+        model['bg_freq'] = np.asarray(model['bg_freq'], dtype=float)
+        if 'H_model_bg' not in model or 'H_model' not in model:
+            model['H_model_bg'] = calculate_H_model_bg(model['pwm'], model['bg_freq'])
+            model['H_model'] = calculate_H_model(model['pwm'])
+        else:
+            model['H_model_bg'] = np.asarray(model['H_model_bg'], dtype=float)
+            model['H_model'] = np.asarray(model['H_model'], dtype=float)
+        upd_models.append(model)
+    return upd_models
+
+
+def write_json_db(path, models):
+    json_models = []
+    for model in models:
+        json_model = {}
+        for key, value in model.items():
+            json_model[key] = value.tolist() if isinstance(value, np.ndarray) else value
+        json_models.append(json_model)
+
+    with open(path, 'w') as out_db:
+        json.dump(json_models, out_db, indent=4, separators=(',', ': '), sort_keys=True)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='convert a model database between the json and the binary format'
+    )
+    parser.add_argument('in_db')
+    parser.add_argument('out_db')
+    parser.add_argument('--to', choices=['binary', 'json'],
+                        help='output format, defaults to the opposite of the input format')
+    return parser
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    in_binary = is_binary_db(args.in_db)
+    models = load_models(args.in_db)
+    out_format = args.to or ('json' if in_binary else 'binary')
+
+    if out_format == 'binary':
+        write_binary_db(args.out_db, models)
+    else:
+        write_json_db(args.out_db, models)
+
+
+if __name__ == '__main__':
+    main()
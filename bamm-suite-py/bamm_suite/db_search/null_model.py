@@ -0,0 +1,179 @@
+import argparse
+from multiprocessing import Pool
+import json
+import logging
+import sys
+
+import numpy as np
+
+from bamm_suite.db_search.utils import calculate_H_model_bg, calculate_H_model, create_permutations
+from bamm_suite.db_search.utils import fit_exp_tail
+from bamm_suite.db_search.packed_db import PackedModelDB
+from bamm_suite.db_search.model_db import load_models
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='fit the null distribution of db_search once per model database'
+    )
+    parser.add_argument('model_db')
+    parser.add_argument('--output_file',
+                        help='defaults to the model database with a .null.json suffix')
+    parser.add_argument('--n_samples', type=int, default=500,
+                        help='number of database models used as calibration queries')
+    parser.add_argument('--n_neg_perm', type=int, default=10)
+    parser.add_argument('--highscore_fraction', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--min_overlap', type=int, default=4)
+    parser.add_argument('--length_bin_width', type=int, default=2)
+    parser.add_argument('--n_processes', type=int)
+    return parser
+
+
+def default_null_model_path(model_db):
+    return model_db + '.null.json'
+
+
+def information_content(H_model_bg):
+    return float(np.sum(H_model_bg))
+
+
+class NullModel:
+
+    # Tail parameters of the permutation null as a function of the query
+    # length and information content. For every length bin, high_score and
+    # log(lambda) are fitted linearly in the information content. Queries
+    # in between bins are interpolated linearly, queries outside the
+    # calibrated range use the nearest bin.
+
+    def __init__(self, bin_lengths, coefficients, params, db_checksum):
+        self.bin_lengths = np.asarray(bin_lengths, dtype=float)
+        # shape (n_bins, 2, 2): bin, [high_score, log_lambda], [intercept, slope]
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.params = params
+        self.db_checksum = db_checksum
+
+    @classmethod
+    def fit(cls, lengths, ics, high_scores, exp_lambdas, params, db_checksum,
+            length_bin_width=2, min_bin_size=3):
+        lengths = np.asarray(lengths)
+        ics = np.asarray(ics)
+        targets = np.column_stack([high_scores, np.log(exp_lambdas)])
+
+        bin_ids = lengths // length_bin_width
+        bin_lengths = []
+        coefficients = []
+        for bin_id in np.unique(bin_ids):
+            in_bin = bin_ids == bin_id
+            if in_bin.sum() < min_bin_size:
+                continue
+            bin_ics = ics[in_bin]
+            if np.ptp(bin_ics) > 0:
+                design = np.column_stack([np.ones(len(bin_ics)), bin_ics])
+                coefs, *_ = np.linalg.lstsq(design, targets[in_bin], rcond=None)
+                coefs = coefs.T
+            else:
+                coefs = np.column_stack([targets[in_bin].mean(axis=0), np.zeros(2)])
+            bin_lengths.append(lengths[in_bin].mean())
+            coefficients.append(coefs)
+
+        if not bin_lengths:
+            raise ValueError('not enough calibration queries to fit the null model')
+        return cls(bin_lengths, coefficients, params, db_checksum)
+
+    def predict(self, length, ic):
+        per_bin = self.coefficients[:, :, 0] + self.coefficients[:, :, 1] * ic
+        high_score = np.interp(length, self.bin_lengths, per_bin[:, 0])
+        log_lambda = np.interp(length, self.bin_lengths, per_bin[:, 1])
+        return high_score, np.exp(log_lambda)
+
+    def save(self, path):
+        with open(path, 'w') as out:
+            json.dump({
+                'bin_lengths': self.bin_lengths.tolist(),
+                'coefficients': self.coefficients.tolist(),
+                'params': self.params,
+                'db_checksum': self.db_checksum,
+            }, out, indent=4, separators=(',', ': '), sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as handle:
+            data = json.load(handle)
+        return cls(data['bin_lengths'], data['coefficients'], data['params'], data['db_checksum'])
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger_fmt = '%(asctime)s [%(levelname)s]  %(message)s'
+    formatter = logging.Formatter(logger_fmt)
+    console_handler = logging.StreamHandler(stream=sys.stdout)
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+
+    models = [model for model in load_models(args.model_db)
+              if len(model['pwm']) >= args.min_overlap]
+    for model in models:
+        model['pwm'] = np.asarray(model['pwm'], dtype=float)
+        model['bg_freq'] = np.asarray(model['bg_freq'], dtype=float)
+        model['H_model_bg'] = calculate_H_model_bg(model['pwm'], model['bg_freq'])
+        model['H_model'] = calculate_H_model(model['pwm'])
+    db_models = PackedModelDB(models)
+
+    random_state = np.random.RandomState(args.seed)
+    n_samples = min(args.n_samples, len(models))
+    samples = random_state.choice(len(models), n_samples, replace=False)
+
+    def init_workers():
+        global db_models_g
+        db_models_g = db_models
+        global n_neg_perm_g
+        n_neg_perm_g = args.n_neg_perm
+        global highscore_fraction_g
+        highscore_fraction_g = args.highscore_fraction
+        global min_overlap_g
+        min_overlap_g = args.min_overlap
+
+    logger.info('Calibrating the null model with %s queries', n_samples)
+
+    # every calibration query gets its own seed, so that the fit does not
+    # depend on the number of processes
+    seeds = random_state.randint(0, 2 ** 31, n_samples)
+    with Pool(args.n_processes, initializer=init_workers) as pool:
+        fits = pool.starmap(calibrate_query, [(models[i], seed) for i, seed in zip(samples, seeds)])
+
+    high_scores, exp_lambdas = np.array(fits).T
+    lengths = [len(models[i]['pwm']) for i in samples]
+    ics = [information_content(models[i]['H_model_bg']) for i in samples]
+
+    params = {
+        'n_neg_perm': args.n_neg_perm,
+        'highscore_fraction': args.highscore_fraction,
+        'min_overlap': args.min_overlap,
+    }
+    null_model = NullModel.fit(lengths, ics, high_scores, exp_lambdas, params,
+                               db_models.checksum(), length_bin_width=args.length_bin_width)
+
+    output_file = args.output_file or default_null_model_path(args.model_db)
+    null_model.save(output_file)
+    logger.info('Wrote null model with %s length bins to %s',
+                len(null_model.bin_lengths), output_file)
+
+
+def calibrate_query(model, seed):
+    pwm = model['pwm']
+    shuffle_ind = create_permutations(len(pwm), n_neg_perm_g, np.random.RandomState(seed))
+    shuffle_pwms = pwm[shuffle_ind]
+    H_shuffle_bg = calculate_H_model_bg(shuffle_pwms, model['bg_freq'])
+    H_shuffle = calculate_H_model(shuffle_pwms)
+    shuffled_dists = db_models_g.score_batch(shuffle_pwms, H_shuffle_bg, H_shuffle,
+                                             min_overlap=min_overlap_g)
+    return fit_exp_tail(np.sort(shuffled_dists, axis=None), highscore_fraction_g)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+import logging
+from multiprocessing import Pool, shared_memory
+import os
+import resource
+import sys
+
+import numpy as np
+
+from bamm_suite.db_search.packed_db import PackedModelDB
+from bamm_suite.db_search.search_index import read_index_header
+from bamm_suite.db_search.searcher import MotifSearcher
+
+# Estimates for the memory budget, in bytes. Scoring keeps a few arrays of
+# max_block_elements float64 values alive (KERNEL_BYTES_PER_ELEMENT), every
+# worker process needs its interpreter on top (PROCESS_BYTES) and every
+# database model a model dict next to its rows (MODEL_BYTES).
+KERNEL_BYTES_PER_ELEMENT = 24
+PROCESS_BYTES = 48 << 20
+MODEL_BYTES = 1024
+# share of the budget for the running per-query state (the permutation
+# tails and the hits), the rest is for the database blocks
+QUERY_STATE_SHARE = 0.25
+# models of the first block used to measure the size of a packed block
+SAMPLE_MODELS = 1000
+
+
+def current_rss():
+    # resident set size of this process in bytes, or its peak (see below)
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # without /proc, this is the peak resident set size instead. It bounds
+        # the current one from above, so the memory plan errs on the safe
+        # side. ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+class IndexBlockReader:
+
+    # Reads blocks of consecutive models from a search index with plain file
+    # reads, the index is never mapped or loaded as a whole. Only the model
+    # ids and the row offsets of all models are held in memory.
+
+    def __init__(self, path):
+        header, self.data_start = read_index_header(path)
+        handle = header['db']
+        self.path = path
+        self.min_overlap = header['min_overlap']
+        self.model_ids = handle['model_ids']
+        self.bucket_width = handle['bucket_width']
+        self.checksum = handle['checksum']
+        self.arrays = {key[0]: (offset, np.dtype(dtype), shape)
+                       for key, offset, dtype, shape in handle['layout'] if len(key) == 1}
+        self.offsets = self._read('offsets', 0, len(self.model_ids) + 1)
+
+    def __len__(self):
+        return len(self.model_ids)
+
+    def _read(self, name, start, end):
+        # rows start:end of one of the arrays of the packed database
+        offset, dtype, shape = self.arrays[name]
+        row_items = int(np.prod(shape[1:], dtype=int))
+        with open(self.path, 'rb') as handle:
+            handle.seek(self.data_start + offset + start * row_items * dtype.itemsize)
+            arr = np.fromfile(handle, dtype=dtype, count=(end - start) * row_items)
+        return arr.reshape((end - start,) + tuple(shape[1:]))
+
+    def read_models(self, start, end):
+        # the prepared model dicts of the models start:end
+        first_row = self.offsets[start]
+        last_row = self.offsets[end]
+        pwm_rows = self._read('pwm_rows', first_row, last_row)
+        H_model_bg = self._read('H_model_bg', first_row, last_row)
+        H_model = self._read('H_model', first_row, last_row)
+        bg_freqs = self._read('bg_freqs', start, end)
+
+        models = []
+        for index in range(start, end):
+            rows = slice(self.offsets[index] - first_row, self.offsets[index + 1] - first_row)
+            models.append({
+                'model_id': self.model_ids[index],
+                'pwm': pwm_rows[rows],
+                'bg_freq': bg_freqs[index - start],
+                'H_model_bg': H_model_bg[rows],
+                'H_model': H_model[rows],
+            })
+        return models
+
+    def read_block(self, start, end, precision='float64'):
+        return PackedModelDB(self.read_models(start, end), bucket_width=self.bucket_width,
+                             dtype=precision)
+
+    def split(self, max_rows):
+
+        # consecutive blocks of at most max_rows pwm rows, or a single model
+        # if it is longer
+        bounds = [0]
+        while bounds[-1] < len(self):
+            start = bounds[-1]
+            end = int(np.searchsorted(self.offsets, self.offsets[start] + max_rows, side='right')) - 1
+            bounds.append(min(max(end, start + 1), len(self)))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+def plan_memory(reader, memory_budget, n_processes, n_queries, tail_size, n_null_strands,
+                precision='float64'):
+
+    # the number of pwm rows per database block and of queries per batch
+    # that keep the search within memory_budget bytes. The budget counts
+    # memory shared between processes, like the database block, only once.
+    sample = reader.read_block(0, min(SAMPLE_MODELS, len(reader)), precision)
+    sample_rows = max(len(sample.pwm_rows), 1)
+    _, sample_bytes = sample.layout()
+    # the packed block, the rows it was built from and, with a pool, its
+    # copy in shared memory
+    row_bytes = (2 * sample_bytes + MODEL_BYTES * len(sample)) / sample_rows \
+        + 6 * sample.pwm_rows.itemsize
+
+    # a single process scores in this one, without a pool
+    n_workers = max(n_processes, 1)
+    n_pool_processes = n_processes if n_processes > 1 else 0
+    fixed = current_rss() + n_pool_processes * PROCESS_BYTES \
+        + n_workers * KERNEL_BYTES_PER_ELEMENT * sample.max_block_elements
+    available = memory_budget - fixed
+    max_model_rows = int(np.diff(reader.offsets).max(initial=0))
+    if available * (1 - QUERY_STATE_SHARE) < max_model_rows * row_bytes:
+        raise ValueError('a memory budget of %.0fMB is too small, this process and the scoring '
+                         'of %s workers already need about %.0fMB'
+                         % (memory_budget / 2 ** 20, n_workers, fixed / 2 ** 20))
+
+    # every query holds the running permutation tails of its null strands
+    # and the merge of the tail of a new block
+    query_bytes = 2 * n_null_strands * tail_size * 8 + 1
+    batch_size = int(max(1, min(n_queries, available * QUERY_STATE_SHARE // query_bytes)))
+    max_rows = int(available * (1 - QUERY_STATE_SHARE) // row_bytes)
+    return max_rows, batch_size
+
+
+def out_of_core_search(reader, models, memory_budget, n_processes=0, precision='float64',
+                       **params):
+
+    # Searches the queries against a search index that does not fit into
+    # memory, and yields the motif_search result of every query in input
+    # order, as a search of the whole database would.
+    #
+    # The queries are searched in batches. For every batch, the database is
+    # read block by block and all queries of the batch are scored against a
+    # block before the next is read:
+    #   1. the permutations of the queries whose null is not stored,
+    #      precomputed or cached. Only the running tail of the permutation
+    #      scores is kept per query, see MotifSearcher.permutation_tail.
+    #      The nulls are fitted from it after the last block.
+    #   2. both strands of the queries with the fitted nulls. The hits are
+    #      collected per query, with top_k only the best top_k so far.
+    # Block and batch sizes follow from memory_budget (see plan_memory).
+    # A pool of n_processes workers (0 for one per cpu) scores the queries
+    # of a block in parallel, see BlockScanner.
+    logger = logging.getLogger()
+    params = dict(params, db_size=params.get('db_size') or len(reader),
+                  db_checksum=params.get('db_checksum') or reader.checksum)
+    n_processes = n_processes or os.cpu_count()
+
+    # scores nothing itself, but decides which nulls are known and fits the
+    # nulls from the tails of all blocks
+    first_block = reader.read_block(0, min(1, len(reader)), precision)
+    searcher = MotifSearcher(first_block, null_db_size=len(reader), **params)
+    if searcher.adaptive_perm is not None and searcher.stored_nulls is None \
+            and searcher.null_model is None:
+        raise ValueError('adaptive null fits need all database models at once and cannot be '
+                         'combined with an out-of-core search')
+
+    max_rows, batch_size = plan_memory(reader, memory_budget, n_processes, len(models),
+                                       searcher.null_tail_size(), searcher.n_null_strands(),
+                                       precision)
+    blocks = reader.split(max_rows)
+    logger.info('Scanning %s models in %s blocks of at most %s pwm rows, %s queries per batch',
+                len(reader), len(blocks), max_rows, batch_size)
+
+    with BlockScanner(reader, precision, n_processes,
+                      dict(params, null_db_size=len(reader))) as scanner:
+        yield from _search_batches(models, blocks, batch_size, searcher, scanner)
+
+
+def _search_batches(models, blocks, batch_size, searcher, scanner):
+    for batch_start in range(0, len(models), batch_size):
+        batch = models[batch_start:batch_start + batch_size]
+        states = [new_query_state(searcher, model) for model in batch]
+        to_fit = [state for state in states if state['nulls'] is None]
+
+        if to_fit:
+            for start, end in blocks:
+                for state, (tails, seconds, worker) in zip(
+                        to_fit, scanner.map(start, end, 'map_permutation_tails',
+                                            [s['model'] for s in to_fit])):
+                    state['tails'] = [merge_tail(old, new, searcher.null_tail_size())
+                                      for old, new in zip(state['tails'], tails)]
+                    add_work(state, worker, seconds, 'null_s')
+            for state in to_fit:
+                state['nulls'] = searcher.fit_strand_nulls_from_tails(
+                    state['model'], [[tail] for tail in state['tails']])
+                state['n_perm'] = searcher.expected_n_perm()
+                del state['tails']
+
+        for start, end in blocks:
+            results = scanner.map(start, end, 'map_scan', [state['model'] for state in states],
+                                  [state['nulls'] for state in states])
+            for state, (strand_hits, n_pairs, n_scored, n_rechecked, seconds, worker) in zip(
+                    states, results):
+                for merged, hits in zip(state['strand_hits'], strand_hits):
+                    merged.extend((start + db_index, hit) for db_index, hit in hits)
+                if searcher.top_k:
+                    state['strand_hits'] = keep_top_k(state['strand_hits'], searcher.top_k)
+                state['pairs'] += n_pairs
+                state['scored'] += n_scored
+                state['rechecked'] += n_rechecked
+                add_work(state, worker, seconds, 'scan_s')
+
+        for state in states:
+            yield query_result(searcher, state)
+
+
+class BlockScanner:
+
+    # Runs the mapping methods of MotifSearcher (map_permutation_tails,
+    # map_scan) on one block of the index after the other. With more than one
+    # process, a pool is started once for the whole search. Every block is
+    # copied into the same shared memory buffer, which only grows when a
+    # block does not fit, and the workers attach a searcher of their own to
+    # it whenever a new block was written. A mapping call returns once all
+    # workers are done with the block, so the buffer is free again for the
+    # next one.
+
+    def __init__(self, reader, precision, n_processes, params):
+        self.reader = reader
+        self.precision = precision
+        self.params = params
+        self.n_processes = n_processes
+        self.pool = None
+        self.shm = None
+        self.generation = 0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def map(self, start, end, method, *args):
+
+        # the results of the mapping method on the block start:end, for the
+        # lists of per query arguments in args. Only the shared copy of the
+        # block lives while the workers score it.
+        block = self.reader.read_block(start, end, self.precision)
+        if self.n_processes <= 1:
+            return getattr(MotifSearcher(block, **self.params), method)(*args)
+
+        handle = self._write_block(block)
+        del block
+        if self.pool is None:
+            # started after the first buffer was created, so that the workers
+            # share the resource tracker that owns it
+            self.pool = Pool(self.n_processes, initializer=_init_block_worker,
+                             initargs=(self.params,))
+        # a few chunks per worker, so that the handle is sent a few times per
+        # block and not once per query
+        n_chunks = min(len(args[0]), 4 * self.n_processes)
+        bounds = np.linspace(0, len(args[0]), n_chunks + 1).astype(int)
+        jobs = [(handle, method) + tuple(arg[chunk_start:chunk_end] for arg in args)
+                for chunk_start, chunk_end in zip(bounds[:-1], bounds[1:])]
+        return [result for chunk in self.pool.starmap(_worker_map_block, jobs)
+                for result in chunk]
+
+    def _write_block(self, block):
+        handle, size = block.layout()
+        if self.shm is None or self.shm.size < size:
+            if self.shm is not None:
+                self.shm.close()
+                self.shm.unlink()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        block.write_to_buffer(handle, self.shm.buf)
+        self.generation += 1
+        handle['name'] = self.shm.name
+        handle['generation'] = self.generation
+        return handle
+
+
+def new_query_state(searcher, model):
+    return {
+        'model': model,
+        'nulls': searcher.known_strand_nulls(model),
+        'tails': [np.zeros(0) for _ in range(searcher.n_null_strands())],
+        'n_perm': 0,
+        'strand_hits': [[], []],
+        'pairs': 0, 'scored': 0, 'rechecked': 0, 'tiles': 0,
+        'worker_busy': {}, 'null_s': 0.0, 'scan_s': 0.0,
+    }
+
+
+def add_work(state, worker, seconds, phase):
+    state['worker_busy'][worker] = state['worker_busy'].get(worker, 0.0) + seconds
+    state['tiles'] += 1
+    state[phase] += seconds
+
+
+def merge_tail(tail, block_tail, tail_size):
+    # the tail_size largest values of both tails, unsorted
+    merged = np.concatenate([tail, block_tail])
+    if tail_size == 0 or len(merged) <= tail_size:
+        return merged
+    return np.partition(merged, len(merged) - tail_size)[-tail_size:]
+
+
+def keep_top_k(strand_hits, top_k):
+
+    # the top_k hits of both strands with the lowest e-values, ties broken
+    # by strand and database order like in MotifSearcher.top_k_search
+    ranked = sorted((hit[3], strand, db_index, hit)
+                    for strand, hits in enumerate(strand_hits) for db_index, hit in hits)
+    kept = [[] for _ in strand_hits]
+    for _, strand, db_index, hit in ranked[:top_k]:
+        kept[strand].append((db_index, hit))
+    return [sorted(hits, key=lambda item: item[0]) for hits in kept]
+
+
+def query_result(searcher, state):
+    model = state['model']
+    stats = searcher.query_stats(model, state['nulls'], state['n_perm'], state['strand_hits'])
+    worker_busy = state['worker_busy']
+    stats.update({
+        'worker': max(worker_busy, key=worker_busy.get) if worker_busy else os.getpid(),
+        'worker_busy': worker_busy,
+        'tiles': state['tiles'],
+        'pairs': state['pairs'],
+        'pruned': state['pairs'] - state['scored'],
+        'rechecked': state['rechecked'],
+        'null_s': state['null_s'],
+        'scan_s': state['scan_s'],
+    })
+    return [[hit for _, hit in hits] for hits in state['strand_hits']], stats
+
+
+# the parameters of the block searchers of a pool worker, and the
+# (generation, attached buffer, searcher) of the block it last worked on
+block_params_g = None
+block_g = None
+
+
+def _init_block_worker(params):
+    global block_params_g
+    block_params_g = params
+
+
+def _block_searcher(handle):
+
+    # the searcher of the block described by handle, attached to the shared
+    # buffer. The searcher of the previous block has to be gone before its
+    # buffer can be closed.
+    global block_g
+    if block_g is not None and block_g[0] == handle['generation']:
+        return block_g[2]
+    shm = block_g[1] if block_g is not None else None
+    block_g = None
+    if shm is not None and shm.name != handle['name']:
+        shm.close()
+        shm = None
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=handle['name'])
+    searcher = MotifSearcher(PackedModelDB.from_buffer(handle, shm.buf), **block_params_g)
+    block_g = (handle['generation'], shm, searcher)
+    return searcher
+
+
+def _worker_map_block(handle, method, *args):
+    return getattr(_block_searcher(handle), method)(*args)
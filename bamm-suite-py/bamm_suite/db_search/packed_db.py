@@ -0,0 +1,441 @@
+import copy
+import hashlib
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy.special import xlogy
+
+from bamm_suite.db_search.utils import loge2, TIE_TOLERANCE
+
+BOUND_SLACK = 1e-9
+SHARED_ALIGNMENT = 64
+
+DB_ARRAYS = ('lengths', 'offsets', 'pwm_rows', 'H_model_bg', 'H_model', 'bg_freqs',
+             'max_H_bg', 'window_H_bg', 'window_sqrt_H_bg')
+BUCKET_ARRAYS = ('indices', 'lengths', 'pwm', 'cum_H_model_bg', 'cum_H_model')
+
+
+class PackedModelDB:
+
+    # The model database packed into contiguous arrays. All pwm rows are
+    # concatenated, model i owns the rows offsets[i]:offsets[i + 1].
+    # For scoring, models are grouped into buckets of similar length that
+    # are zero-padded to a common length, so that one query can be scored
+    # against a whole bucket with a few array operations.
+    # dtype is the precision of the padded pwms and thereby of the pairwise
+    # cross entropies, the bulk of the scoring work. The concatenated rows,
+    # the entropies and their prefix sums and the sums over the alignments
+    # stay in float64.
+
+    def __init__(self, models, bucket_width=4, max_block_elements=1 << 21, dtype=float):
+        self.model_ids = [model['model_id'] for model in models]
+        self.lengths = np.array([len(model['pwm']) for model in models], dtype=int)
+        self.offsets = np.zeros(len(models) + 1, dtype=int)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+
+        if models:
+            self.pwm_rows = np.concatenate([model['pwm'] for model in models])
+            self.H_model_bg = np.concatenate([model['H_model_bg'] for model in models])
+            self.H_model = np.concatenate([model['H_model'] for model in models])
+            self.bg_freqs = np.vstack([model['bg_freq'] for model in models])
+        else:
+            self.pwm_rows = np.zeros((0, 4))
+            self.H_model_bg = np.zeros(0)
+            self.H_model = np.zeros(0)
+            self.bg_freqs = np.zeros((0, 4))
+
+        self.bucket_width = bucket_width
+        self.max_block_elements = max_block_elements
+        self.dtype = np.dtype(dtype)
+        self.buckets = self._create_buckets()
+        self._create_bounds()
+
+    def __len__(self):
+        return len(self.model_ids)
+
+    def model(self, index):
+        # the model dict of a database entry, with views into the packed arrays
+        rows = slice(self.offsets[index], self.offsets[index + 1])
+        return {
+            'model_id': self.model_ids[index],
+            'pwm': self.pwm_rows[rows],
+            'bg_freq': self.bg_freqs[index],
+            'H_model_bg': self.H_model_bg[rows],
+            'H_model': self.H_model[rows],
+        }
+
+    def _arrays(self):
+        for name in DB_ARRAYS:
+            yield (name,), getattr(self, name)
+        for bucket_index, bucket in enumerate(self.buckets):
+            for name in BUCKET_ARRAYS:
+                yield (bucket_index, name), bucket[name]
+
+    def layout(self):
+
+        # the placement of all arrays in one flat buffer, with a small
+        # picklable description from which from_buffer restores the database
+        layout = []
+        size = 0
+        for key, arr in self._arrays():
+            size = -(-size // SHARED_ALIGNMENT) * SHARED_ALIGNMENT
+            layout.append((key, size, arr.dtype.str, arr.shape))
+            size += arr.nbytes
+
+        handle = {
+            'layout': layout,
+            'model_ids': self.model_ids,
+            'bucket_lengths': [int(bucket['length']) for bucket in self.buckets],
+            'bucket_width': self.bucket_width,
+            'max_block_elements': self.max_block_elements,
+            'dtype': self.dtype.str,
+            # only passed on if it was computed already
+            'checksum': getattr(self, '_checksum', None),
+        }
+        return handle, size
+
+    def write_to_buffer(self, handle, buffer):
+        for (_, arr), (_, offset, dtype, shape) in zip(self._arrays(), handle['layout']):
+            np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)[...] = arr
+
+    def to_shared_memory(self):
+
+        # copies all arrays into one shared memory block. The returned handle
+        # is small and picklable, processes attach to the block with
+        # from_shared_memory. The caller owns the block and has to unlink it.
+        handle, size = self.layout()
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.write_to_buffer(handle, shm.buf)
+        handle['name'] = shm.name
+        return shm, handle
+
+    @classmethod
+    def from_shared_memory(cls, handle):
+
+        # a read-only database whose arrays are views into the shared block
+        shm = shared_memory.SharedMemory(name=handle['name'])
+        db = cls.from_buffer(handle, shm.buf)
+        db._shm = shm
+        return db
+
+    @classmethod
+    def from_buffer(cls, handle, buffer):
+
+        # a read-only database whose arrays are views into buffer, laid out
+        # as described by handle
+        db = cls.__new__(cls)
+        db.model_ids = handle['model_ids']
+        db.bucket_width = handle['bucket_width']
+        db.max_block_elements = handle['max_block_elements']
+        db.dtype = np.dtype(handle.get('dtype', '<f8'))
+        db.buckets = [{'length': length} for length in handle['bucket_lengths']]
+        db._checksum = handle['checksum']
+
+        for key, offset, dtype, shape in handle['layout']:
+            arr = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+            arr.flags.writeable = False
+            if len(key) == 1:
+                setattr(db, key[0], arr)
+            else:
+                bucket_index, name = key
+                db.buckets[bucket_index][name] = arr
+        return db
+
+    def astype(self, dtype):
+
+        # the database with the padded pwms in another precision, all other
+        # arrays are shared
+        if np.dtype(dtype) == self.dtype:
+            return self
+        db = copy.copy(self)
+        db.dtype = np.dtype(dtype)
+        db.buckets = [dict(bucket, pwm=bucket['pwm'].astype(dtype)) for bucket in self.buckets]
+        return db
+
+    def checksum(self):
+        # identifies the database content, independent of the file it was loaded from
+        if getattr(self, '_checksum', None) is None:
+            sha = hashlib.sha1()
+            sha.update('\n'.join(self.model_ids).encode())
+            for arr in (self.lengths, self.pwm_rows, self.H_model_bg, self.H_model, self.bg_freqs):
+                sha.update(np.ascontiguousarray(arr).tobytes())
+            self._checksum = sha.hexdigest()
+        return self._checksum
+
+    def _create_bounds(self):
+
+        # per model quantities for upper_bounds: the largest H_model_bg
+        # column and the best window sums of H_model_bg and its square root
+        # for every window length
+        max_len = self.lengths.max() if len(self) else 0
+        row_model = np.repeat(np.arange(len(self)), self.lengths)
+        row_pos = np.arange(len(self.H_model_bg)) - np.repeat(self.offsets[:-1], self.lengths)
+        H_bg = np.zeros((len(self), max_len))
+        H_bg[row_model, row_pos] = np.maximum(self.H_model_bg, 0)
+
+        self.max_H_bg = H_bg.max(axis=1, initial=0)
+        self.window_H_bg = max_window_sums(H_bg)
+        self.window_sqrt_H_bg = max_window_sums(np.sqrt(H_bg))
+
+    def upper_bounds(self, H_model_bg, bg_freq):
+
+        # provable upper bound of the similarity of a query with every
+        # database model. Per aligned column pair the score is
+        #     JS(q, bg) + JS(d, bg) - JS(q, d),
+        # which is at most JS(q, bg) + JS(d, bg), since JS(q, d) >= 0. With a
+        # common background, sqrt(JS) is a metric and the triangle
+        # inequality gives the tighter bound 2 sqrt(JS(q, bg) JS(d, bg)).
+        # Both are summed up over the best window of the overlap length.
+        # H_model_bg has to be measured against bg_freq. For the reverse
+        # strand of a query, whose entropies are the reversed forward ones,
+        # that is the reverse complemented background (see
+        # MotifSearcher.strand_upper_bounds).
+        query_H_bg = np.maximum(H_model_bg, 0)[np.newaxis]
+        query_window = max_window_sums(query_H_bg)[0]
+        query_sqrt_window = max_window_sums(np.sqrt(query_H_bg))[0]
+
+        overlap = np.minimum(len(H_model_bg), self.lengths)
+        model_index = np.arange(len(self))
+        bounds = query_window[overlap] + self.window_H_bg[model_index, overlap]
+
+        same_bg = np.all(np.abs(self.bg_freqs - bg_freq) <= 1e-12, axis=1)
+        metric_bounds = np.minimum(
+            2 * np.sqrt(self.max_H_bg) * query_sqrt_window[overlap],
+            2 * np.sqrt(query_H_bg.max()) * self.window_sqrt_H_bg[model_index, overlap]
+        )
+        bounds = np.where(same_bg, np.minimum(bounds, metric_bounds), bounds)
+
+        # the exact scores are sums in a different order
+        return bounds + BOUND_SLACK * np.maximum(np.abs(bounds), 1)
+
+    def _create_buckets(self):
+        buckets = []
+        padded_lengths = -(-self.lengths // self.bucket_width) * self.bucket_width
+        for bucket_length in np.unique(padded_lengths):
+            indices = np.flatnonzero(padded_lengths == bucket_length)
+            buckets.append(self._pad_models(indices, bucket_length))
+        return buckets
+
+    def _pad_models(self, indices, bucket_length):
+        n_models = len(indices)
+        alphabet_size = self.pwm_rows.shape[1]
+        lengths = self.lengths[indices]
+
+        pwm = np.zeros((n_models, bucket_length, alphabet_size), dtype=self.dtype)
+        H_model_bg = np.zeros((n_models, bucket_length), dtype=self.H_model_bg.dtype)
+        H_model = np.zeros((n_models, bucket_length), dtype=self.H_model.dtype)
+
+        # scatter the concatenated rows into the padded arrays
+        row_model = np.repeat(np.arange(n_models), lengths)
+        row_pos = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = np.repeat(self.offsets[indices], lengths) + row_pos
+        pwm[row_model, row_pos] = self.pwm_rows[rows]
+        H_model_bg[row_model, row_pos] = self.H_model_bg[rows]
+        H_model[row_model, row_pos] = self.H_model[rows]
+
+        # prefix sums are taken per model so that slice sums do not depend on
+        # the other models in the database
+        cum_H_bg = np.zeros((n_models, bucket_length + 1), dtype=H_model_bg.dtype)
+        np.cumsum(H_model_bg, axis=1, out=cum_H_bg[:, 1:])
+        cum_H = np.zeros((n_models, bucket_length + 1), dtype=H_model.dtype)
+        np.cumsum(H_model, axis=1, out=cum_H[:, 1:])
+
+        return {
+            'indices': indices,
+            'length': bucket_length,
+            'lengths': lengths,
+            'pwm': pwm,
+            'cum_H_model_bg': cum_H_bg,
+            'cum_H_model': cum_H,
+        }
+
+    def score(self, pwm, H_model_bg, H_model, min_overlap=2, subset=None):
+
+        # scores a query against every model of the database. The return
+        # value mirrors model_sim, but with arrays in database order.
+        # A stack of queries of the same length (e.g. both strands of a
+        # query) is scored in one pass, the arrays then get a leading
+        # query axis. If a boolean subset mask is given, only those database
+        # models are scored, the others keep a score of -inf.
+        single = pwm.ndim == 2
+        if single:
+            pwm, H_model_bg, H_model = pwm[np.newaxis], H_model_bg[np.newaxis], H_model[np.newaxis]
+
+        shape = (len(pwm), len(self))
+        scores = np.full(shape, -np.inf)
+        starts_query = np.zeros(shape, dtype=int)
+        ends_query = np.zeros(shape, dtype=int)
+        starts_hit = np.zeros(shape, dtype=int)
+        ends_hit = np.zeros(shape, dtype=int)
+        bg_scores = np.zeros(shape)
+        cross_scores = np.zeros(shape)
+
+        for indices, block_result in self._score_blocks(pwm, H_model_bg, H_model, min_overlap,
+                                                        _score_block, subset):
+            (scores[:, indices], (starts_query[:, indices], ends_query[:, indices]),
+             (starts_hit[:, indices], ends_hit[:, indices]),
+             (bg_scores[:, indices], cross_scores[:, indices])) = block_result
+
+        result = scores, (starts_query, ends_query), (starts_hit, ends_hit), (bg_scores, cross_scores)
+        if single:
+            result = map_arrays(lambda arr: arr[0], result)
+        return result
+
+    def score_batch(self, pwms, H_model_bg, H_model, min_overlap=2, subset=None):
+
+        # scores a stack of queries of the same length (e.g. the permutations
+        # of one pwm) against every model of the database, or the models in
+        # the boolean subset mask. Only the best scores are returned, as an
+        # array of shape (n_queries, n_models).
+        scores = np.full((len(pwms), len(self)), -np.inf)
+        for indices, block_scores in self._score_blocks(pwms, H_model_bg, H_model, min_overlap,
+                                                        _score_batch_block, subset):
+            scores[:, indices] = block_scores
+        return scores
+
+    def _score_blocks(self, pwms, H_model_bg, H_model, min_overlap, score_block, subset=None):
+        n_queries, query_len, alphabet_size = pwms.shape
+        pwms = pwms.astype(self.dtype, copy=False)
+
+        cum_H_bg = np.zeros((n_queries, query_len + 1))
+        np.cumsum(H_model_bg, axis=1, out=cum_H_bg[:, 1:])
+        cum_H = np.zeros((n_queries, query_len + 1))
+        np.cumsum(H_model, axis=1, out=cum_H[:, 1:])
+
+        for bucket in self.buckets:
+            bucket_len = bucket['length']
+            if subset is None:
+                positions = np.arange(len(bucket['indices']))
+            else:
+                positions = np.flatnonzero(subset[bucket['indices']])
+            block_size = max(1, self.max_block_elements //
+                             (n_queries * query_len * bucket_len * alphabet_size))
+            for block_start in range(0, len(positions), block_size):
+                block = positions[block_start:block_start + block_size]
+                yield bucket['indices'][block], score_block(
+                    pwms, cum_H_bg, cum_H,
+                    bucket['pwm'][block], bucket['lengths'][block],
+                    bucket['cum_H_model_bg'][block], bucket['cum_H_model'][block],
+                    min_overlap
+                )
+
+
+def max_window_sums(values):
+
+    # values has shape (n, length) and must be non-negative. Entry [k, l] of
+    # the result is the largest sum of l consecutive values of row k. Zero
+    # padding at the end of a row does not change the result.
+    n, length = values.shape
+    cum = np.zeros((n, length + 1))
+    np.cumsum(values, axis=1, out=cum[:, 1:])
+    windows = np.zeros((n, length + 1))
+    for window_len in range(1, length + 1):
+        windows[:, window_len] = (cum[:, window_len:] - cum[:, :-window_len]).max(axis=1)
+    return windows
+
+
+def map_arrays(func, nested):
+    if isinstance(nested, tuple):
+        return tuple(map_arrays(func, item) for item in nested)
+    return func(nested)
+
+
+def _alignment_scores(pwms, cum_H_bg, cum_H, db_pwms, db_lengths, db_cum_H_bg, db_cum_H,
+                      min_overlap):
+
+    # scores of every alignment of every query (axis 0) with every database
+    # model of the block (axis 1). Alignments are on axis 2.
+    n_queries, query_len, _ = pwms.shape
+    n_models, bucket_len, _ = db_pwms.shape
+    n_diags = query_len + bucket_len - 1
+
+    # cross entropy of every query row with every database row. Padded rows
+    # are masked out, so that they do not contribute to the diagonal sums.
+    p_bar = 0.5 * (pwms[:, np.newaxis, :, np.newaxis, :] + db_pwms[np.newaxis, :, np.newaxis, :, :])
+    pair_entropy = xlogy(p_bar, p_bar).sum(axis=4) / loge2
+    pair_entropy *= np.arange(bucket_len) < db_lengths[:, np.newaxis, np.newaxis]
+
+    # every alignment is a diagonal. diagonal k is the shift
+    # d = k - bucket_len + 1 of the query start against the database model start.
+    n_pairs = n_queries * n_models
+    diagonals = np.subtract.outer(np.arange(query_len), np.arange(bucket_len)) + bucket_len - 1
+    diagonals = diagonals + n_diags * np.arange(n_pairs)[:, np.newaxis, np.newaxis]
+    diag_entropy = np.bincount(diagonals.ravel(), weights=pair_entropy.ravel(),
+                               minlength=n_pairs * n_diags).reshape(n_queries, n_models, n_diags)
+
+    shift = np.arange(n_diags) - bucket_len + 1
+    lengths = db_lengths[:, np.newaxis]
+    start_query = np.maximum(shift, 0)
+    start_db = np.maximum(-shift, 0)
+    overlap = np.minimum(query_len - start_query, lengths - start_db)
+    valid = overlap >= min_overlap
+    overlap = np.maximum(overlap, 0)
+    start_query = np.broadcast_to(start_query, overlap.shape)
+    start_db = np.broadcast_to(start_db, overlap.shape)
+    end_query = start_query + overlap
+    end_db = start_db + overlap
+
+    rows = np.arange(n_models)[:, np.newaxis]
+    background_scores = (cum_H_bg[:, end_query] - cum_H_bg[:, start_query]
+                         + db_cum_H_bg[rows, end_db] - db_cum_H_bg[rows, start_db])
+    cross_scores = (cum_H[:, end_query] - cum_H[:, start_query]
+                    + db_cum_H[rows, end_db] - db_cum_H[rows, start_db])
+    cross_scores -= diag_entropy
+
+    scores = np.where(valid, background_scores - cross_scores, -np.inf)
+    return scores, background_scores, cross_scores, (shift, start_query, start_db, overlap)
+
+
+def _score_block(pwms, cum_H_bg, cum_H, db_pwms, db_lengths, db_cum_H_bg, db_cum_H, min_overlap):
+    scores, background_scores, cross_scores, geometry = _alignment_scores(
+        pwms, cum_H_bg, cum_H, db_pwms, db_lengths, db_cum_H_bg, db_cum_H, min_overlap
+    )
+    shift, start_query, start_db, overlap = geometry
+    query_len = pwms.shape[1]
+
+    # break ties like model_sim, i.e. take the first maximum in the order
+    # create_slices visits the alignments. Sums are taken in a different
+    # order than in model_sim, so ties are only equal up to rounding.
+    ranks = _slice_ranks(shift, query_len, db_lengths[:, np.newaxis], min_overlap)
+    max_scores = scores.max(axis=2, keepdims=True)
+    is_max = scores >= max_scores - TIE_TOLERANCE * np.maximum(np.abs(max_scores), 1)
+    best = np.where(is_max, ranks, np.iinfo(ranks.dtype).max).argmin(axis=2)
+
+    query_index = np.arange(len(pwms))[:, np.newaxis]
+    model_index = np.arange(len(db_pwms))
+    max_scores = scores[query_index, model_index, best]
+    start_query = start_query[model_index, best]
+    start_db = start_db[model_index, best]
+    length = overlap[model_index, best]
+    return (
+        max_scores,
+        (start_query + 1, start_query + length),
+        (start_db + 1, start_db + length),
+        (background_scores[query_index, model_index, best],
+         cross_scores[query_index, model_index, best]),
+    )
+
+
+def _score_batch_block(pwms, cum_H_bg, cum_H, db_pwms, db_lengths, db_cum_H_bg, db_cum_H,
+                       min_overlap):
+
+    # without the offsets there are no ties to break, so we only keep the maxima
+    scores, *_ = _alignment_scores(pwms, cum_H_bg, cum_H, db_pwms, db_lengths,
+                                   db_cum_H_bg, db_cum_H, min_overlap)
+    return scores.max(axis=2)
+
+
+def _slice_ranks(shift, query_len, db_lengths, min_overlap):
+
+    # position of the alignment with the given shift in the sequence
+    # generated by create_slices for the longer vs. the shorter model
+    switched = query_len < db_lengths
+    long_len = np.where(switched, db_lengths, query_len)
+    short_len = np.where(switched, query_len, db_lengths)
+    long_shift = np.where(switched, -shift, shift)
+
+    n_inner = long_len - short_len + 1
+    left_rank = n_inner + 2 * (short_len + long_shift - min_overlap)
+    right_rank = n_inner + 2 * (long_len - long_shift - min_overlap) + 1
+    return np.where(long_shift < 0, left_rank,
+                    np.where(long_shift < n_inner, long_shift, right_rank))
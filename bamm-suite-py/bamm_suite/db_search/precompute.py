@@ -1,8 +1,8 @@
 import argparse
-import json
 
 import numpy as np
 from bamm_suite.db_search.utils import calculate_H_model, calculate_H_model_bg
+from bamm_suite.db_search.model_db import load_models, write_json_db
 
 
 def create_parser():
@@ -16,8 +16,7 @@ def main():
     parser = create_parser()
     args = parser.parse_args()
 
-    with open(args.in_json_db) as in_db:
-        models = json.load(in_db)
+    models = load_models(args.in_json_db)
 
     for model in models:
         if 'H_model_bg' not in model or 'H_model' not in model:
@@ -26,8 +25,7 @@ def main():
             model['H_model_bg'] = calculate_H_model_bg(pwm, bg).tolist()
             model['H_model'] = calculate_H_model(pwm).tolist()
 
-    with open(args.out_json_db, 'w') as out_db:
-        json.dump(models, out_db, indent=4, separators=(',', ': '), sort_keys=True)
+    write_json_db(args.out_json_db, models)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+import argparse
+import os
+import sqlite3
+import sys
+
+# columns of the hits table, in the order of the db_search output. The
+# e-value column is called evalue, the tsv header keeps e-value.
+HIT_COLUMNS = [
+    ('model_id', 'TEXT'), ('db_id', 'TEXT'), ('simscore', 'REAL'), ('evalue', 'REAL'),
+    ('start_query', 'INTEGER'), ('end_query', 'INTEGER'), ('start_hit', 'INTEGER'),
+    ('end_hit', 'INTEGER'), ('bg_score', 'REAL'), ('cross_score', 'REAL'),
+]
+ADAPTIVE_COLUMN = ('n_neg_perm', 'INTEGER')
+TSV_HEADER = {'evalue': 'e-value'}
+
+# the indexes serve a filter on the column, and with model_id and db_id
+# the hits of a query or database model ordered by e-value
+HIT_INDEXES = {
+    'hits_model_id': '(model_id, evalue)',
+    'hits_db_id': '(db_id, evalue)',
+    'hits_evalue': '(evalue)',
+}
+# rows per transaction while writing
+COMMIT_ROWS = 100000
+# the sort orders of the query cli, ties keep the output order
+ORDER_BY = {
+    'output': 'rowid',
+    'evalue': 'evalue, rowid',
+    'simscore': 'simscore DESC, rowid',
+    'model_id': 'model_id, evalue, rowid',
+    'db_id': 'db_id, evalue, rowid',
+}
+
+
+class HitStore:
+
+    # The hits of db_search in an sqlite file, one row per hit in the table
+    # hits with the columns of the tsv output.
+    #
+    # A new store is written without indexes and the indexes are built at
+    # close, which is much faster than updating them for every row. Rows
+    # are inserted with executemany in large transactions and without
+    # syncing to disk; a store that was not closed is incomplete and has
+    # to be written again.
+
+    def __init__(self, path, adaptive_neg_perm=False):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.columns = HIT_COLUMNS + ([ADAPTIVE_COLUMN] if adaptive_neg_perm else [])
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE hits (%s)' % ', '.join(
+            '%s %s' % column for column in self.columns))
+        self.insert = 'INSERT INTO hits VALUES (%s)' % ', '.join('?' * len(self.columns))
+        self.n_pending = 0
+
+    def add(self, rows):
+        rows = [hit_values(row) for row in rows]
+        self.connection.executemany(self.insert, rows)
+        self.n_pending += len(rows)
+        if self.n_pending >= COMMIT_ROWS:
+            self.flush()
+
+    def flush(self):
+        self.connection.commit()
+        self.n_pending = 0
+
+    def close(self):
+        self.flush()
+        create_indexes(self.connection)
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def hit_values(row):
+    # the sqlite values of an output row, numpy integers are not accepted
+    return tuple(str(value) if kind == 'TEXT' else float(value) if kind == 'REAL' else int(value)
+                 for value, (_, kind) in zip(row, HIT_COLUMNS + [ADAPTIVE_COLUMN]))
+
+
+def create_indexes(connection):
+    for name, columns in HIT_INDEXES.items():
+        connection.execute('CREATE INDEX IF NOT EXISTS %s ON hits %s' % (name, columns))
+    connection.commit()
+
+
+def import_tsv(tsv_file, path):
+
+    # writes the hits of a db_search tsv result file, e.g. of db_search_merge
+    # or an incremental run, into a new store
+    with open(tsv_file) as handle:
+        header = handle.readline().rstrip('\n').split('\t')
+        with HitStore(path, adaptive_neg_perm=ADAPTIVE_COLUMN[0] in header) as store:
+            rows = []
+            for line in handle:
+                rows.append(line.rstrip('\n').split('\t'))
+                if len(rows) == COMMIT_ROWS:
+                    store.add(rows)
+                    rows = []
+            store.add(rows)
+
+
+def query_hits(path, model_ids=None, db_ids=None, max_evalue=None, order_by='output', limit=None):
+
+    # the column names and a cursor over the matching hits. A model id
+    # matches the hits of both strands of the query.
+    connection = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    conditions = []
+    params = []
+    if model_ids:
+        strand_ids = [strand_id for model_id in model_ids
+                      for strand_id in (model_id, model_id + '_rev')]
+        conditions.append('model_id IN (%s)' % ', '.join('?' * len(strand_ids)))
+        params.extend(strand_ids)
+    if db_ids:
+        conditions.append('db_id IN (%s)' % ', '.join('?' * len(db_ids)))
+        params.extend(db_ids)
+    if max_evalue is not None:
+        conditions.append('evalue <= ?')
+        params.append(max_evalue)
+
+    sql = 'SELECT * FROM hits'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY %s' % ORDER_BY[order_by]
+    if limit is not None:
+        sql += ' LIMIT %d' % limit
+    cursor = connection.execute(sql, params)
+    return [column[0] for column in cursor.description], cursor
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='query the hits of a db_search result store (see --output_format sqlite) '
+                    'and print them as tsv, in the format of the db_search output'
+    )
+    parser.add_argument('store')
+    parser.add_argument('--from_tsv',
+                        help='first build the store from this db_search tsv result file')
+    parser.add_argument('--model_id', nargs='+',
+                        help='only hits of these queries, on both strands')
+    parser.add_argument('--db_id', nargs='+', help='only hits of these database models')
+    parser.add_argument('--max_evalue', type=float, help='only hits with at most this e-value')
+    parser.add_argument('--order_by', choices=list(ORDER_BY), default='output',
+                        help='sort the hits, by default they are in the order of the db_search '
+                             'output. simscore sorts in decreasing order, model_id and db_id '
+                             'by e-value within a model.')
+    parser.add_argument('--limit', type=int, help='print at most this many hits')
+    parser.add_argument('--output_file', help='write to this file instead of stdout')
+    return parser
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.from_tsv:
+        import_tsv(args.from_tsv, args.store)
+    if not os.path.exists(args.store):
+        parser.error('%s does not exist' % args.store)
+
+    columns, cursor = query_hits(args.store, args.model_id, args.db_id, args.max_evalue,
+                                 args.order_by, args.limit)
+
+    out = open(args.output_file, 'w') if args.output_file else sys.stdout
+    try:
+        print(*[TSV_HEADER.get(column, column) for column in columns], sep='\t', file=out)
+        for row in cursor:
+            print(*row, sep='\t', file=out)
+    finally:
+        if args.output_file:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import heapq
+
+import numpy as np
+
+# The unit of the cost estimates is one aligned column pair of a query and
+# a padded database model, scored for one query pwm. A tile should take at
+# least MIN_TILE_COST units (roughly a tenth of a second), so that the
+# overhead of dispatching it does not matter.
+MIN_TILE_COST = 1e6
+# work left for dispatch is cut into about this many tiles per worker,
+# see TileScheduler
+TILES_PER_WORKER = 4
+
+
+class TileScheduler:
+
+    # Plans the jobs of a pooled search, the most expensive work first.
+    #
+    # The cost of a query is its length times the padded length of the
+    # scanned database models, times the number of pwms scored against them:
+    # both strands and the permutations of the null fit. Cheap queries are
+    # grouped into ('search', query_indices) tiles of at least MIN_TILE_COST.
+    # A query that alone is more than a 1 / (TILES_PER_WORKER * n_workers)
+    # share of all work would keep one worker busy while the others run out
+    # of jobs. It becomes a ('null', query_index) tile for the null fit,
+    # which the searcher may replace by ('perm', query_index, block) tiles
+    # of the permutations against blocks of database models (see
+    # split_null). Once the null is known, the query is scanned in
+    # ('scan', query_index, block) tiles (see split_scan).
+    #
+    # A block is a contiguous range of the models in bucket order, so that a
+    # tile scans contiguous rows of a few bucket arrays. Blocks are sized by
+    # guided self-scheduling: a tile gets a 1 / (TILES_PER_WORKER * n_workers)
+    # share of the work not yet dispatched, so tiles become smaller towards
+    # the end of the run and the workers finish at about the same time.
+    # Tiles are handed out on demand (see next_tile), a worker that is done
+    # early simply takes the next one.
+
+    def __init__(self, query_lengths, db_models, n_perm, n_workers, split_queries=True,
+                 db_shard=None):
+        self.n_workers = n_workers
+        # the permutations of the null fit are scored against the whole
+        # database, the query strands only against the shard
+        db_order = np.concatenate([bucket['indices'] for bucket in db_models.buckets]
+                                  + [np.zeros(0, dtype=int)])
+        db_columns = np.concatenate([np.full(len(bucket['indices']), bucket['length'])
+                                     for bucket in db_models.buckets] + [np.zeros(0)])
+        self.null_blocks = BlockPlan(db_order, db_columns)
+        if db_shard:
+            in_shard = (db_order >= db_shard[0]) & (db_order < db_shard[1])
+            db_order = db_order[in_shard]
+            db_columns = db_columns[in_shard]
+        self.scan_blocks = BlockPlan(db_order, db_columns)
+
+        query_lengths = np.asarray(query_lengths, dtype=float)
+        self.scan_cost = 2 * query_lengths * self.scan_blocks.n_columns
+        self.null_cost = np.asarray(n_perm) * query_lengths * self.null_blocks.n_columns
+        query_costs = self.scan_cost + self.null_cost
+        # cost of the tiles that are planned or still have to be planned,
+        # but are not dispatched yet
+        self.remaining = float(query_costs.sum())
+
+        self.heap = []
+        self.n_pushed = 0
+        split_cost = max(MIN_TILE_COST, self.remaining / (TILES_PER_WORKER * n_workers))
+        group = []
+        group_cost = 0.0
+        for query_index in np.argsort(-query_costs, kind='stable'):
+            query_index = int(query_index)
+            cost = query_costs[query_index]
+            if split_queries and cost > split_cost and len(self.scan_blocks.order) > 1:
+                # the null tile stands for the whole query, its scan tiles
+                # can only start once it is done
+                self._push(cost, self.null_cost[query_index], ('null', query_index))
+                continue
+            group.append(query_index)
+            group_cost += cost
+            if group_cost >= MIN_TILE_COST:
+                self._push(group_cost, group_cost, ('search', group))
+                group = []
+                group_cost = 0.0
+        if group:
+            self._push(group_cost, group_cost, ('search', group))
+
+    def _push(self, priority, cost, tile):
+        # the sequence number keeps the order of tiles with the same priority
+        heapq.heappush(self.heap, (-priority, self.n_pushed, cost, tile))
+        self.n_pushed += 1
+
+    def next_tile(self):
+        # the most expensive planned tile, or None if there is none right now
+        if not self.heap:
+            return None
+        _, _, cost, tile = heapq.heappop(self.heap)
+        self.remaining -= cost
+        return tile
+
+    def split_null(self, query_index):
+
+        # replaces the null tile of a query by tiles of its permutations
+        # against blocks of the database, returns their number
+        self.remaining += self.null_cost[query_index]
+        return self._split(query_index, 'perm', self.null_cost[query_index], self.null_blocks)
+
+    def split_scan(self, query_index):
+        # plans the scan tiles of a query whose null is known, returns their number
+        return self._split(query_index, 'scan', self.scan_cost[query_index], self.scan_blocks)
+
+    def _split(self, query_index, kind, cost, blocks):
+        block_cost = max(MIN_TILE_COST, self.remaining / (TILES_PER_WORKER * self.n_workers))
+        planned = blocks.split(max(int(np.ceil(cost / block_cost)), 1))
+        for block, block_share in planned:
+            self._push(cost * block_share, cost * block_share, (kind, query_index, block))
+        return len(planned)
+
+
+class BlockPlan:
+
+    # database models in bucket order with their padded lengths, to cut
+    # into contiguous blocks of about equal work
+
+    def __init__(self, order, columns):
+        self.order = order
+        self.cum_columns = np.zeros(len(columns) + 1)
+        np.cumsum(columns, out=self.cum_columns[1:])
+        self.n_columns = self.cum_columns[-1]
+
+    def split(self, n_blocks):
+
+        # at most n_blocks blocks with their share of the columns. There is
+        # always at least one block, if empty.
+        bounds = np.searchsorted(self.cum_columns, np.linspace(0, self.n_columns, n_blocks + 1))
+        bounds[0], bounds[-1] = 0, len(self.order)
+        bounds = np.unique(bounds)
+        if len(bounds) == 1:
+            return [(self.order[:0], 1.0)]
+        return [(self.order[start:end],
+                 (self.cum_columns[end] - self.cum_columns[start]) / max(self.n_columns, 1))
+                for start, end in zip(bounds[:-1], bounds[1:])]
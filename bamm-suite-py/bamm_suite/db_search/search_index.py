@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from bamm_suite.db_search.packed_db import PackedModelDB, SHARED_ALIGNMENT
+from bamm_suite.db_search.model_db import load_models, update_models
+
+# Search index layout (all numbers little endian):
+#
+#   magic           8 bytes, INDEX_MAGIC
+#   header_length   uint64
+#   header          json with the format version, the min_overlap the models
+#                   were filtered with, the sha1 of the source database file,
+#                   the consensus of every model and the layout of the
+#                   packed database (see PackedModelDB.layout), including
+#                   its checksum
+#   data            the arrays of the packed database: concatenated pwms,
+#                   entropies and backgrounds, the window maxima for the
+#                   upper bounds and the length buckets with their padded
+#                   pwms and entropy prefix sums. The layout offsets are
+#                   relative to data_start, a multiple of SHARED_ALIGNMENT.
+#
+# The reverse complements are not stored, they are views into the forward
+# arrays (see reverse_complement in db_search).
+
+INDEX_MAGIC = b'BAMMIDX\x01'
+INDEX_VERSION = 1
+CONSENSUS_ALPHABET = 'ACGT'
+
+
+def default_index_path(model_db):
+    return model_db + '.index'
+
+
+def is_search_index(path):
+    with open(path, 'rb') as handle:
+        return handle.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+
+def file_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def consensus(pwm, alphabet=CONSENSUS_ALPHABET):
+
+    # the most likely letter per position, in lower case if its probability
+    # is below 0.5
+    if pwm.shape[1] != len(alphabet):
+        return ''
+    best = pwm.argmax(axis=1)
+    strong = pwm[np.arange(len(pwm)), best] >= 0.5
+    return ''.join(alphabet[letter] if is_strong else alphabet[letter].lower()
+                   for letter, is_strong in zip(best, strong))
+
+
+def write_search_index(path, db_models, min_overlap, source_sha1):
+    db_models.checksum()
+    handle, size = db_models.layout()
+    header = json.dumps({
+        'version': INDEX_VERSION,
+        'min_overlap': min_overlap,
+        'source_sha1': source_sha1,
+        'consensus': [consensus(db_models.model(index)['pwm']) for index in range(len(db_models))],
+        'db': handle,
+    }).encode('utf-8')
+
+    prefix_length = len(INDEX_MAGIC) + 8 + len(header)
+    data_start = -(-prefix_length // SHARED_ALIGNMENT) * SHARED_ALIGNMENT
+    data = np.zeros(size, dtype=np.uint8)
+    db_models.write_to_buffer(handle, data)
+
+    # write to a temporary file first, so that a running search never
+    # picks up a truncated index
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(INDEX_MAGIC)
+        out.write(np.uint64(len(header)).astype('<u8').tobytes())
+        out.write(header)
+        out.write(b'\x00' * (data_start - prefix_length))
+        out.write(data.tobytes())
+    os.replace(tmp_path, path)
+
+
+def build_search_index(model_db, path, min_overlap=4, bucket_width=4):
+    db_models = PackedModelDB(update_models(load_models(model_db), min_overlap),
+                              bucket_width=bucket_width)
+    write_search_index(path, db_models, min_overlap, file_sha1(model_db))
+    return db_models
+
+
+def read_index_header(path):
+
+    # the json header of a search index and the file offset of its data
+    with open(path, 'rb') as handle:
+        if handle.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError('%s is not a search index' % path)
+        header_length = int(np.frombuffer(handle.read(8), dtype='<u8')[0])
+        header = json.loads(handle.read(header_length).decode('utf-8'))
+
+    if header['version'] != INDEX_VERSION:
+        raise ValueError('unsupported search index version %s' % header['version'])
+    prefix_length = len(INDEX_MAGIC) + 8 + header_length
+    return header, -(-prefix_length // SHARED_ALIGNMENT) * SHARED_ALIGNMENT
+
+
+class SearchIndex:
+
+    # read-only search index. db is a PackedModelDB whose arrays are memory
+    # mapped from the index file.
+
+    def __init__(self, path):
+        header, data_start = read_index_header(path)
+        self.path = path
+        self.min_overlap = header['min_overlap']
+        self.source_sha1 = header['source_sha1']
+        self.consensus = header['consensus']
+
+        if os.path.getsize(path) > data_start:
+            data = np.memmap(path, dtype=np.uint8, mode='r', offset=data_start)
+        else:
+            data = np.zeros(0, dtype=np.uint8)
+        self.db = PackedModelDB.from_buffer(header['db'], data)
+
+
+def load_packed_db(model_db, min_overlap, precision='float64'):
+
+    # the packed database for a search. model_db is either a search index,
+    # or a model database in json or binary format. In the latter case an
+    # up to date index next to it (see default_index_path) is used instead
+    # of preparing the models again. Indexes are stored in float64, for a
+    # lower precision the padded pwms are converted after loading.
+    return _load_packed_db(model_db, min_overlap).astype(precision)
+
+
+def _load_packed_db(model_db, min_overlap):
+    logger = logging.getLogger()
+    if is_search_index(model_db):
+        index = SearchIndex(model_db)
+        if index.min_overlap == min_overlap:
+            return index.db
+        if index.min_overlap > min_overlap:
+            raise ValueError('%s was built with min_overlap %s and lacks the shorter models, '
+                             'please rebuild it' % (model_db, index.min_overlap))
+        logger.warn('%s was built with min_overlap %s, filtering its models again.',
+                    model_db, index.min_overlap)
+        models = [index.db.model(i) for i in range(len(index.db))]
+        return PackedModelDB(update_models(models, min_overlap),
+                             bucket_width=index.db.bucket_width)
+
+    index_path = find_search_index(model_db, min_overlap)
+    if index_path is not None:
+        logger.info('Using the search index %s', index_path)
+        return SearchIndex(index_path).db
+    return PackedModelDB(update_models(load_models(model_db), min_overlap))
+
+
+def find_search_index(model_db, min_overlap):
+
+    # the up to date search index of model_db for min_overlap: model_db
+    # itself or the index next to it. None if there is none.
+    if is_search_index(model_db):
+        index_path = model_db
+    else:
+        index_path = default_index_path(model_db)
+        if not os.path.exists(index_path):
+            return None
+
+    header, _ = read_index_header(index_path)
+    if header['min_overlap'] != min_overlap or (
+            index_path != model_db and header['source_sha1'] != file_sha1(model_db)):
+        logging.getLogger().warn('ignoring the search index %s, it was built from a different '
+                                 'database or with a different min_overlap.', index_path)
+        return None
+    return index_path
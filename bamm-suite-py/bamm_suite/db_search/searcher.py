@@ -0,0 +1,839 @@
+import heapq
+from multiprocessing import Pool
+import os
+import queue
+import time
+
+import numpy as np
+
+from bamm_suite.db_search.utils import calculate_H_model_bg, calculate_H_model, create_permutations
+from bamm_suite.db_search.utils import fit_exp_tail, fit_converged, query_seed
+from bamm_suite.db_search.packed_db import PackedModelDB, map_arrays
+from bamm_suite.db_search.model_db import update_models
+from bamm_suite.db_search.search_index import load_packed_db
+from bamm_suite.db_search.null_model import information_content
+from bamm_suite.db_search.dispatch import chunked, imap_unordered_bounded
+from bamm_suite.db_search.scheduler import TileScheduler
+
+TOP_K_MIN_BLOCK = 256
+# relative distance to the hit threshold within which scores of a reduced
+# precision scan are scored again in float64
+RECHECK_TOLERANCE = 1e-4
+
+# one row per hit, as returned by MotifSearcher.search
+HIT_DTYPE = np.dtype([
+    ('model_id', object), ('db_id', object), ('strand', np.int8),
+    ('simscore', float), ('evalue', float), ('start_query', np.int64), ('end_query', np.int64),
+    ('start_hit', np.int64), ('end_hit', np.int64), ('bg_score', float), ('cross_score', float),
+    ('n_neg_perm', np.int64),
+])
+
+
+class MotifSearcher:
+
+    # Searches query models against a packed model database. The searcher is
+    # constructed once and reused for many queries.
+    #
+    # With n_processes, the database is placed in shared memory and the
+    # searches of search_many and map_search run in a pool of worker
+    # processes that each hold their own searcher attached to it. Otherwise
+    # everything runs in the calling process. A pooled searcher has to be
+    # closed, e.g. by using it as a context manager.
+    #
+    # The null distribution of a query is taken from stored_nulls (a dict
+    # of model id to (high_score, exp_lambda, n_perm)) if given, else from
+    # the precomputed null_model, else from the calibration_cache, else it is
+    # fitted with permutations of the query.
+    #
+    # The scan runs in the precision of the database (see
+    # PackedModelDB.astype). Below float64, scores within recheck_tolerance
+    # of the hit threshold of a strand are scored again in float64, so the
+    # reported hits are the ones of a float64 scan.
+    #
+    # null_db_size is the number of database models the permutations of a
+    # null fit are scored against. It differs from len(db_models) when the
+    # searcher holds only a block of the database (see out_of_core).
+    #
+    # With n_candidates, only the n_candidates database models most similar
+    # to a query in the candidate_index (see CandidateIndex) are scored and
+    # can become hits, the others count as pruned. The hits found are the
+    # ones of a full scan, with the same e-values; the null is still fitted
+    # against the whole database.
+
+    def __init__(self, db_models, highscore_fraction=0.1, evalue_threshold=0.1, n_neg_perm=10,
+                 adaptive_perm=None, min_overlap=4, top_k=None, prune=True,
+                 separate_rev_null=True, seed=42, db_size=None, db_shard=None, db_checksum=None,
+                 null_model=None, stored_nulls=None, calibration_cache=None,
+                 recheck_tolerance=RECHECK_TOLERANCE, null_db_size=None, candidate_index=None,
+                 n_candidates=None, n_processes=None):
+        self.highscore_fraction = highscore_fraction
+        self.evalue_threshold = evalue_threshold
+        self.n_neg_perm = n_neg_perm
+        # (batch size, maximum number, relative tolerance) of permutations
+        self.adaptive_perm = adaptive_perm
+        self.min_overlap = min_overlap
+        self.top_k = top_k
+        self.prune = prune
+        self.separate_rev_null = separate_rev_null
+        self.seed = seed
+        self.db_size = db_size or len(db_models)
+        self.db_shard = db_shard
+        self.null_model = null_model
+        self.stored_nulls = stored_nulls
+        self.calibration_cache = calibration_cache
+        self.recheck_tolerance = recheck_tolerance
+        self.null_db_size = null_db_size or len(db_models)
+        self.candidate_index = candidate_index
+        self.n_candidates = n_candidates
+        self.db_checksum = db_checksum
+        if calibration_cache is not None and db_checksum is None:
+            self.db_checksum = db_models.checksum()
+
+        self.db_models = db_models
+        # number of models rescored in float64 by recheck_near_threshold
+        self.n_rechecked = 0
+        self.pool = None
+        self._shm = None
+        if n_processes is not None:
+            self._start_pool(n_processes)
+
+    @classmethod
+    def from_path(cls, model_db, min_overlap=4, precision='float64', **params):
+
+        # a searcher over a model database in json or binary format or a
+        # search index (see bamm precompute), loaded like db_search loads it.
+        # The other parameters are the ones of the constructor.
+        db_models = load_packed_db(model_db, min_overlap, precision)
+        return cls(db_models, min_overlap=min_overlap, **params)
+
+    def _params(self):
+        return {
+            'highscore_fraction': self.highscore_fraction,
+            'evalue_threshold': self.evalue_threshold,
+            'n_neg_perm': self.n_neg_perm,
+            'adaptive_perm': self.adaptive_perm,
+            'min_overlap': self.min_overlap,
+            'top_k': self.top_k,
+            'prune': self.prune,
+            'separate_rev_null': self.separate_rev_null,
+            'seed': self.seed,
+            'db_size': self.db_size,
+            'db_shard': self.db_shard,
+            'db_checksum': self.db_checksum,
+            'null_model': self.null_model,
+            'stored_nulls': self.stored_nulls,
+            'calibration_cache': self.calibration_cache,
+            'recheck_tolerance': self.recheck_tolerance,
+            'null_db_size': self.null_db_size,
+            'candidate_index': self.candidate_index,
+            'n_candidates': self.n_candidates,
+        }
+
+    def _start_pool(self, n_processes):
+
+        # the database is placed once in shared memory, all workers attach to
+        # it read-only instead of holding their own copy. The searcher itself
+        # switches to the shared copy as well.
+        self._shm, db_handle = self.db_models.to_shared_memory()
+        try:
+            self.db_models = PackedModelDB.from_shared_memory(db_handle)
+            self.pool = Pool(n_processes or None, initializer=_init_worker,
+                             initargs=(db_handle, self._params()))
+        except BaseException:
+            self.close()
+            raise
+        self.n_processes = n_processes or os.cpu_count()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self._shm is not None:
+            # the views into the block have to be gone before it is closed
+            attached_shm = getattr(self.db_models, '_shm', None)
+            self.db_models = None
+            if attached_shm is not None:
+                attached_shm.close()
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def search(self, pwm, bg_freq, model_id='query'):
+
+        # searches one query given by its pwm and background frequencies,
+        # returns its hits on both strands as HIT_DTYPE array, by e-value
+        model = {'model_id': model_id, 'pwm': pwm, 'bg_freq': bg_freq}
+        return self.search_many([model])[0]
+
+    def search_many(self, models):
+
+        # the HIT_DTYPE arrays of a list of query model dicts, in the pool if
+        # the searcher has one
+        # the searches of models shorter than min_overlap are empty
+        prepared = update_models(list(models), self.min_overlap)
+        results = {}
+        for model, (strand_hits, stats) in zip(prepared, self.map_search(prepared)):
+            results[id(model)] = hit_array(strand_hits, stats)
+        return [results.get(id(model), np.zeros(0, dtype=HIT_DTYPE)) for model in models]
+
+    def map_search(self, models, ordered=True, chunk_size=1, max_in_flight=None, schedule='cost'):
+
+        # yields the result of motif_search for every model, in the input
+        # order or, with ordered=False, as they finish. With schedule='cost',
+        # the pool works on the tiles of a TileScheduler, at most
+        # max_in_flight of them pending. With schedule='input', the models
+        # are submitted in input order, unordered results lazily in chunks
+        # of models with at most max_in_flight pending chunks.
+        if self.pool is None:
+            for model in models:
+                yield self.motif_search(model)
+        elif schedule == 'cost':
+            models = list(models)
+            results = self._scheduled_search(models, max_in_flight or 2 * self.n_processes)
+            if not ordered:
+                for _, result in results:
+                    yield result
+                return
+            # results are held back until all earlier queries are done
+            finished = {}
+            next_index = 0
+            for query_index, result in results:
+                finished[query_index] = result
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+        elif ordered:
+            jobs = [self.pool.apply_async(_worker_search, args=(model,)) for model in models]
+            for job in jobs:
+                yield job.get()
+        else:
+            max_in_flight = max_in_flight or 4 * self.n_processes
+            for chunk_results in imap_unordered_bounded(
+                    self.pool, _worker_search_chunk, chunked(models, chunk_size), max_in_flight):
+                yield from chunk_results
+
+    def map_strand_nulls(self, models):
+
+        # the nulls of both strands of every query, see fit_strand_nulls, in
+        # input order and in the pool if the searcher has one. Yields
+        # (nulls, n_perm, seconds, worker pid) per query.
+        if self.pool is None:
+            for model in models:
+                yield _fit_nulls_job(self, model)
+        else:
+            yield from self.pool.imap(_worker_fit_nulls, models)
+
+    def map_permutation_tails(self, models):
+
+        # the permutation tails of the null strands of every query against
+        # the whole database, in the pool if the searcher has one. Returns
+        # (tails, seconds, worker pid) per query.
+        args = [(model, None) for model in models]
+        if self.pool is None:
+            return [_permutation_tail_job(self, *job_args) for job_args in args]
+        return self.pool.starmap(_worker_permutation_tail, args)
+
+    def map_scan(self, models, nulls):
+
+        # scan of every query with its nulls against the whole database, in
+        # the pool if the searcher has one. Returns (strand_hits, n_pairs,
+        # n_scored, n_rechecked, seconds, worker pid) per query, with the
+        # (db_index, hit) pairs of scan.
+        args = [(model, query_nulls, None) for model, query_nulls in zip(models, nulls)]
+        if self.pool is None:
+            return [_scan_job(self, *job_args) for job_args in args]
+        return self.pool.starmap(_worker_scan, args)
+
+    def _scheduled_search(self, models, max_in_flight):
+
+        # runs the tiles of a TileScheduler in the pool and yields the index
+        # and the motif_search result of every query as soon as its last
+        # tile is done. Only max_in_flight tiles are submitted at a time, so
+        # the tiles of split queries are planned late and sized by the work
+        # left at that point.
+        #
+        # A split query first needs its null. If it is stored, precomputed or
+        # cached, it is looked up here. This also keeps cached queries from
+        # being estimated as expensive. A null that has to be fitted with a
+        # fixed number of permutations is scored in ('perm', query_index,
+        # block) tiles over database blocks and fitted here from their
+        # tails (see permutation_tail). An adaptive fit depends on its
+        # previous batches and runs as a single ('null', query_index) tile.
+        known_nulls = {}
+        n_perm = np.zeros(len(models))
+        for query_index, model in enumerate(models):
+            nulls = self.known_strand_nulls(model)
+            if nulls is None:
+                n_perm[query_index] = self.expected_n_perm()
+            else:
+                known_nulls[query_index] = nulls
+        scheduler = TileScheduler([len(model['pwm']) for model in models], self.db_models,
+                                  n_perm, self.n_processes, split_queries=not self.top_k,
+                                  db_shard=self.db_shard)
+        finished = queue.Queue()
+        # the partial results of the split queries
+        split = {}
+
+        def submit(tile):
+            query_index = tile[1]
+            if tile[0] == 'search':
+                func, args = _worker_search_chunk, ([models[index] for index in query_index],)
+            elif tile[0] == 'null':
+                func, args = _worker_fit_nulls, (models[query_index],)
+            elif tile[0] == 'perm':
+                func, args = _worker_permutation_tail, (models[query_index], tile[2])
+            else:
+                func, args = _worker_scan, (models[query_index], split[query_index]['nulls'],
+                                            tile[2])
+            self.pool.apply_async(func, args=args,
+                                  callback=lambda result: finished.put((tile, True, result)),
+                                  error_callback=lambda error: finished.put((tile, False, error)))
+
+        def start_scan(query_index, nulls, n_perm):
+            partial = split[query_index]
+            partial['nulls'] = nulls
+            partial['n_perm'] = n_perm
+            partial['tiles_left'] = scheduler.split_scan(query_index)
+
+        n_in_flight = 0
+        while True:
+            while n_in_flight < max_in_flight:
+                tile = scheduler.next_tile()
+                if tile is None:
+                    break
+                if tile[0] == 'null':
+                    query_index = tile[1]
+                    split[query_index] = new_split_query()
+                    if query_index in known_nulls:
+                        start_scan(query_index, known_nulls[query_index], 0)
+                        continue
+                    if self.adaptive_perm is None:
+                        split[query_index]['tails'] = [[] for _ in range(self.n_null_strands())]
+                        split[query_index]['tiles_left'] = scheduler.split_null(query_index)
+                        continue
+                submit(tile)
+                n_in_flight += 1
+            if n_in_flight == 0:
+                break
+
+            tile, success, result = finished.get()
+            n_in_flight -= 1
+            if not success:
+                raise result
+
+            if tile[0] == 'search':
+                yield from zip(tile[1], result)
+                continue
+
+            query_index = tile[1]
+            model = models[query_index]
+            partial = split[query_index]
+            *result, seconds, worker = result
+            partial['worker_busy'][worker] = partial['worker_busy'].get(worker, 0.0) + seconds
+            partial['tiles'] += 1
+            if tile[0] == 'null':
+                partial['null_s'] += seconds
+                start_scan(query_index, *result)
+            elif tile[0] == 'perm':
+                partial['null_s'] += seconds
+                for strand_tails, tail in zip(partial['tails'], result[0]):
+                    strand_tails.append(tail)
+                partial['tiles_left'] -= 1
+                if partial['tiles_left'] == 0:
+                    start_scan(query_index, self.fit_strand_nulls_from_tails(model, partial['tails']),
+                               self.expected_n_perm())
+            else:
+                strand_hits, n_pairs, n_scored, n_rechecked = result
+                for merged, hits in zip(partial['strand_hits'], strand_hits):
+                    merged.extend(hits)
+                partial['pairs'] += n_pairs
+                partial['scored'] += n_scored
+                partial['rechecked'] += n_rechecked
+                partial['scan_s'] += seconds
+                partial['tiles_left'] -= 1
+                if partial['tiles_left'] == 0:
+                    del split[query_index]
+                    yield query_index, self._merge_split_query(model, partial)
+
+    def _merge_split_query(self, model, partial):
+
+        # the motif_search result of a query from the results of its tiles.
+        # The blocks are in bucket order, sorting by database index restores
+        # the hit order of a single scan.
+        strand_hits = [sorted(hits, key=lambda item: item[0]) for hits in partial['strand_hits']]
+        stats = self.query_stats(model, partial['nulls'], partial['n_perm'], strand_hits)
+        worker_busy = partial['worker_busy']
+        stats.update({
+            'worker': max(worker_busy, key=worker_busy.get),
+            'worker_busy': worker_busy,
+            'tiles': partial['tiles'],
+            'pairs': partial['pairs'],
+            'pruned': partial['pairs'] - partial['scored'],
+            'rechecked': partial['rechecked'],
+            'null_s': partial['null_s'],
+            'scan_s': partial['scan_s'],
+        })
+        return [[hit for _, hit in hits] for hits in strand_hits], stats
+
+    def motif_search(self, model):
+
+        # searches a prepared query model (see update_models) in this process.
+        # Returns the hit tuples of both strands and the counters of the query.
+        start = time.perf_counter()
+        nulls, n_perm = self.fit_strand_nulls(model)
+        null_end = time.perf_counter()
+        n_rechecked = self.n_rechecked
+        strand_hits, n_pairs, n_scored = self.scan(model, nulls)
+        scan_s = time.perf_counter() - null_end
+
+        stats = self.query_stats(model, nulls, n_perm, strand_hits)
+        busy_s = null_end - start + scan_s
+        stats.update({
+            'worker': os.getpid(),
+            'worker_busy': {os.getpid(): busy_s},
+            'tiles': 1,
+            'pairs': n_pairs,
+            'pruned': n_pairs - n_scored,
+            'rechecked': self.n_rechecked - n_rechecked,
+            'null_s': null_end - start,
+            'scan_s': scan_s,
+        })
+        return [[hit for _, hit in hits] for hits in strand_hits], stats
+
+    def query_stats(self, model, nulls, n_perm, strand_hits):
+
+        # the counters of a query that do not depend on how its search was
+        # split into jobs
+        null, rev_null = nulls
+        null_records = {model['model_id']: (float(null[0]), float(null[1]), int(null[2]))}
+        if self.separate_rev_null:
+            null_records[model['model_id'] + '_rev'] = (float(rev_null[0]), float(rev_null[1]),
+                                                         int(rev_null[2]))
+        return {
+            'model_id': model['model_id'],
+            'nulls': null_records,
+            'n_perm': n_perm,
+            'hits': sum(len(hits) for hits in strand_hits),
+        }
+
+    def expected_n_perm(self):
+        # permutations drawn per query if its null has to be fitted
+        if self.stored_nulls is not None or self.null_model is not None:
+            return 0
+        n_perm = self.n_neg_perm if self.adaptive_perm is None else self.adaptive_perm[1]
+        return 2 * n_perm if self.separate_rev_null else n_perm
+
+    def n_null_strands(self):
+        return 2 if self.separate_rev_null else 1
+
+    def null_strand_models(self, model):
+        # the strands of a query that get a null of their own
+        if self.separate_rev_null:
+            return [model, reverse_complement(model)]
+        return [model]
+
+    def known_strand_nulls(self, model):
+        # the nulls of both strands if none of them has to be fitted, else None
+        nulls = [self.known_null(strand_model) for strand_model in self.null_strand_models(model)]
+        if any(null is None for null in nulls):
+            return None
+        return nulls[0], nulls[-1]
+
+    def fit_strand_nulls_from_tails(self, model, tails):
+
+        # the nulls of both strands from the permutation tails of all
+        # database blocks, see permutation_tail
+        nulls = []
+        for strand_model, strand_tails in zip(self.null_strand_models(model), tails):
+            tail = np.sort(np.concatenate(strand_tails))
+            high_score, exp_lambda = fit_exp_tail(tail, self.highscore_fraction,
+                                                  n_neg=self.n_neg_perm * self.null_db_size)
+            null = (high_score, exp_lambda, self.n_neg_perm)
+            if self.calibration_cache is not None:
+                self.calibration_cache.put(self.cache_key(strand_model), *null)
+            nulls.append(null)
+        return nulls[0], nulls[-1]
+
+    def fit_strand_nulls(self, model):
+
+        # the nulls of the forward and the reverse strand, unless cached or
+        # precomputed for the database, and the number of permutations
+        # scored for them. The forward null scores shuffles of the forward
+        # pwm against the database, which is the null of the reverse strand
+        # against the reverse complemented database. Both only agree if the
+        # database is closed under reverse complement, so by default each
+        # strand gets its own null. Without separate_rev_null, the reverse
+        # strand reuses the forward null at half the permutations.
+        null, n_perm = self.cached_fit_null(model)
+        rev_null = null
+        if self.separate_rev_null:
+            rev_null, n_rev_perm = self.cached_fit_null(reverse_complement(model))
+            n_perm += n_rev_perm
+        return (null, rev_null), n_perm
+
+    def scan(self, model, nulls, block=None):
+
+        # scans the database for hits of both strands of a query with the
+        # given nulls, or only the database models in the index array block.
+        # Returns the (db_index, hit) pairs of both strands in database
+        # order, the number of query/database pairs and how many of them
+        # were scored.
+        null, rev_null = nulls
+        strands = [(model, null), (reverse_complement(model), rev_null)]
+
+        # skip the database models that cannot become a hit on either strand
+        candidates = None
+        strand_bounds = None
+        if self.prune or self.top_k:
+            strand_bounds = self.strand_upper_bounds(model)
+        if self.prune:
+            candidates = np.zeros(len(self.db_models), dtype=bool)
+            for bounds, (_, strand_null) in zip(strand_bounds, strands):
+                candidates |= bounds >= self.hit_threshold(*strand_null[:2])
+        if self.n_candidates:
+            similar = np.zeros(len(self.db_models), dtype=bool)
+            similar[self.candidate_index.candidates(model, self.n_candidates)] = True
+            candidates = similar if candidates is None else candidates & similar
+
+        in_scope = None
+        if self.db_shard:
+            in_scope = np.zeros(len(self.db_models), dtype=bool)
+            in_scope[slice(*self.db_shard)] = True
+        if block is not None:
+            in_block = np.zeros(len(self.db_models), dtype=bool)
+            in_block[block] = True
+            in_scope = in_block if in_scope is None else in_scope & in_block
+        if in_scope is not None:
+            candidates = in_scope if candidates is None else candidates & in_scope
+
+        n_pairs = len(self.db_models) if in_scope is None else int(in_scope.sum())
+        if self.top_k:
+            strand_hits, n_scored = self.top_k_search(strands, candidates, strand_bounds)
+        else:
+            strand_hits = self.score_strands(strands, candidates)
+            n_scored = n_pairs if candidates is None else int(candidates.sum())
+        return strand_hits, n_pairs, n_scored
+
+    def strand_upper_bounds(self, model):
+
+        # the upper bounds of both strands of a query against every database
+        # model, see PackedModelDB.upper_bounds. The entropies of the reverse
+        # strand are the reversed forward ones, so they are measured against
+        # the reverse complemented background. Both bounds are the same if
+        # the background is symmetric.
+        bg_freq = np.asarray(model['bg_freq'])
+        bounds = self.db_models.upper_bounds(model['H_model_bg'], bg_freq)
+        if np.array_equal(bg_freq, bg_freq[::-1]):
+            return bounds, bounds
+        return bounds, self.db_models.upper_bounds(model['H_model_bg'][::-1], bg_freq[::-1])
+
+    def fit_null(self, model):
+        pwm = model['pwm']
+        bg_freq = model['bg_freq']
+        model_len = len(pwm)
+
+        if self.adaptive_perm is None:
+            batch_size, max_perm, rel_tol = self.n_neg_perm, self.n_neg_perm, None
+        else:
+            batch_size, max_perm, rel_tol = self.adaptive_perm
+
+        # use shuffled pwms to estimate the p-value under the null.
+        # The locality preserving permutations are drawn and scored in batches,
+        # after each batch the tail is refitted and we stop once it is stable.
+        random_state = np.random.RandomState(query_seed(self.seed, pwm))
+        shuffled_dists = []
+        n_perm = 0
+        fit = None
+        while n_perm < max_perm:
+            n_batch = min(batch_size, max_perm - n_perm)
+            shuffle_ind = create_permutations(model_len, n_batch, random_state)
+            shuffle_pwms = pwm[shuffle_ind]
+            H_shuffle_bg = calculate_H_model_bg(shuffle_pwms, bg_freq)
+            H_shuffle = calculate_H_model(shuffle_pwms)
+            shuffled_dists.append(self.db_models.score_batch(shuffle_pwms, H_shuffle_bg, H_shuffle,
+                                                             min_overlap=self.min_overlap))
+            n_perm += n_batch
+
+            sorted_null = np.sort(np.concatenate(shuffled_dists), axis=None)
+            new_fit = fit_exp_tail(sorted_null, self.highscore_fraction)
+            if fit is not None and fit_converged(fit, new_fit, rel_tol):
+                fit = new_fit
+                break
+            fit = new_fit
+
+        high_score, exp_lambda = fit
+        return high_score, exp_lambda, n_perm
+
+    def null_tail_size(self):
+        # number of permutation scores in the tail of a non-adaptive null fit
+        return int(self.n_neg_perm * self.null_db_size * self.highscore_fraction)
+
+    def permutation_tail(self, model, block=None):
+
+        # the fixed number of permutations of fit_null, scored against the
+        # database models in the index array block only, or all of them.
+        # Of their scores, only those that can be in the tail of the fit over
+        # the whole database are returned: at most null_tail_size. The fit
+        # from the tails of all blocks equals the one of fit_null.
+        random_state = np.random.RandomState(query_seed(self.seed, model['pwm']))
+        shuffle_pwms = model['pwm'][create_permutations(len(model['pwm']), self.n_neg_perm,
+                                                        random_state)]
+        subset = None
+        if block is not None:
+            subset = np.zeros(len(self.db_models), dtype=bool)
+            subset[block] = True
+        scores = self.db_models.score_batch(
+            shuffle_pwms, calculate_H_model_bg(shuffle_pwms, model['bg_freq']),
+            calculate_H_model(shuffle_pwms), min_overlap=self.min_overlap, subset=subset
+        )
+        if block is not None:
+            scores = scores[:, block]
+        return np.sort(scores, axis=None)[-self.null_tail_size():]
+
+    def lookup_null(self, model):
+        high_score, exp_lambda = self.null_model.predict(len(model['pwm']),
+                                                         information_content(model['H_model_bg']))
+        return high_score, exp_lambda, 0
+
+    def cache_key(self, model):
+        params = {
+            'n_neg_perm': self.n_neg_perm, 'adaptive_perm': self.adaptive_perm,
+            'highscore_fraction': self.highscore_fraction, 'seed': self.seed,
+            'min_overlap': self.min_overlap,
+        }
+        # the permutations are scored in the precision of the database, keep
+        # the keys of float64 fits unchanged
+        if self.db_models.dtype != np.float64:
+            params['precision'] = self.db_models.dtype.name
+        return self.calibration_cache.key(model['pwm'], model['bg_freq'], self.db_checksum,
+                                          **params)
+
+    def known_null(self, model):
+        # the null of a query strand if it needs no permutations: stored,
+        # precomputed or cached. None otherwise.
+        if self.stored_nulls is not None:
+            return self.stored_nulls[model['model_id']]
+        if self.null_model is not None:
+            return self.lookup_null(model)
+        if self.calibration_cache is not None:
+            return self.calibration_cache.get(self.cache_key(model))
+        return None
+
+    def cached_fit_null(self, model):
+
+        # returns the null fit and the number of permutations scored for it
+        # in this call
+        calibration = self.known_null(model)
+        if calibration is not None:
+            return calibration, 0
+        calibration = self.fit_null(model)
+        if self.calibration_cache is not None:
+            self.calibration_cache.put(self.cache_key(model), *calibration)
+        return calibration, calibration[2]
+
+    def score_strands(self, strands, subset):
+
+        # run both strands against the database in one pass
+        (model, null), (rev_model, rev_null) = strands
+        queries = (np.stack([model['pwm'], rev_model['pwm']]),
+                   np.stack([model['H_model_bg'], rev_model['H_model_bg']]),
+                   np.stack([model['H_model'], rev_model['H_model']]))
+        results = self.db_models.score(*queries, min_overlap=self.min_overlap, subset=subset)
+        if self.db_models.dtype != np.float64:
+            self.n_rechecked += self.recheck_near_threshold(strands, queries, results)
+
+        strand_hits = []
+        for strand, (strand_model, strand_null) in enumerate(strands):
+            strand_results = map_arrays(lambda arr: arr[strand], results)
+            strand_hits.append(self.collect_hits(strand_model['model_id'], strand_results,
+                                                 *strand_null))
+        return strand_hits
+
+    def recheck_near_threshold(self, strands, queries, results):
+
+        # scores the database models again in float64 whose reduced precision
+        # score is close to the hit threshold of a strand, and overwrites
+        # their results. Returns the number of rescored models.
+        sims = results[0]
+        near = np.zeros(sims.shape[1], dtype=bool)
+        for strand, (_, null) in enumerate(strands):
+            threshold = self.hit_threshold(*null[:2])
+            tolerance = self.recheck_tolerance * max(abs(threshold), 1.0)
+            near |= np.abs(sims[strand] - threshold) <= tolerance
+        indices = np.flatnonzero(near)
+        if len(indices) == 0:
+            return 0
+
+        exact_db = PackedModelDB([self.db_models.model(index) for index in indices],
+                                 bucket_width=self.db_models.bucket_width)
+        exact = exact_db.score(*queries, min_overlap=self.min_overlap)
+        for arr, exact_arr in zip(result_arrays(results), result_arrays(exact)):
+            arr[:, indices] = exact_arr
+        return len(indices)
+
+    def top_k_search(self, strands, candidates, strand_bounds):
+
+        # keeps the top_k hits of both strands with the lowest e-values in a
+        # bounded heap. Database models are scanned in blocks in the order of
+        # the best e-value their upper bounds allow on either strand. Once
+        # the heap is full and no remaining model can beat its worst e-value,
+        # the scan stops.
+        best_evalues = np.minimum(*[self.evalue(bounds, *null[:2])
+                                    for bounds, (_, null) in zip(strand_bounds, strands)])
+        order = np.argsort(best_evalues, kind='stable')
+        if candidates is not None:
+            order = order[candidates[order]]
+
+        heap = []
+        n_scored = 0
+        block_size = max(4 * self.top_k, TOP_K_MIN_BLOCK)
+        for block_start in range(0, len(order), block_size):
+            if len(heap) == self.top_k and best_evalues[order[block_start]] >= -heap[0][0]:
+                break
+
+            block = order[block_start:block_start + block_size]
+            subset = np.zeros(len(self.db_models), dtype=bool)
+            subset[block] = True
+            n_scored += len(block)
+            for strand, hits in enumerate(self.score_strands(strands, subset)):
+                for db_index, hit in hits:
+                    # ties are broken by strand and database order, like in the
+                    # sorted output of a full scan
+                    item = (-hit[3], -strand, -db_index, hit)
+                    if len(heap) < self.top_k:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+
+        strand_hits = [[] for _ in strands]
+        for _, neg_strand, neg_db_index, hit in sorted(heap, key=lambda item: item[2],
+                                                       reverse=True):
+            strand_hits[-neg_strand].append((-neg_db_index, hit))
+        return strand_hits, n_scored
+
+    def evalue(self, sim, high_score, exp_lambda):
+        pvalue = self.highscore_fraction * np.exp(- exp_lambda * (sim - high_score))
+        return self.db_size * pvalue
+
+    def hit_threshold(self, high_score, exp_lambda):
+
+        # smallest similarity that can reach an e-value below the threshold
+        evalue_score = high_score + np.log(self.highscore_fraction * self.db_size
+                                           / self.evalue_threshold) / exp_lambda
+        return max(high_score, evalue_score)
+
+    def collect_hits(self, model_id, results, high_score, exp_lambda, n_perm):
+        sims, (starts1, ends1), (starts2, ends2), (bg_scores, cross_scores) = results
+
+        hits = []
+        # scores that are not in the top scores of the background model are
+        # surely not significant hits
+        for db_index in np.flatnonzero(sims >= high_score):
+            sim = sims[db_index]
+            hit_evalue = self.evalue(sim, high_score, exp_lambda)
+            if hit_evalue < self.evalue_threshold:
+                hit = (model_id, self.db_models.model_ids[db_index], sim, hit_evalue,
+                       starts1[db_index], ends1[db_index], starts2[db_index], ends2[db_index],
+                       max(bg_scores[db_index], 0), max(cross_scores[db_index], 0))
+                if self.adaptive_perm is not None:
+                    hit += (n_perm,)
+                hits.append((db_index, hit))
+        return hits
+
+
+def result_arrays(result):
+    # the arrays of a PackedModelDB.score result, in a flat list
+    scores, *pairs = result
+    return [scores] + [arr for pair in pairs for arr in pair]
+
+
+def reverse_complement(model):
+    rev_model = dict(model)
+    rev_model['model_id'] = model['model_id'] + '_rev'
+    # reverse complement the pwm
+    rev_model['pwm'] = model['pwm'][::-1, ::-1]
+
+    # entropy calculations simply reverse
+    rev_model['H_model_bg'] = model['H_model_bg'][::-1]
+    rev_model['H_model'] = model['H_model'][::-1]
+    return rev_model
+
+
+def new_split_query():
+    # the partial results of a query that is split into tiles
+    return {
+        'nulls': None, 'n_perm': 0, 'worker_busy': {}, 'tiles': 0, 'tiles_left': 0,
+        'strand_hits': [[], []], 'pairs': 0, 'scored': 0, 'rechecked': 0,
+        'null_s': 0.0, 'scan_s': 0.0,
+    }
+
+
+def hit_array(strand_hits, stats):
+
+    # the hits of one query as HIT_DTYPE array, sorted by e-value
+    model_id = stats['model_id']
+    rows = []
+    for strand, hits in enumerate(strand_hits):
+        for hit in hits:
+            # the reverse strand shares the forward null, unless it has its own
+            null = stats['nulls'].get(hit[0], stats['nulls'][model_id])
+            rows.append((model_id, hit[1], strand) + tuple(hit[2:10]) + (null[2],))
+    result = np.array(rows, dtype=HIT_DTYPE)
+    return result[np.argsort(result['evalue'], kind='stable')]
+
+
+# the searcher of a pool worker process
+searcher_g = None
+
+
+def _init_worker(db_handle, params):
+    global searcher_g
+    searcher_g = MotifSearcher(PackedModelDB.from_shared_memory(db_handle), **params)
+
+
+def _worker_search(model):
+    return searcher_g.motif_search(model)
+
+
+def _worker_search_chunk(models):
+    return [searcher_g.motif_search(model) for model in models]
+
+
+def _worker_fit_nulls(model):
+    return _fit_nulls_job(searcher_g, model)
+
+
+def _worker_permutation_tail(model, block):
+    return _permutation_tail_job(searcher_g, model, block)
+
+
+def _worker_scan(model, nulls, block):
+    return _scan_job(searcher_g, model, nulls, block)
+
+
+def _fit_nulls_job(searcher, model):
+    start = time.perf_counter()
+    nulls, n_perm = searcher.fit_strand_nulls(model)
+    return nulls, n_perm, time.perf_counter() - start, os.getpid()
+
+
+def _permutation_tail_job(searcher, model, block):
+    start = time.perf_counter()
+    tails = [searcher.permutation_tail(strand_model, block)
+             for strand_model in searcher.null_strand_models(model)]
+    return tails, time.perf_counter() - start, os.getpid()
+
+
+def _scan_job(searcher, model, nulls, block):
+    start = time.perf_counter()
+    n_rechecked = searcher.n_rechecked
+    strand_hits, n_pairs, n_scored = searcher.scan(model, nulls, block)
+    return (strand_hits, n_pairs, n_scored, searcher.n_rechecked - n_rechecked,
+            time.perf_counter() - start, os.getpid())
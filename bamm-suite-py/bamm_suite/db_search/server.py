@@ -0,0 +1,342 @@
+import argparse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+import numpy as np
+
+from bamm_suite.db_search.model_db import update_models
+from bamm_suite.db_search.search_index import load_packed_db
+from bamm_suite.db_search.db_search import add_search_arguments, search_params, load_null_model
+from bamm_suite.db_search.db_search import hit_header, hit_lines
+from bamm_suite.db_search.searcher import MotifSearcher
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='serve db_search requests from a database that is loaded once. '
+                    'POST a json list of models (like the input_models of db_search) to '
+                    '/search and get the hit rows of db_search back as tsv. '
+                    'GET /status describes the loaded database.'
+    )
+    parser.add_argument('model_db')
+    add_search_arguments(parser)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix_socket',
+                        help='listen on this unix socket instead of host and port')
+    parser.add_argument('--max_concurrent_requests', type=int, default=2,
+                        help='number of requests searched at the same time')
+    parser.add_argument('--max_queued_requests', type=int, default=32,
+                        help='number of requests waiting for a free slot, '
+                             'further requests are rejected with 503')
+    parser.add_argument('--max_queries', type=int, default=1000,
+                        help='maximum number of query models per request')
+    parser.add_argument('--reload_interval', type=float, default=10.0,
+                        help='seconds between checks whether the model db changed on disk')
+    return parser
+
+
+def db_file_stat(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class LoadedDatabase:
+
+    # a searcher with the prepared model database in shared memory and a warm
+    # pool of workers attached to it. Requests register as users, a database
+    # replaced by a reload is closed once its last user is done.
+
+    def __init__(self, args):
+        self.stat = db_file_stat(args.model_db)
+        db_models = load_packed_db(args.model_db, args.min_overlap, args.precision)
+        self.n_models = len(db_models)
+        self.alphabet_size = db_models.pwm_rows.shape[1]
+        self.db_size = args.db_size or self.n_models
+        db_checksum = None
+        if args.calibration_cache or args.null == 'precomputed':
+            db_checksum = db_models.checksum()
+        null_model = load_null_model(args, args.model_db, db_checksum)
+
+        params = dict(search_params(args), db_checksum=db_checksum, null_model=null_model)
+        self.searcher = MotifSearcher(db_models, n_processes=args.n_processes or 0, **params)
+        self.loaded_at = time.time()
+        self.n_users = 0
+        self.retired = False
+
+    def close(self):
+        # only called once no request uses the database anymore, so no
+        # jobs can be lost
+        self.searcher.close()
+
+
+class SearchBackend:
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.database = LoadedDatabase(args)
+
+    @contextmanager
+    def use_database(self):
+        with self.lock:
+            database = self.database
+            database.n_users += 1
+        try:
+            yield database
+        finally:
+            with self.lock:
+                database.n_users -= 1
+                close = database.retired and database.n_users == 0
+            if close:
+                database.close()
+
+    def reload_if_changed(self):
+        logger = logging.getLogger()
+        try:
+            changed = db_file_stat(self.args.model_db) != self.database.stat
+        except OSError:
+            # the database is being replaced, we check again later
+            return False
+        if not changed:
+            return False
+
+        logger.info('%s changed, reloading', self.args.model_db)
+        try:
+            database = LoadedDatabase(self.args)
+        except Exception:
+            logger.exception('reloading %s failed, keeping the loaded database',
+                             self.args.model_db)
+            return False
+
+        with self.lock:
+            old_database = self.database
+            self.database = database
+            old_database.retired = True
+            close = old_database.n_users == 0
+        if close:
+            old_database.close()
+        logger.info('Loaded %s models', database.n_models)
+        return True
+
+    def search(self, models):
+        with self.use_database() as database:
+            lines = ['\t'.join(hit_header(self.args.adaptive_neg_perm))]
+            for strand_hits, _ in database.searcher.map_search(models):
+                lines.extend(hit_lines(strand_hits))
+        return '\n'.join(lines) + '\n'
+
+    def alphabet_size(self):
+        with self.lock:
+            return self.database.alphabet_size
+
+    def status(self):
+        with self.lock:
+            database = self.database
+            return {
+                'model_db': self.args.model_db,
+                'n_models': database.n_models,
+                'alphabet_size': database.alphabet_size,
+                'db_size': database.db_size,
+                'loaded_at': database.loaded_at,
+            }
+
+    def close(self):
+        with self.lock:
+            database = self.database
+            database.retired = True
+            close = database.n_users == 0
+        if close:
+            database.close()
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RequestLimiter:
+
+    # at most max_concurrent requests are searched at the same time and at
+    # most max_queued further requests wait for a slot
+
+    def __init__(self, max_concurrent, max_queued):
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.n_pending = 0
+        self.max_pending = max_concurrent + max_queued
+
+    @contextmanager
+    def slot(self):
+        with self.lock:
+            if self.n_pending >= self.max_pending:
+                raise QueueFull()
+            self.n_pending += 1
+        try:
+            with self.slots:
+                yield
+        finally:
+            with self.lock:
+                self.n_pending -= 1
+
+
+def parse_models(body, max_queries, alphabet_size):
+
+    # the query models of a request body. Everything a client can get wrong
+    # is checked here and raises a ValueError, so that the search itself
+    # only sees well-formed models.
+    models = json.loads(body)
+    if isinstance(models, dict):
+        models = models.get('models')
+    if not isinstance(models, list) or not models:
+        raise ValueError('expected a non-empty list of models')
+    if len(models) > max_queries:
+        raise ValueError('at most %s models per request' % max_queries)
+    for index, model in enumerate(models):
+        if not isinstance(model, dict) or 'pwm' not in model or 'bg_freq' not in model:
+            raise ValueError('model %s needs a pwm and a bg_freq' % index)
+        model_id = model.setdefault('model_id', 'query_%s' % index)
+        if not isinstance(model_id, str):
+            raise ValueError('the model_id of model %s is not a string' % index)
+        model['pwm'] = probabilities(model['pwm'], 2, alphabet_size, 'pwm of %s' % model_id)
+        model['bg_freq'] = probabilities(model['bg_freq'], 1, alphabet_size,
+                                         'bg_freq of %s' % model_id)
+    return models
+
+
+def probabilities(values, ndim, alphabet_size, name):
+    # values as float array of ndim dimensions, with one probability per
+    # letter of the alphabet of the database in the last one
+    array = np.array(values, dtype=float)
+    if array.ndim != ndim or array.shape[-1] != alphabet_size or array.size == 0:
+        expected = '(length, %s)' % alphabet_size if ndim == 2 else '(%s,)' % alphabet_size
+        raise ValueError('the %s has shape %s, expected %s' % (name, array.shape, expected))
+    if not np.all(np.isfinite(array)) or np.any(array < 0):
+        raise ValueError('the %s holds negative or non-finite values' % name)
+    return array
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+
+    # backend, limiter and args are set on the subclass created in main
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_text(404, 'not found\n')
+            return
+        status = dict(self.backend.status(), pending_requests=self.limiter.n_pending)
+        self.send_text(200, json.dumps(status) + '\n', 'application/json')
+
+    def do_POST(self):
+        if self.path != '/search':
+            self.send_text(404, 'not found\n')
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            models = parse_models(self.rfile.read(length), self.args.max_queries,
+                                  self.backend.alphabet_size())
+            models = update_models(models, self.args.min_overlap)
+        except (ValueError, TypeError, KeyError) as error:
+            self.send_text(400, 'invalid request: %s\n' % error)
+            return
+
+        try:
+            with self.limiter.slot():
+                start = time.perf_counter()
+                result = self.backend.search(models)
+                logging.getLogger().info('Searched %s models in %.2fs', len(models),
+                                         time.perf_counter() - start)
+        except QueueFull:
+            self.send_text(503, 'too many pending requests\n', retry_after=1)
+            return
+        except Exception:
+            # the request was valid, so this is our fault. The handler
+            # thread has to answer anyway, the client would hang otherwise.
+            logging.getLogger().exception('search of %s models failed', len(models))
+            self.send_text(500, 'search failed\n')
+            return
+        self.send_text(200, result, 'text/tab-separated-values')
+
+    def send_text(self, code, text, content_type='text/plain', retry_after=None):
+        body = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.getLogger().info('%s %s', self.address_string(), format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger_fmt = '%(asctime)s [%(levelname)s]  %(message)s'
+    formatter = logging.Formatter(logger_fmt)
+    console_handler = logging.StreamHandler(stream=sys.stdout)
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+
+    backend = SearchBackend(args)
+    logger.info('Loaded %s models from %s', backend.database.n_models, args.model_db)
+
+    handler = type('Handler', (SearchRequestHandler,), {
+        'backend': backend,
+        'limiter': RequestLimiter(args.max_concurrent_requests, args.max_queued_requests),
+        'args': args,
+    })
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+        server = UnixHTTPServer(args.unix_socket, handler)
+        logger.info('Listening on %s', args.unix_socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        logger.info('Listening on http://%s:%s', args.host, server.server_address[1])
+
+    # requests are served from a thread, the main thread watches the
+    # database file and starts the worker pools of reloaded databases
+    def stop(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        while True:
+            time.sleep(args.reload_interval)
+            backend.reload_if_changed()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        backend.close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
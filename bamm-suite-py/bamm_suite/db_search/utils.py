@@ -1,24 +1,68 @@
 import numpy as np
 from scipy.special import xlogy
+import hashlib
 import operator
 
 loge2 = np.log(2)
+# relative difference below which two alignment scores count as a tie
+TIE_TOLERANCE = 1e-12
 
 
+# the entropy helpers work on a single pwm as well as on a stack of pwms
 def calculate_H_model_bg(model, bg):
-    H = xlogy(model, model).sum(axis=1) / loge2
+    H = xlogy(model, model).sum(axis=-1) / loge2
     H += xlogy(bg, bg).sum() / loge2
     H *= 0.5
     p_bar = 0.5 * (model + bg)
-    H -= xlogy(p_bar, p_bar).sum(axis=1) / loge2
+    H -= xlogy(p_bar, p_bar).sum(axis=-1) / loge2
     return H
 
 
 def calculate_H_model(model):
-    H = 0.5 * xlogy(model, model).sum(axis=1) / loge2
+    H = 0.5 * xlogy(model, model).sum(axis=-1) / loge2
     return H
 
 
+def create_permutations(model_len, n_perm, random_state=np.random):
+
+    # locality preserving permutations, one per row. Positions only move
+    # a few steps on average, so that the shuffled pwm keeps some of the
+    # correlation between neighbouring columns.
+    assert model_len > 1
+    Z = random_state.normal(0, 1, (n_perm, model_len))
+    return np.argsort(2 * Z - np.arange(model_len), axis=1)
+
+
+def query_seed(seed, pwm):
+
+    # every query gets its own random stream, derived from its pwm, so that
+    # its null does not depend on the worker, the number of processes or
+    # the sharding
+    sha = hashlib.sha1(str(seed).encode())
+    sha.update(np.ascontiguousarray(pwm, dtype=float).tobytes())
+    return int.from_bytes(sha.digest()[:4], 'little')
+
+
+def shard_range(n_items, shard):
+    index, n_shards = shard
+    return (index - 1) * n_items // n_shards, index * n_items // n_shards
+
+
+def fit_exp_tail(sorted_null, highscore_fraction, n_neg=None):
+
+    # we are fitting only the tail of the null scores with an exponential
+    # distribution. sorted_null may hold only the largest of n_neg scores.
+    N_neg = len(sorted_null) if n_neg is None else n_neg
+    high_scores = sorted_null[-int(N_neg * highscore_fraction):]
+    high_score = high_scores[0]
+    exp_lambda = 1 / np.mean(high_scores - high_score)
+    return high_score, exp_lambda
+
+
+def fit_converged(old_fit, new_fit, rel_tol):
+    return all(abs(new - old) <= rel_tol * abs(old) for old, new in zip(old_fit, new_fit))
+
+
 def create_slices(m, n, min_overlap):
 
     # m, n are the lengths of the patterns
@@ -40,6 +84,38 @@ def create_slices(m, n, min_overlap):
         yield slice(-ov, None), slice(0, ov)
 
 
+def create_offsets(m, n, min_overlap):
+
+    # vectorized counterpart of create_slices: returns the start positions
+    # in both patterns and the overlap length of every alignment, in the
+    # order create_slices would yield them
+    assert m >= n
+
+    if n < min_overlap:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, empty
+
+    n_inner = m - n + 1
+    ov = np.arange(min_overlap, n)
+    n_slices = n_inner + 2 * len(ov)
+
+    start1 = np.zeros(n_slices, dtype=int)
+    start2 = np.zeros(n_slices, dtype=int)
+    length = np.empty(n_slices, dtype=int)
+
+    # the shorter pattern shifted inside the longer pattern
+    start1[:n_inner] = np.arange(n_inner)
+    length[:n_inner] = n
+
+    # overlapping the left and the right edge, alternating
+    start2[n_inner::2] = n - ov
+    length[n_inner::2] = ov
+    start1[n_inner + 1::2] = m - ov
+    length[n_inner + 1::2] = ov
+
+    return start1, start2, length
+
+
 def model_sim(model1, model2, H_model1_bg, H_model2_bg, H_model1, H_model2, min_overlap=2):
 
     models_switched = False
@@ -89,3 +165,63 @@ def model_sim(model1, model2, H_model1_bg, H_model2_bg, H_model1, H_model2, min_
         return max_score, (start2 + 1, end2), (start1 + 1, end1), contrib
     else:
         return max_score, (start1 + 1, end1), (start2 + 1, end2), contrib
+
+
+def prefix_sum(H):
+    cum_H = np.zeros(len(H) + 1, dtype=H.dtype)
+    np.cumsum(H, out=cum_H[1:])
+    return cum_H
+
+
+def model_sim_vectorized(model1, model2, H_model1_bg, H_model2_bg, H_model1, H_model2,
+                         min_overlap=2):
+
+    # drop-in replacement for model_sim that scores all alignments at once
+
+    models_switched = False
+
+    # my design model2 cannot be longer than model1
+    if len(model1) < len(model2):
+        model1, model2 = model2, model1
+        H_model1_bg, H_model2_bg = H_model2_bg, H_model1_bg
+        H_model1, H_model2 = H_model2, H_model1
+        models_switched = True
+
+    m, n = len(model1), len(model2)
+    start1, start2, length = create_offsets(m, n, min_overlap)
+    end1 = start1 + length
+    end2 = start2 + length
+
+    # slice sums of the entropies are differences of prefix sums
+    cum1_bg, cum2_bg = prefix_sum(H_model1_bg), prefix_sum(H_model2_bg)
+    background_scores = cum1_bg[end1] - cum1_bg[start1] + cum2_bg[end2] - cum2_bg[start2]
+    cum1, cum2 = prefix_sum(H_model1), prefix_sum(H_model2)
+    cross_scores = cum1[end1] - cum1[start1] + cum2[end2] - cum2[start2]
+
+    # the cross entropy of every pair of rows in one go. Each alignment is
+    # a diagonal of the (m, n) matrix, so we sum up along the diagonals.
+    p_bar = 0.5 * (model1[:, np.newaxis, :] + model2[np.newaxis, :, :])
+    pair_entropy = xlogy(p_bar, p_bar).sum(axis=2) / loge2
+    diagonals = np.subtract.outer(np.arange(m), np.arange(n)) + n - 1
+    diag_entropy = np.bincount(diagonals.ravel(), weights=pair_entropy.ravel(),
+                               minlength=m + n - 1)
+    cross_scores -= diag_entropy[start1 - start2 + n - 1]
+
+    scores = background_scores - cross_scores
+    # the first maximum in create_slices order, just like max() in
+    # model_sim. The sums are taken in a different order than in model_sim,
+    # so scores within TIE_TOLERANCE of the maximum count as tied.
+    max_score = scores.max()
+    is_max = scores >= max_score - TIE_TOLERANCE * max(abs(max_score), 1)
+    max_index = np.argmax(is_max)
+    max_score = scores[max_index]
+
+    start1, end1 = int(start1[max_index]), int(end1[max_index])
+    start2, end2 = int(start2[max_index]), int(end2[max_index])
+
+    contrib = background_scores[max_index], cross_scores[max_index]
+
+    if models_switched:
+        return max_score, (start2 + 1, end2), (start1 + 1, end1), contrib
+    else:
+        return max_score, (start1 + 1, end1), (start2 + 1, end2), contrib
@@ -0,0 +1,153 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from bamm_suite.db_search.candidates import CandidateIndex, KMER_LENGTH
+from bamm_suite.db_search.model_db import load_models, update_models
+from bamm_suite.db_search.packed_db import PackedModelDB
+from bamm_suite.db_search.searcher import MotifSearcher
+
+from run_benchmarks import prepare
+from synthetic_db import synthetic_models
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='recall of the approximate db_search (--candidates) against the exhaustive '
+                    'search for a range of candidate budgets, to choose a budget. By default '
+                    'the queries are noisy pieces of models of a synthetic database, so that '
+                    'they have hits beyond chance.'
+    )
+    parser.add_argument('--output_file', default='candidate_recall.json')
+    parser.add_argument('--model_db', help='use this model database instead of synthetic models')
+    parser.add_argument('--input_models', help='use these queries instead of synthetic models')
+    parser.add_argument('--n_db_models', type=int, default=2000)
+    parser.add_argument('--n_queries', type=int, default=32)
+    parser.add_argument('--min_length', type=int, default=6)
+    parser.add_argument('--max_length', type=int, default=25)
+    parser.add_argument('--noise', type=float, default=0.2,
+                        help='weight of the random columns mixed into the synthetic queries')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--evalue_threshold', type=float, default=0.1)
+    parser.add_argument('--kmer_length', type=int, default=KMER_LENGTH)
+    parser.add_argument('--candidates', type=int, nargs='+', default=[10, 30, 100, 300, 1000],
+                        help='candidate budgets to report')
+    return parser
+
+
+def related_queries(db_json, n_queries, min_length, noise, seed):
+
+    # a random piece of at least min_length columns of a random database
+    # model, mixed with random columns and on a random strand
+    random_state = np.random.RandomState(seed)
+    queries = []
+    for query_index in range(n_queries):
+        model = db_json[random_state.randint(len(db_json))]
+        pwm = np.array(model['pwm'])
+        length = random_state.randint(min(min_length, len(pwm)), len(pwm) + 1)
+        start = random_state.randint(len(pwm) - length + 1)
+        pwm = (1 - noise) * pwm[start:start + length] \
+            + noise * random_state.dirichlet(np.ones(4), size=length)
+        if random_state.rand() < 0.5:
+            pwm = pwm[::-1, ::-1]
+        queries.append({
+            'model_id': 'query_%s_%s' % (query_index, model['model_id']),
+            'pwm': pwm.tolist(),
+            'bg_freq': model['bg_freq'],
+        })
+    return queries
+
+
+def run_search(searcher, queries):
+
+    # the hits of all queries by (query, database model, strand) and the
+    # search time
+    start = time.perf_counter()
+    hits = {}
+    for query in queries:
+        strand_hits, _ = searcher.motif_search(query)
+        for strand, strand_hit_list in enumerate(strand_hits):
+            for hit in strand_hit_list:
+                hits[(query['model_id'], hit[1], strand)] = hit
+    return hits, time.perf_counter() - start
+
+
+def query_nulls(searcher, queries):
+    # the nulls of all queries, so that the searches to compare only scan
+    stored_nulls = {}
+    for query in queries:
+        _, stats = searcher.motif_search(query)
+        stored_nulls.update(stats['nulls'])
+    return stored_nulls
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.model_db:
+        db_models = update_models(load_models(args.model_db), 4)
+    else:
+        db_json = synthetic_models(args.n_db_models, args.min_length, args.max_length,
+                                   seed=args.seed)
+        db_models = prepare(db_json)
+    if args.input_models:
+        queries = update_models(load_models(args.input_models), 4)
+    elif args.model_db:
+        parser.error('--model_db needs --input_models')
+    else:
+        queries = prepare(related_queries(db_json, args.n_queries, args.min_length, args.noise,
+                                          args.seed + 1))
+
+    packed_db = PackedModelDB(db_models)
+    start = time.perf_counter()
+    candidate_index = CandidateIndex.build(packed_db, args.kmer_length)
+    build_s = time.perf_counter() - start
+
+    params = {'evalue_threshold': args.evalue_threshold,
+              'stored_nulls': query_nulls(MotifSearcher(packed_db), queries)}
+    exhaustive, exhaustive_s = run_search(MotifSearcher(packed_db, **params), queries)
+    report = {
+        'config': vars(args),
+        'candidate_index_build_s': build_s,
+        'exhaustive': {'hits': len(exhaustive), 'scan_s': exhaustive_s},
+        'candidates': [],
+    }
+    print('exhaustive           %6s hits  scan %.2fs' % (len(exhaustive), exhaustive_s))
+
+    for n_candidates in args.candidates:
+        searcher = MotifSearcher(packed_db, candidate_index=candidate_index,
+                                 n_candidates=n_candidates, **params)
+        hits, search_s = run_search(searcher, queries)
+        found = exhaustive.keys() & hits.keys()
+        query_recall = []
+        for query in queries:
+            query_hits = [key for key in exhaustive if key[0] == query['model_id']]
+            if query_hits:
+                query_recall.append(np.mean([key in found for key in query_hits]))
+        result = {
+            'n_candidates': n_candidates,
+            'hits': len(hits),
+            # hits that are not in the exhaustive search, always 0
+            'extra': len(hits.keys() - exhaustive.keys()),
+            'recall': len(found) / max(len(exhaustive), 1),
+            'min_query_recall': min(query_recall, default=1.0),
+            'queries_with_full_recall': int(np.sum(np.array(query_recall) == 1.0)),
+            'queries_with_hits': len(query_recall),
+            'scan_s': search_s,
+            'speedup': exhaustive_s / search_s,
+        }
+        report['candidates'].append(result)
+        print('%5s candidates %6s hits  recall %.3f  full recall %s/%s queries  '
+              'scan %.2fs (%.1fx)' % (n_candidates, result['hits'], result['recall'],
+                                      result['queries_with_full_recall'],
+                                      result['queries_with_hits'], search_s, result['speedup']))
+
+    with open(args.output_file, 'w') as out:
+        json.dump(report, out, indent=4)
+
+
+if __name__ == '__main__':
+    main()
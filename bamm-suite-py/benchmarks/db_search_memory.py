@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic_db import synthetic_models
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='peak memory of db_search for different numbers of processes'
+    )
+    parser.add_argument('--n_processes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--n_db_models', type=int, default=20000)
+    parser.add_argument('--n_queries', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output_file', help='write the results as json')
+    return parser
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child in _children(pid):
+        pids.extend(process_tree(child))
+    return pids
+
+
+def _children(pid):
+    children = []
+    try:
+        with os.scandir('/proc/%s/task' % pid) as tasks:
+            for task in tasks:
+                with open(os.path.join(task.path, 'children')) as handle:
+                    children.extend(int(child) for child in handle.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def _memory_kb(pid, field):
+    try:
+        with open('/proc/%s/smaps_rollup' % pid) as handle:
+            for line in handle:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def measure(cmd, interval=0.05):
+
+    # the proportional set size (pss) splits shared pages between the
+    # processes that map them, so the sum over the process tree is the real
+    # memory footprint. The summed rss counts shared pages once per process.
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    peak_pss = peak_rss = 0
+    start = time.perf_counter()
+    while proc.poll() is None:
+        pids = process_tree(proc.pid)
+        peak_pss = max(peak_pss, sum(_memory_kb(pid, 'Pss') for pid in pids))
+        peak_rss = max(peak_rss, sum(_memory_kb(pid, 'Rss') for pid in pids))
+        time.sleep(interval)
+    runtime = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError('db_search failed with exit code %s' % proc.returncode)
+    return {'peak_pss_mb': peak_pss / 1024, 'peak_rss_mb': peak_rss / 1024, 'runtime_s': runtime}
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, 'db.json')
+        query_file = os.path.join(tmp_dir, 'queries.json')
+        with open(db_file, 'w') as out:
+            json.dump(synthetic_models(args.n_db_models, seed=args.seed), out)
+        with open(query_file, 'w') as out:
+            json.dump(synthetic_models(args.n_queries, seed=args.seed + 1, id_prefix='query'), out)
+
+        for n_processes in args.n_processes:
+            cmd = [sys.executable, '-m', 'bamm_suite.db_search.db_search', query_file, db_file,
+                   os.path.join(tmp_dir, 'hits.tsv'), '--n_processes', str(n_processes)]
+            result = measure(cmd)
+            result['n_processes'] = n_processes
+            results.append(result)
+            print('n_processes={n_processes}\tpeak_pss={peak_pss_mb:.1f}MB\t'
+                  'peak_rss={peak_rss_mb:.1f}MB\truntime={runtime_s:.1f}s'.format(**result))
+
+    if args.output_file:
+        with open(args.output_file, 'w') as out:
+            json.dump(results, out, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from bamm_suite.db_search.model_db import load_models, update_models
+from bamm_suite.db_search.packed_db import PackedModelDB
+from bamm_suite.db_search.searcher import MotifSearcher, reverse_complement
+
+from run_benchmarks import prepare
+from synthetic_db import synthetic_models
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='compare the float32 scan of db_search with the float64 scan on a '
+                    'synthetic model database: deviation of the raw scores, of the e-values '
+                    'of the hits and the hits gained or lost with and without the float64 '
+                    'recheck near the threshold'
+    )
+    parser.add_argument('--output_file', default='precision_report.json')
+    parser.add_argument('--model_db', help='use this model database instead of synthetic models')
+    parser.add_argument('--input_models', help='use these queries instead of synthetic models')
+    parser.add_argument('--n_db_models', type=int, default=2000)
+    parser.add_argument('--n_queries', type=int, default=16)
+    parser.add_argument('--min_length', type=int, default=6)
+    parser.add_argument('--max_length', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--evalue_threshold', type=float, default=0.1)
+    return parser
+
+
+def score_deviation(db64, db32, queries):
+
+    # largest absolute and relative difference of the best alignment scores
+    # of both strands against every database model
+    max_abs = 0.0
+    max_rel = 0.0
+    for query in queries:
+        rev_query = reverse_complement(query)
+        stacked = [np.stack([query[key], rev_query[key]]) for key in ('pwm', 'H_model_bg', 'H_model')]
+        scores64 = db64.score(*stacked, min_overlap=4)[0]
+        scores32 = db32.score(*stacked, min_overlap=4)[0]
+        finite = np.isfinite(scores64)
+        diff = np.abs(scores64[finite] - scores32[finite])
+        if len(diff):
+            max_abs = max(max_abs, float(diff.max()))
+            max_rel = max(max_rel, float((diff / np.maximum(np.abs(scores64[finite]), 1.0)).max()))
+    return {'max_abs_score_deviation': max_abs, 'max_rel_score_deviation': max_rel}
+
+
+def run_search(searcher, queries):
+    start = time.perf_counter()
+    hits = {}
+    for query in queries:
+        strand_hits, _ = searcher.motif_search(query)
+        for strand, strand_hit_list in enumerate(strand_hits):
+            for hit in strand_hit_list:
+                hits[(hit[0], hit[1], strand)] = hit
+    return hits, time.perf_counter() - start
+
+
+def compare_hits(hits64, hits32):
+    common = hits64.keys() & hits32.keys()
+    evalue_deviation = [abs(hits32[key][3] - hits64[key][3]) / hits64[key][3] for key in common]
+    score_deviation = [abs(hits32[key][2] - hits64[key][2]) for key in common]
+    return {
+        'hits_float64': len(hits64),
+        'hits_float32': len(hits32),
+        'lost': len(hits64.keys() - hits32.keys()),
+        'gained': len(hits32.keys() - hits64.keys()),
+        'max_rel_evalue_deviation': max(evalue_deviation, default=0.0),
+        'max_abs_hit_score_deviation': max(score_deviation, default=0.0),
+    }
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.model_db:
+        db_models = update_models(load_models(args.model_db), 4)
+    else:
+        db_models = prepare(synthetic_models(args.n_db_models, args.min_length, args.max_length,
+                                             seed=args.seed))
+    if args.input_models:
+        queries = update_models(load_models(args.input_models), 4)
+    else:
+        queries = prepare(synthetic_models(args.n_queries, args.min_length, args.max_length,
+                                           seed=args.seed + 1, id_prefix='query'))
+
+    db64 = PackedModelDB(db_models)
+    db32 = db64.astype(np.float32)
+    report = {'config': vars(args), 'scores': score_deviation(db64, db32, queries)}
+
+    # every model is scored, so that the comparison covers the scores below
+    # the pruning bounds as well
+    params = {'evalue_threshold': args.evalue_threshold, 'prune': False}
+    hits64, time64 = run_search(MotifSearcher(db64, **params), queries)
+    searcher32 = MotifSearcher(db32, **params)
+    hits32, time32 = run_search(searcher32, queries)
+    no_recheck_hits32, _ = run_search(MotifSearcher(db32, recheck_tolerance=-1.0, **params),
+                                      queries)
+
+    report['search'] = dict(compare_hits(hits64, hits32), rechecked=searcher32.n_rechecked,
+                            float64_s=time64, float32_s=time32)
+    report['search_without_recheck'] = compare_hits(hits64, no_recheck_hits32)
+
+    print('max score deviation        %.3g (relative %.3g)'
+          % (report['scores']['max_abs_score_deviation'],
+             report['scores']['max_rel_score_deviation']))
+    for name in ('search', 'search_without_recheck'):
+        result = report[name]
+        print('%-26s %s hits, %s lost, %s gained, max e-value deviation %.3g'
+              % (name, result['hits_float32'], result['lost'], result['gained'],
+                 result['max_rel_evalue_deviation']))
+    print('rechecked in float64       %s of %s query-model pairs'
+          % (searcher32.n_rechecked, len(queries) * len(db_models)))
+    print('search time                float64 %.2fs  float32 %.2fs' % (time64, time32))
+
+    with open(args.output_file, 'w') as out:
+        json.dump(report, out, indent=4)
+
+
+if __name__ == '__main__':
+    main()
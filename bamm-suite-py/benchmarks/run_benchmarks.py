@@ -0,0 +1,220 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import scipy
+
+from bamm_suite import __version__
+from bamm_suite.db_search.packed_db import PackedModelDB
+from bamm_suite.db_search.searcher import MotifSearcher
+from bamm_suite.db_search.utils import calculate_H_model_bg, calculate_H_model
+from bamm_suite.db_search.utils import create_slices, create_offsets, create_permutations
+from bamm_suite.db_search.utils import model_sim, model_sim_vectorized
+
+from db_search_memory import measure
+from synthetic_db import synthetic_models
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='time the db_search hot paths on a synthetic model database'
+    )
+    parser.add_argument('--output_file', default='benchmark_results.json')
+    parser.add_argument('--n_db_models', type=int, default=2000)
+    parser.add_argument('--n_queries', type=int, default=16)
+    parser.add_argument('--min_length', type=int, default=6)
+    parser.add_argument('--max_length', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='repetitions per micro benchmark, the best one is reported')
+    parser.add_argument('--n_processes', type=int, nargs='+', default=[1, 2, 4],
+                        help='process counts for the end-to-end runs')
+    parser.add_argument('--skip_end_to_end', action='store_true')
+    return parser
+
+
+def prepare(models):
+    for model in models:
+        model['pwm'] = np.array(model['pwm'], dtype=float)
+        model['bg_freq'] = np.array(model['bg_freq'], dtype=float)
+        model['H_model_bg'] = calculate_H_model_bg(model['pwm'], model['bg_freq'])
+        model['H_model'] = calculate_H_model(model['pwm'])
+    return models
+
+
+def time_call(func, n_calls, repeat):
+
+    # runs func n_calls times per repetition and reports the fastest
+    # repetition, which is the least disturbed by other load on the machine
+    times = timeit.repeat(func, number=1, repeat=repeat)
+    best = min(times)
+    return {
+        'n_calls': n_calls,
+        'best_s': best,
+        'mean_s': float(np.mean(times)),
+        'calls_per_s': n_calls / best,
+    }
+
+
+def micro_benchmarks(db_models, queries, repeat):
+    results = {}
+    pairs = [(query, db_models[index]) for index, query in enumerate(queries)]
+    n_pairs = len(pairs)
+
+    def run_model_sim(sim_func):
+        def run():
+            for query, model in pairs:
+                sim_func(query['pwm'], model['pwm'], query['H_model_bg'], model['H_model_bg'],
+                         query['H_model'], model['H_model'], min_overlap=4)
+        return run
+
+    results['model_sim'] = time_call(run_model_sim(model_sim), n_pairs, repeat)
+    results['model_sim_vectorized'] = time_call(run_model_sim(model_sim_vectorized),
+                                                n_pairs, repeat)
+
+    def run_create_slices():
+        for query, model in pairs:
+            m, n = sorted([len(query['pwm']), len(model['pwm'])], reverse=True)
+            for _ in create_slices(m, n, 4):
+                pass
+    results['create_slices'] = time_call(run_create_slices, n_pairs, repeat)
+
+    def run_create_offsets():
+        for query, model in pairs:
+            m, n = sorted([len(query['pwm']), len(model['pwm'])], reverse=True)
+            create_offsets(m, n, 4)
+    results['create_offsets'] = time_call(run_create_offsets, n_pairs, repeat)
+
+    def run_entropies(entropy_func):
+        def run():
+            for model in db_models:
+                if entropy_func is calculate_H_model_bg:
+                    entropy_func(model['pwm'], model['bg_freq'])
+                else:
+                    entropy_func(model['pwm'])
+        return run
+    results['calculate_H_model_bg'] = time_call(run_entropies(calculate_H_model_bg),
+                                                len(db_models), repeat)
+    results['calculate_H_model'] = time_call(run_entropies(calculate_H_model),
+                                             len(db_models), repeat)
+
+    packed_db = PackedModelDB(db_models)
+    results['packed_db_build'] = time_call(lambda: PackedModelDB(db_models), 1, repeat)
+
+    def run_score():
+        for query in queries:
+            packed_db.score(query['pwm'], query['H_model_bg'], query['H_model'], min_overlap=4)
+    results['packed_db_score'] = time_call(run_score, len(queries), repeat)
+    results['packed_db_score']['pairs_per_s'] = (results['packed_db_score']['calls_per_s']
+                                                 * len(packed_db))
+
+    n_perm = 10
+    random_state = np.random.RandomState(0)
+    stacks = []
+    for query in queries:
+        shuffled = query['pwm'][create_permutations(len(query['pwm']), n_perm, random_state)]
+        stacks.append((shuffled, calculate_H_model_bg(shuffled, query['bg_freq']),
+                       calculate_H_model(shuffled)))
+
+    def run_score_batch():
+        for pwms, H_bg, H in stacks:
+            packed_db.score_batch(pwms, H_bg, H, min_overlap=4)
+    results['packed_db_score_batch'] = time_call(run_score_batch, len(queries), repeat)
+    results['packed_db_score_batch']['pairs_per_s'] = (
+        results['packed_db_score_batch']['calls_per_s'] * len(packed_db) * n_perm
+    )
+
+    def run_upper_bounds():
+        for query in queries:
+            packed_db.upper_bounds(query['H_model_bg'], query['bg_freq'])
+    results['packed_db_upper_bounds'] = time_call(run_upper_bounds, len(queries), repeat)
+
+    return results
+
+
+def motif_search_benchmark(db_models, queries, repeat):
+
+    # a searcher with the default search parameters, in this process
+    searcher = MotifSearcher(PackedModelDB(db_models))
+
+    def run():
+        for query in queries:
+            searcher.motif_search(query)
+    result = time_call(run, len(queries), repeat)
+    result['pairs_per_s'] = result['calls_per_s'] * 2 * len(db_models)
+    return result
+
+
+def end_to_end_benchmarks(db_file, query_file, n_db_models, n_queries, n_processes_list, tmp_dir):
+    results = []
+    for n_processes in n_processes_list:
+        cmd = [sys.executable, '-m', 'bamm_suite.db_search.db_search', query_file, db_file,
+               os.path.join(tmp_dir, 'hits.tsv'), '--n_processes', str(n_processes)]
+        result = measure(cmd)
+        result['n_processes'] = n_processes
+        # both strands of every query against every database model
+        result['pairs_per_s'] = 2 * n_queries * n_db_models / result['runtime_s']
+        results.append(result)
+    return results
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    db_json = synthetic_models(args.n_db_models, args.min_length, args.max_length, seed=args.seed)
+    query_json = synthetic_models(args.n_queries, args.min_length, args.max_length,
+                                  seed=args.seed + 1, id_prefix='query')
+
+    results = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'bamm_suite_version': __version__,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'config': vars(args),
+        },
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, 'db.json')
+        query_file = os.path.join(tmp_dir, 'queries.json')
+        with open(db_file, 'w') as out:
+            json.dump(db_json, out)
+        with open(query_file, 'w') as out:
+            json.dump(query_json, out)
+
+        db_models = prepare(db_json)
+        queries = prepare(query_json)
+
+        results['micro'] = micro_benchmarks(db_models, queries, args.repeat)
+        for name, result in results['micro'].items():
+            print('%-24s %12.1f calls/s' % (name, result['calls_per_s']))
+
+        results['motif_search'] = motif_search_benchmark(db_models, queries, args.repeat)
+        print('%-24s %12.1f pairs/s' % ('motif_search', results['motif_search']['pairs_per_s']))
+
+        if not args.skip_end_to_end:
+            results['end_to_end'] = end_to_end_benchmarks(
+                db_file, query_file, args.n_db_models, args.n_queries, args.n_processes, tmp_dir
+            )
+            for result in results['end_to_end']:
+                print('db_search n_processes=%-3s %12.1f pairs/s  peak rss %.1fMB  peak pss %.1fMB'
+                      % (result['n_processes'], result['pairs_per_s'],
+                         result['peak_rss_mb'], result['peak_pss_mb']))
+
+    with open(args.output_file, 'w') as out:
+        json.dump(results, out, indent=4)
+
+
+if __name__ == '__main__':
+    main()
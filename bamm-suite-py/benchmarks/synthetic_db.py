@@ -0,0 +1,46 @@
+import argparse
+import json
+
+import numpy as np
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='generate a random pwm model database')
+    parser.add_argument('output_file')
+    parser.add_argument('--n_models', type=int, default=1000)
+    parser.add_argument('--min_length', type=int, default=6)
+    parser.add_argument('--max_length', type=int, default=25)
+    parser.add_argument('--concentration', type=float, default=0.5,
+                        help='dirichlet concentration of the pwm columns, small values give '
+                             'more informative columns')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def synthetic_models(n_models, min_length=6, max_length=25, concentration=0.5, seed=0,
+                     id_prefix='synthetic'):
+    random_state = np.random.RandomState(seed)
+    models = []
+    for model_index in range(n_models):
+        length = random_state.randint(min_length, max_length + 1)
+        pwm = random_state.dirichlet(np.full(4, concentration), size=length)
+        models.append({
+            'model_id': '%s_%s' % (id_prefix, model_index),
+            'pwm': pwm.tolist(),
+            'bg_freq': [0.25, 0.25, 0.25, 0.25],
+        })
+    return models
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    models = synthetic_models(args.n_models, args.min_length, args.max_length,
+                              args.concentration, args.seed)
+    with open(args.output_file, 'w') as out:
+        json.dump(models, out)
+
+
+if __name__ == '__main__':
+    main()
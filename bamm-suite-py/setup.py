@@ -14,6 +14,12 @@ setup(
             # standalone scripts
             'db_search = bamm_suite.db_search.db_search:main',
             'meme2models = bamm_suite.db_search.meme2models:main',
+            'db_null_model = bamm_suite.db_search.null_model:main',
+            'db_convert = bamm_suite.db_search.model_db:main',
+            'db_all_vs_all = bamm_suite.db_search.all_vs_all:main',
+            'db_search_merge = bamm_suite.db_search.merge:main',
+            'db_search_server = bamm_suite.db_search.server:main',
+            'db_search_query = bamm_suite.db_search.result_store:main',
         ]
     },
     packages=find_packages(),
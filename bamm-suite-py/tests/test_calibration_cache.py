@@ -0,0 +1,58 @@
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from bamm_suite.db_search.calibration_cache import CalibrationCache
+
+
+class CalibrationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pwm = np.random.RandomState(0).dirichlet(np.ones(4), size=8)
+        self.bg_freq = np.full(4, 0.25)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_hit_and_miss(self):
+        cache = CalibrationCache(self.tmp_dir.name)
+        key = cache.key(self.pwm, self.bg_freq, 'checksum', n_neg_perm=10, seed=42)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, np.float64(3.5), 1.25, np.int64(40))
+        self.assertEqual(cache.get(key), (3.5, 1.25, 40))
+
+        # the key covers the pwm, the database and every parameter
+        for other_key in (
+                cache.key(self.pwm[::-1], self.bg_freq, 'checksum', n_neg_perm=10, seed=42),
+                cache.key(self.pwm, self.bg_freq, 'other checksum', n_neg_perm=10, seed=42),
+                cache.key(self.pwm, self.bg_freq, 'checksum', n_neg_perm=20, seed=42)):
+            self.assertNotEqual(other_key, key)
+            self.assertIsNone(cache.get(other_key))
+        self.assertEqual(cache.key(self.pwm.copy(), self.bg_freq, 'checksum', seed=42,
+                                   n_neg_perm=10), key)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = CalibrationCache(self.tmp_dir.name, max_entries=2)
+        keys = [cache.key(self.pwm, self.bg_freq, 'checksum', seed=seed) for seed in range(3)]
+        cache.put(keys[0], 1.0, 1.0, 10)
+        cache.put(keys[1], 2.0, 1.0, 10)
+        # the first entry was last used 50 minutes ago, the second an hour ago
+        now = time.time()
+        os.utime(os.path.join(self.tmp_dir.name, keys[0] + '.json'), (now - 3000, now - 3000))
+        os.utime(os.path.join(self.tmp_dir.name, keys[1] + '.json'), (now - 3600, now - 3600))
+
+        # using the older entry makes the other one the least recently used
+        self.assertEqual(cache.get(keys[1]), (2.0, 1.0, 10))
+        cache.put(keys[2], 3.0, 1.0, 10)
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertEqual(cache.get(keys[1]), (2.0, 1.0, 10))
+        self.assertEqual(cache.get(keys[2]), (3.0, 1.0, 10))
+        self.assertEqual(len(os.listdir(self.tmp_dir.name)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
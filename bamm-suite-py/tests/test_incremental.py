@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from bamm_suite.db_search.incremental import load_search_state
+from bamm_suite.db_search.model_db import load_models, update_models
+from bamm_suite.db_search.packed_db import PackedModelDB
+from bamm_suite.db_search.searcher import MotifSearcher
+
+from test_sharding import write_random_models
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_db_search(*args):
+    return subprocess.run([sys.executable, '-m', 'bamm_suite.db_search.db_search'] + list(args),
+                          cwd=PACKAGE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+def read_hits(path):
+    with open(path) as handle:
+        handle.readline()
+        return [line.rstrip('\n').split('\t') for line in handle]
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.queries = self.path('queries.json')
+        self.old_db = self.path('old_db.json')
+        self.new_db = self.path('new_db.json')
+        write_random_models(self.queries, 5, seed=5, prefix='query')
+        write_random_models(self.old_db, 150, seed=6, prefix='old')
+        write_random_models(self.new_db, 60, seed=7, prefix='new')
+        self.previous = self.path('previous.tsv')
+        completed = run_db_search(self.queries, self.old_db, self.previous, '--save_state',
+                                  '--evalue_threshold', '10', '--n_processes', '1')
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_extended_results_equal_a_search_of_the_combined_db(self):
+        extended = self.path('extended.tsv')
+        completed = run_db_search(self.queries, self.new_db, extended,
+                                  '--previous_results', self.previous,
+                                  '--evalue_threshold', '10', '--n_processes', '1')
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+
+        # the incremental run keeps the nulls of the previous run, so the
+        # reference searches the combined database with the same nulls
+        combined = update_models(list(load_models(self.old_db)) + list(load_models(self.new_db)),
+                                 4)
+        searcher = MotifSearcher(PackedModelDB(combined), evalue_threshold=10.0,
+                                 stored_nulls=load_search_state(self.previous)['nulls'])
+        expected = []
+        for query in update_models(list(load_models(self.queries)), 4):
+            strand_hits, _ = searcher.motif_search(query)
+            for hits in strand_hits:
+                expected.extend(sorted(hits, key=lambda hit: hit[3]))
+
+        hits = read_hits(extended)
+        self.assertEqual([hit[:2] for hit in hits], [list(hit[:2]) for hit in expected])
+        for hit, expected_hit in zip(hits, expected):
+            self.assertEqual(float(hit[2]), expected_hit[2])
+            self.assertAlmostEqual(float(hit[3]) / expected_hit[3], 1.0, places=9)
+        self.assertTrue(any(hit[1].startswith('old') for hit in hits))
+        self.assertTrue(any(hit[1].startswith('new') for hit in hits))
+        self.assertEqual(load_search_state(extended)['db_size'], 210)
+
+    def test_incompatible_previous_results_fail_before_the_search(self):
+        extended = self.path('extended.tsv')
+        completed = run_db_search(self.queries, self.new_db, extended,
+                                  '--previous_results', self.previous, '--min_overlap', '5')
+        self.assertNotEqual(completed.returncode, 0)
+        self.assertIn('min_overlap=4', completed.stderr)
+        self.assertFalse(os.path.exists(extended))
+
+        completed = run_db_search(self.queries, self.new_db, extended,
+                                  '--previous_results', self.previous, '--adaptive_neg_perm')
+        self.assertNotEqual(completed.returncode, 0)
+        self.assertIn('has the columns', completed.stderr)
+        self.assertFalse(os.path.exists(extended))
+
+
+if __name__ == '__main__':
+    unittest.main()
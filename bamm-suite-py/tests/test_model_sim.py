@@ -0,0 +1,78 @@
+import unittest
+
+import numpy as np
+
+from bamm_suite.db_search.utils import calculate_H_model_bg, calculate_H_model
+from bamm_suite.db_search.utils import model_sim, model_sim_vectorized
+
+
+def random_model(random_state, length, concentration=0.5):
+    pwm = random_state.dirichlet(np.full(4, concentration), size=length)
+    bg_freq = random_state.dirichlet(np.full(4, 10.0))
+    return pwm, calculate_H_model_bg(pwm, bg_freq), calculate_H_model(pwm)
+
+
+def sim_args(model1, model2):
+    (pwm1, H1_bg, H1), (pwm2, H2_bg, H2) = model1, model2
+    return pwm1, pwm2, H1_bg, H2_bg, H1, H2
+
+
+class ModelSimVectorizedTest(unittest.TestCase):
+
+    def assert_same(self, model1, model2, min_overlap):
+        expected = model_sim(*sim_args(model1, model2), min_overlap=min_overlap)
+        result = model_sim_vectorized(*sim_args(model1, model2), min_overlap=min_overlap)
+        self.assertAlmostEqual(result[0], expected[0], places=9)
+        self.assertEqual(result[1], expected[1])
+        self.assertEqual(result[2], expected[2])
+        np.testing.assert_allclose(result[3], expected[3], rtol=1e-9, atol=1e-9)
+
+    def test_random_models(self):
+        random_state = np.random.RandomState(1)
+        for _ in range(300):
+            min_overlap = random_state.randint(1, 6)
+            len1 = random_state.randint(min_overlap, 20)
+            len2 = random_state.randint(min_overlap, 20)
+            self.assert_same(random_model(random_state, len1), random_model(random_state, len2),
+                             min_overlap)
+
+    def test_switched_lengths(self):
+        random_state = np.random.RandomState(2)
+        short = random_model(random_state, 5)
+        long = random_model(random_state, 12)
+        for min_overlap in (1, 2, 4, 5):
+            self.assert_same(short, long, min_overlap)
+            self.assert_same(long, short, min_overlap)
+
+    def test_equal_lengths(self):
+        random_state = np.random.RandomState(3)
+        for min_overlap in (1, 3, 8):
+            self.assert_same(random_model(random_state, 8), random_model(random_state, 8),
+                             min_overlap)
+
+    def test_ties(self):
+
+        # every column is the same, so all alignments of the full overlap
+        # length score alike and the first one in create_slices order wins
+        column = np.array([[0.7, 0.1, 0.1, 0.1]])
+        bg_freq = np.full(4, 0.25)
+        for len1, len2 in ((10, 4), (4, 10), (6, 6), (9, 3)):
+            models = []
+            for length in (len1, len2):
+                pwm = np.repeat(column, length, axis=0)
+                models.append((pwm, calculate_H_model_bg(pwm, bg_freq), calculate_H_model(pwm)))
+            for min_overlap in (1, 2, 3):
+                self.assert_same(models[0], models[1], min_overlap)
+
+    def test_uniform_models(self):
+        # all scores are zero
+        pwm = np.full((7, 4), 0.25)
+        bg_freq = np.full(4, 0.25)
+        model = (pwm, calculate_H_model_bg(pwm, bg_freq), calculate_H_model(pwm))
+        short = (pwm[:4], model[1][:4], model[2][:4])
+        self.assert_same(model, short, 2)
+        self.assert_same(short, model, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
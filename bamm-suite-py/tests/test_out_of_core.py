@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from bamm_suite.db_search.out_of_core import IndexBlockReader, out_of_core_search
+from bamm_suite.db_search.packed_db import PackedModelDB
+from bamm_suite.db_search.search_index import write_search_index
+from bamm_suite.db_search.searcher import MotifSearcher
+
+from test_searcher import random_models
+
+
+class OutOfCoreTest(unittest.TestCase):
+
+    def test_blockwise_search_equals_in_memory_search(self):
+        # many blocks of different sizes, so that the shared buffer of the
+        # pool is reused and has to grow, and two batches of queries that
+        # read the blocks again
+        db_models = PackedModelDB(random_models(400, seed=9))
+        queries = random_models(6, seed=10, prefix='query')
+        in_memory = MotifSearcher(db_models, evalue_threshold=10.0)
+        expected = [in_memory.motif_search(query) for query in queries]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_path = os.path.join(tmp_dir, 'db.idx')
+            write_search_index(index_path, db_models, 4, None)
+            reader = IndexBlockReader(index_path)
+            for n_processes in (1, 2):
+                with mock.patch('bamm_suite.db_search.out_of_core.plan_memory',
+                                return_value=(300, 4)):
+                    results = list(out_of_core_search(reader, queries, 0,
+                                                      n_processes=n_processes,
+                                                      evalue_threshold=10.0))
+                self.assertEqual(len(results), len(queries))
+                for (strand_hits, stats), (expected_hits, expected_stats) in zip(results,
+                                                                                expected):
+                    self.assertEqual(strand_hits, expected_hits)
+                    self.assertEqual(stats['nulls'], expected_stats['nulls'])
+                    self.assertEqual(stats['pairs'], expected_stats['pairs'])
+        self.assertGreater(sum(len(hits) for strand_hits, _ in expected for hits in strand_hits),
+                           0)
+
+
+if __name__ == '__main__':
+    unittest.main()
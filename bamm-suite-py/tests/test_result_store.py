@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from bamm_suite.db_search.result_store import HitStore, query_hits
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# output rows of two queries, each strand in e-value order as db_search
+# writes them
+ROWS = [
+    ('query_0', 'model_3', 2.5, 0.001, 1, 8, 2, 9, 4.1, 1.2),
+    ('query_0', 'model_1', 1.9, 0.04, 1, 7, 1, 7, 3.9, 1.5),
+    ('query_0_rev', 'model_2', 2.2, 0.002, 2, 9, 1, 8, 4.0, 1.1),
+    ('query_1', 'model_1', 2.8, 0.0005, 1, 10, 3, 12, 4.4, 1.6),
+    ('query_1', 'model_2', 1.4, 0.09, 3, 9, 1, 7, 3.2, 1.8),
+]
+
+
+class HitStoreTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'hits.db')
+            with HitStore(path) as store:
+                store.add(ROWS[:2])
+                store.add(ROWS[2:])
+
+            columns, cursor = query_hits(path)
+            self.assertEqual(columns[:4], ['model_id', 'db_id', 'simscore', 'evalue'])
+            self.assertEqual(list(cursor), ROWS)
+
+            _, cursor = query_hits(path, order_by='evalue')
+            self.assertEqual(list(cursor), sorted(ROWS, key=lambda row: row[3]))
+
+            # a model id matches both strands of the query
+            _, cursor = query_hits(path, model_ids=['query_0'], max_evalue=0.01,
+                                   order_by='evalue')
+            self.assertEqual(list(cursor), [ROWS[0], ROWS[2]])
+
+            _, cursor = query_hits(path, db_ids=['model_1', 'model_2'], order_by='simscore',
+                                   limit=2)
+            self.assertEqual(list(cursor), [ROWS[3], ROWS[2]])
+
+    def test_db_search_rejects_sqlite_with_save_state(self):
+        # an incremental run merges tsv results, so a store written with
+        # --save_state could never be extended
+        completed = subprocess.run(
+            [sys.executable, '-m', 'bamm_suite.db_search.db_search', 'queries.json', 'db.json',
+             'hits.db', '--output_format', 'sqlite', '--save_state'],
+            cwd=PACKAGE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        self.assertEqual(completed.returncode, 2)
+        self.assertIn('--save_state', completed.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
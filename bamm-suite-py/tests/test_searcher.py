@@ -0,0 +1,195 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from bamm_suite.db_search.model_db import write_json_db
+from bamm_suite.db_search.packed_db import PackedModelDB
+from bamm_suite.db_search.searcher import MotifSearcher, HIT_DTYPE, reverse_complement
+from bamm_suite.db_search.utils import calculate_H_model_bg, calculate_H_model
+
+
+def random_models(n_models, seed, bg_freq=(0.25, 0.25, 0.25, 0.25), prefix='model',
+                  min_length=6, max_length=16, bg_like=False):
+
+    # random models, with bg_like their columns are close to the
+    # background or its reverse complement
+    random_state = np.random.RandomState(seed)
+    bg_freq = np.array(bg_freq, dtype=float)
+    models = []
+    for index in range(n_models):
+        length = random_state.randint(min_length, max_length + 1)
+        if bg_like:
+            means = np.where(random_state.rand(length, 1) < 0.5, bg_freq, bg_freq[::-1])
+            pwm = np.array([random_state.dirichlet(20 * mean) for mean in means])
+        else:
+            pwm = random_state.dirichlet(np.full(4, 0.5), size=length)
+        models.append({
+            'model_id': '%s_%s' % (prefix, index),
+            'pwm': pwm,
+            'bg_freq': bg_freq,
+            'H_model_bg': calculate_H_model_bg(pwm, bg_freq),
+            'H_model': calculate_H_model(pwm),
+        })
+    return models
+
+
+def hit_keys(strand_hits):
+    return [[(hit[1], hit[2], hit[3]) for hit in hits] for hits in strand_hits]
+
+
+class ReverseNullTest(unittest.TestCase):
+
+    def test_reverse_strand_is_searched_like_its_own_query(self):
+        # by default the reverse strand has its own null, so its hits are
+        # the forward hits of the reverse complement searched as a query
+        db_models = PackedModelDB(random_models(200, seed=1))
+        searcher = MotifSearcher(db_models, evalue_threshold=10.0)
+        for query in random_models(5, seed=2, prefix='query'):
+            strand_hits, stats = searcher.motif_search(query)
+            self.assertIn(query['model_id'] + '_rev', stats['nulls'])
+            rev_hits, _ = searcher.motif_search(reverse_complement(query))
+            self.assertEqual(hit_keys(strand_hits)[1], hit_keys(rev_hits)[0])
+
+
+ASYMMETRIC_BG = (0.7, 0.1, 0.1, 0.1)
+
+
+def all_hits(searcher, queries):
+    # the hits of both strands of all queries, with their e-values
+    return [hit_keys(searcher.motif_search(query)[0]) for query in queries]
+
+
+class PruningTest(unittest.TestCase):
+
+    def check_bounds(self, bg_freq, bg_like=False):
+        db_models = PackedModelDB(random_models(300, seed=3, bg_freq=bg_freq, bg_like=bg_like))
+        searcher = MotifSearcher(db_models)
+        for query in random_models(20, seed=4, bg_freq=bg_freq, prefix='query',
+                                   bg_like=bg_like):
+            strand_bounds = searcher.strand_upper_bounds(query)
+            for strand_query, bounds in zip([query, reverse_complement(query)], strand_bounds):
+                scores = db_models.score(strand_query['pwm'], strand_query['H_model_bg'],
+                                         strand_query['H_model'], min_overlap=4)[0]
+                finite = np.isfinite(scores)
+                self.assertTrue(np.all(scores[finite] <= bounds[finite]))
+
+    def test_bounds_hold_on_both_strands(self):
+        self.check_bounds((0.25, 0.25, 0.25, 0.25))
+
+    def test_bounds_hold_with_asymmetric_background(self):
+        # a query column close to the background has no entropy against it,
+        # its reverse complement does against the background of the database
+        self.check_bounds(ASYMMETRIC_BG, bg_like=True)
+
+    def test_pruned_search_is_exhaustive(self):
+        for bg_freq, bg_like in (((0.25, 0.25, 0.25, 0.25), False), (ASYMMETRIC_BG, True)):
+            db_models = PackedModelDB(random_models(300, seed=5, bg_freq=bg_freq,
+                                                    bg_like=bg_like))
+            queries = random_models(30, seed=6, bg_freq=bg_freq, prefix='query', bg_like=bg_like)
+            pruned = all_hits(MotifSearcher(db_models, evalue_threshold=1.0), queries)
+            exhaustive = all_hits(MotifSearcher(db_models, evalue_threshold=1.0, prune=False),
+                                  queries)
+            self.assertEqual(pruned, exhaustive)
+            self.assertGreater(sum(len(hits[1]) for hits in exhaustive), 0)
+
+
+class TopKTest(unittest.TestCase):
+
+    def test_top_k_is_the_best_of_the_full_search(self):
+        # the top_k hits with the lowest e-values, ties broken by strand and
+        # database order
+        for bg_freq, bg_like in (((0.25, 0.25, 0.25, 0.25), False), (ASYMMETRIC_BG, True)):
+            db_models = PackedModelDB(random_models(600, seed=7, bg_freq=bg_freq,
+                                                    bg_like=bg_like))
+            db_index = {model_id: index for index, model_id in enumerate(db_models.model_ids)}
+            queries = random_models(15, seed=8, bg_freq=bg_freq, prefix='query', bg_like=bg_like)
+            for top_k in (1, 3, 10):
+                full = MotifSearcher(db_models, evalue_threshold=100.0, prune=False)
+                searcher = MotifSearcher(db_models, evalue_threshold=100.0, top_k=top_k)
+                for query in queries:
+                    ranked = sorted((hit[2], strand, db_index[hit[0]], hit)
+                                    for strand, hits in enumerate(hit_keys(
+                                        full.motif_search(query)[0]))
+                                    for hit in hits)
+                    expected = [[], []]
+                    for _, strand, _, hit in sorted(ranked[:top_k], key=lambda item: item[2]):
+                        expected[strand].append(hit)
+                    self.assertEqual(hit_keys(searcher.motif_search(query)[0]), expected)
+
+
+def plain_query(query):
+    # the query as a user would pass it, with nested lists and no entropies
+    return {'model_id': query['model_id'], 'pwm': query['pwm'].tolist(),
+            'bg_freq': query['bg_freq'].tolist()}
+
+
+class SearchApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'db.json')
+        write_json_db(self.db_path, random_models(200, seed=11))
+        self.queries = random_models(6, seed=12, prefix='query')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def expected_hits(self, searcher, query):
+        # the hits of motif_search as rows of search, sorted by e-value
+        strand_hits, _ = searcher.motif_search(query)
+        rows = [(query['model_id'], hit[1], strand, hit[3])
+                for strand, hits in enumerate(strand_hits) for hit in hits]
+        return sorted(rows, key=lambda row: row[3])
+
+    def assert_hits(self, hits, expected):
+        self.assertEqual(hits.dtype, HIT_DTYPE)
+        self.assertEqual([(hit['model_id'], hit['db_id'], hit['strand'], hit['evalue'])
+                          for hit in hits], expected)
+
+    def test_search_numpy_and_list_input(self):
+        searcher = MotifSearcher.from_path(self.db_path, evalue_threshold=10.0)
+        self.assertEqual(len(searcher.db_models), 200)
+        n_hits = 0
+        for query in self.queries:
+            expected = self.expected_hits(searcher, query)
+            n_hits += len(expected)
+            self.assert_hits(searcher.search(query['pwm'], query['bg_freq'],
+                                             model_id=query['model_id']), expected)
+            plain = plain_query(query)
+            self.assert_hits(searcher.search(plain['pwm'], plain['bg_freq'],
+                                             model_id=plain['model_id']), expected)
+        self.assertGreater(n_hits, 0)
+
+    def test_search_many_numpy_and_list_input(self):
+        searcher = MotifSearcher.from_path(self.db_path, evalue_threshold=10.0)
+        expected = [self.expected_hits(searcher, query) for query in self.queries]
+        # a query shorter than min_overlap has no hits
+        short = {'model_id': 'short', 'pwm': [[0.25] * 4] * 3, 'bg_freq': [0.25] * 4}
+        for queries in (self.queries, [plain_query(query) for query in self.queries]):
+            results = searcher.search_many(queries + [short])
+            self.assertEqual(len(results), len(self.queries) + 1)
+            for hits, query_expected in zip(results, expected):
+                self.assert_hits(hits, query_expected)
+            self.assert_hits(results[-1], [])
+
+    def test_pooled_searcher_as_context_manager(self):
+        in_process = MotifSearcher.from_path(self.db_path, evalue_threshold=10.0)
+        expected = [self.expected_hits(in_process, query) for query in self.queries]
+        with MotifSearcher.from_path(self.db_path, evalue_threshold=10.0,
+                                     n_processes=2) as searcher:
+            self.assertIsNotNone(searcher.pool)
+            results = searcher.search_many([plain_query(query) for query in self.queries])
+            for hits, query_expected in zip(results, expected):
+                self.assert_hits(hits, query_expected)
+            query = self.queries[0]
+            self.assert_hits(searcher.search(query['pwm'], query['bg_freq'],
+                                             model_id=query['model_id']), expected[0])
+        # closing stops the pool and releases the shared database
+        self.assertIsNone(searcher.pool)
+        self.assertIsNone(searcher._shm)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from test_sharding import write_random_models
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEARCH_ARGS = ['--evalue_threshold', '10', '--n_processes', '1']
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super().__init__('localhost', timeout=60)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.queries = self.path('queries.json')
+        self.model_db = self.path('db.json')
+        write_random_models(self.queries, 4, seed=8, prefix='query')
+        write_random_models(self.model_db, 120, seed=9, prefix='model')
+        self.socket_path = self.path('server.sock')
+        self.server = subprocess.Popen(
+            [sys.executable, '-m', 'bamm_suite.db_search.server', self.model_db,
+             '--unix_socket', self.socket_path, '--reload_interval', '0.2'] + SEARCH_ARGS,
+            cwd=PACKAGE_DIR, stdout=subprocess.DEVNULL)
+        deadline = time.time() + 60
+        while not os.path.exists(self.socket_path):
+            self.assertIsNone(self.server.poll(), 'the server exited')
+            self.assertLess(time.time(), deadline, 'the server did not start listening')
+            time.sleep(0.1)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait(60)
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def request(self, method, url, body=None):
+        connection = UnixHTTPConnection(self.socket_path)
+        try:
+            connection.request(method, url, body)
+            response = connection.getresponse()
+            return response.status, response.read().decode()
+        finally:
+            connection.close()
+
+    def cli_output(self, model_db):
+        output_file = self.path('cli.tsv')
+        subprocess.run([sys.executable, '-m', 'bamm_suite.db_search.db_search', self.queries,
+                        model_db, output_file] + SEARCH_ARGS,
+                       cwd=PACKAGE_DIR, check=True, stdout=subprocess.DEVNULL)
+        with open(output_file) as handle:
+            return handle.read()
+
+    def search(self):
+        with open(self.queries) as handle:
+            return self.request('POST', '/search', handle.read())
+
+    def test_search_matches_the_cli(self):
+        status, body = self.search()
+        self.assertEqual(status, 200)
+        expected = self.cli_output(self.model_db)
+        self.assertEqual(body, expected)
+        self.assertGreater(expected.count('\n'), 5)
+
+    def test_malformed_requests_are_rejected(self):
+        with open(self.queries) as handle:
+            models = json.load(handle)
+        bad_pwm = [dict(models[0], pwm=[row[:3] for row in models[0]['pwm']])]
+        negative_pwm = [dict(models[0], pwm=[[-0.1, 0.5, 0.3, 0.3]] * 6)]
+        for body in ('[{"pwm": ', '[]', json.dumps([{'model_id': 'no pwm'}]),
+                     json.dumps(bad_pwm), json.dumps(negative_pwm)):
+            status, text = self.request('POST', '/search', body)
+            self.assertEqual(status, 400, body)
+            self.assertTrue(text.startswith('invalid request'), text)
+        # the server still answers valid requests
+        self.assertEqual(self.search()[0], 200)
+
+    def test_reload_picks_up_a_new_database(self):
+        new_db = self.path('new_db.json')
+        write_random_models(new_db, 80, seed=10, prefix='new')
+        expected = self.cli_output(new_db)
+        os.replace(new_db, self.model_db)
+
+        deadline = time.time() + 60
+        while True:
+            status, body = self.request('GET', '/status')
+            self.assertEqual(status, 200)
+            if json.loads(body)['n_models'] == 80:
+                break
+            self.assertLess(time.time(), deadline, 'the server did not reload the database')
+            time.sleep(0.2)
+        status, body = self.search()
+        self.assertEqual(status, 200)
+        self.assertEqual(body, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_random_models(path, n_models, seed, prefix):
+    random_state = np.random.RandomState(seed)
+    models = []
+    for index in range(n_models):
+        length = random_state.randint(6, 17)
+        models.append({
+            'model_id': '%s_%s' % (prefix, index),
+            'pwm': random_state.dirichlet(np.full(4, 0.5), size=length).tolist(),
+            'bg_freq': [0.25] * 4,
+        })
+    with open(path, 'w') as out:
+        json.dump(models, out)
+
+
+def run_module(module, *args):
+    subprocess.run([sys.executable, '-m', module] + list(args), cwd=PACKAGE_DIR, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+class ShardingTest(unittest.TestCase):
+
+    def test_merged_shards_equal_a_single_run(self):
+        # every shard fits the null against the whole database, so the
+        # merged shards are the output of a single run, byte by byte
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            queries = os.path.join(tmp_dir, 'queries.json')
+            model_db = os.path.join(tmp_dir, 'db.json')
+            write_random_models(queries, 7, seed=3, prefix='query')
+            write_random_models(model_db, 150, seed=4, prefix='model')
+            search_args = [queries, model_db, '--evalue_threshold', '10', '--n_processes', '1']
+
+            single = os.path.join(tmp_dir, 'single.tsv')
+            run_module('bamm_suite.db_search.db_search', *search_args + [single])
+
+            partial_results = []
+            for shard in range(1, 4):
+                for db_shard in range(1, 3):
+                    partial = os.path.join(tmp_dir, 'part_%s_%s.tsv' % (shard, db_shard))
+                    run_module('bamm_suite.db_search.db_search', *search_args + [
+                        '--shard', '%s/3' % shard, '--db_shard', '%s/2' % db_shard, partial])
+                    partial_results.append(partial)
+            merged = os.path.join(tmp_dir, 'merged.tsv')
+            run_module('bamm_suite.db_search.merge', *partial_results + [
+                merged, '--evalue_threshold', '10'])
+
+            with open(single) as handle:
+                expected = handle.read()
+            with open(merged) as handle:
+                self.assertEqual(handle.read(), expected)
+            self.assertGreater(expected.count('\n'), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()